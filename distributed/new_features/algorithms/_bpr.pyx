@@ -2,7 +2,7 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from cython.parallel import parallel, prange
-from libc.math cimport exp as cexp, pow as cpow, sqrt as csqrt
+from libc.math cimport exp as cexp, pow as cpow, sqrt as csqrt, log as clog
 from libcpp cimport bool
 from libcpp.algorithm cimport binary_search
 from libcpp.vector cimport vector
@@ -30,6 +30,58 @@ cdef bool check_consumed(const int[:] indices, const int[:] indptr,
                          item_neg)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef Py_ssize_t sample_negative(const int[:] indices,
+                                const int[:] indptr,
+                                const float *user_embed_ptr,
+                                const float *item_embed_ptr,
+                                int user,
+                                int item_pos,
+                                int n_items,
+                                int n_factors,
+                                bool warp,
+                                int max_trials,
+                                mt19937 *rng,
+                                uniform_int_distribution[long] *dist,
+                                float *weight) nogil:
+    # Uniform sampler returns the first unconsumed item with weight 1.
+    # WARP keeps drawing until a negative violates the margin,
+    # x_uj > x_ui - 1, and weights the step by log of the estimated rank
+    # of the positive item, (n_items - 1) / trials. Returns -1 if no
+    # violating item is found within max_trials draws.
+    cdef Py_ssize_t item_neg, j
+    cdef int trials = 0
+    cdef float pos_score = 0, neg_score
+    cdef const float *pos_ptr = item_embed_ptr + item_pos * n_factors
+    cdef const float *neg_ptr
+
+    if warp:
+        for j in range(n_factors):
+            pos_score = pos_score + user_embed_ptr[j] * pos_ptr[j]
+
+    while True:
+        item_neg = dist[0](rng[0])
+        if warp:
+            trials = trials + 1
+        if not check_consumed(indices, indptr, user, item_neg):
+            if not warp:
+                weight[0] = 1.0
+                return item_neg
+
+            neg_ptr = item_embed_ptr + item_neg * n_factors
+            neg_score = 0
+            for j in range(n_factors):
+                neg_score = neg_score + user_embed_ptr[j] * neg_ptr[j]
+            if neg_score > pos_score - 1.0:
+                weight[0] = clog(max(1.0, <float>((n_items - 1) / trials)))
+                return item_neg
+
+        if warp and trials >= max_trials:
+            return -1
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -37,7 +89,8 @@ cpdef bpr_update(optimizer, train_data, user_embed, item_embed, lr, reg,
                  n_users, n_items, shuffle, num_threads, seed, epoch, 
                  u_velocity=None, i_velocity=None, momentum=0.9, 
                  u_1st_mom=None, i_1st_mom=None, u_2nd_mom=None, 
-                 i_2nd_mom=None, rho1=0.9, rho2=0.999):
+                 i_2nd_mom=None, rho1=0.9, rho2=0.999, sampler="uniform",
+                 max_trials=10):
 
     if train_data.has_sampled:
         user_indices = train_data.user_indices_orig.astype(np.int32)
@@ -52,6 +105,9 @@ cpdef bpr_update(optimizer, train_data, user_embed, item_embed, lr, reg,
 
     if not reg:
         reg = 0.0
+    if sampler not in ("uniform", "warp"):
+        raise ValueError("sampler must either be 'uniform' or 'warp'")
+    warp = sampler == "warp"
 
     if shuffle:
         user_indices, item_indices = shuffle_data(
@@ -68,6 +124,8 @@ cpdef bpr_update(optimizer, train_data, user_embed, item_embed, lr, reg,
                         reg,
                         n_users,
                         n_items,
+                        warp,
+                        max_trials,
                         num_threads,
                         seed)
 
@@ -85,6 +143,8 @@ cpdef bpr_update(optimizer, train_data, user_embed, item_embed, lr, reg,
                              u_velocity, 
                              i_velocity,  
                              momentum, 
+                             warp,
+                             max_trials,
                              num_threads,
                              seed)
 
@@ -106,6 +166,8 @@ cpdef bpr_update(optimizer, train_data, user_embed, item_embed, lr, reg,
                          rho1, 
                          rho2, 
                          epoch, 
+                         warp,
+                         max_trials,
                          num_threads,
                          seed)
 
@@ -123,12 +185,14 @@ cdef void _bpr_update_sgd(const int[:] user_indices,
                           double reg, 
                           int n_users, 
                           int n_items, 
+                          bool warp, 
+                          int max_trials, 
                           int num_threads, 
                           int seed):
 
     cdef Py_ssize_t i, j, t, random_seed, user, item_pos, item_neg
     cdef int length = len(user_indices), embed_size = user_embed.shape[1] - 1
-    cdef float item_diff, log_sigmoid_grad
+    cdef float item_diff, log_sigmoid_grad, weight
     cdef float user_grad, item_pos_grad, item_neg_grad
     cdef long lower_bound = 0, upper_bound = n_items - 1
 
@@ -150,10 +214,14 @@ cdef void _bpr_update_sgd(const int[:] user_indices,
             t = i % num_threads
             user = user_indices[i]
             item_pos = item_indices[i]
-            item_neg = dist[t](rng[t])
-            while check_consumed(sparse_indices, sparse_indptr, 
-                                 user, item_neg):
-                item_neg = dist[t](rng[t])
+            weight = 1.0
+            item_neg = sample_negative(sparse_indices, sparse_indptr,
+                                       &user_embed[user, 0], &item_embed[0, 0],
+                                       user, item_pos, n_items,
+                                       embed_size + 1, warp, max_trials,
+                                       &rng[t], &dist[t], &weight)
+            if item_neg < 0:
+                continue
 
             user_embed_ptr = &user_embed[user, 0]
             item_pos_embed_ptr = &item_embed[item_pos, 0]
@@ -163,7 +231,7 @@ cdef void _bpr_update_sgd(const int[:] user_indices,
             for j in range(embed_size + 1):
                 item_diff = item_diff + user_embed_ptr[j] * (
                     item_pos_embed_ptr[j] - item_neg_embed_ptr[j])
-            log_sigmoid_grad = 1.0 / (1.0 + cexp(item_diff))
+            log_sigmoid_grad = weight / (1.0 + cexp(item_diff))
 
             for j in range(embed_size):
                 user_grad = log_sigmoid_grad * (
@@ -204,12 +272,14 @@ cdef void _bpr_update_momentum(const int[:] user_indices,
                                float[:, ::1] u_velocity, 
                                float[:, ::1] i_velocity, 
                                double momentum, 
+                               bool warp, 
+                               int max_trials, 
                                int num_threads, 
                                int seed):
 
     cdef Py_ssize_t i, j, t, random_seed, user, item_pos, item_neg
     cdef int length = len(user_indices), embed_size = user_embed.shape[1] - 1
-    cdef float item_diff, log_sigmoid_grad
+    cdef float item_diff, log_sigmoid_grad, weight
     cdef float user_grad, item_pos_grad, item_neg_grad
     cdef long lower_bound = 0, upper_bound = n_items - 1
 
@@ -235,10 +305,14 @@ cdef void _bpr_update_momentum(const int[:] user_indices,
             t = i % num_threads
             user = user_indices[i]
             item_pos = item_indices[i]
-            item_neg = dist[t](rng[t])
-            while check_consumed(sparse_indices, sparse_indptr, 
-                                 user, item_neg):
-                item_neg = dist[t](rng[t])
+            weight = 1.0
+            item_neg = sample_negative(sparse_indices, sparse_indptr,
+                                       &user_embed[user, 0], &item_embed[0, 0],
+                                       user, item_pos, n_items,
+                                       embed_size + 1, warp, max_trials,
+                                       &rng[t], &dist[t], &weight)
+            if item_neg < 0:
+                continue
 
             user_embed_ptr = &user_embed[user, 0]
             item_pos_embed_ptr = &item_embed[item_pos, 0]
@@ -252,7 +326,7 @@ cdef void _bpr_update_momentum(const int[:] user_indices,
             for j in range(embed_size + 1):
                 item_diff = item_diff + user_embed_ptr[j] * (
                     item_pos_embed_ptr[j] - item_neg_embed_ptr[j])
-            log_sigmoid_grad = 1.0 / (1.0 + cexp(item_diff))
+            log_sigmoid_grad = weight / (1.0 + cexp(item_diff))
 
             for j in range(embed_size + 1):
                 if j < embed_size:
@@ -302,12 +376,14 @@ cdef void _bpr_update_adam(const int[:] user_indices,
                            double rho1, 
                            double rho2, 
                            int epoch, 
+                           bool warp, 
+                           int max_trials, 
                            int num_threads, 
                            int seed):
 
     cdef Py_ssize_t i, j, t, random_seed, user, item_pos, item_neg
     cdef int length = len(user_indices), embed_size = user_embed.shape[1] - 1
-    cdef float item_diff, log_sigmoid_grad
+    cdef float item_diff, log_sigmoid_grad, weight
     cdef float user_grad, item_pos_grad, item_neg_grad
     cdef float unbias_v_user, unbias_h_user
     cdef float unbias_v_pos_item, unbias_h_pos_item
@@ -339,10 +415,14 @@ cdef void _bpr_update_adam(const int[:] user_indices,
             t = i % num_threads
             user = user_indices[i]
             item_pos = item_indices[i]
-            item_neg = dist[t](rng[t])
-            while check_consumed(sparse_indices, sparse_indptr, 
-                                 user, item_neg):
-                item_neg = dist[t](rng[t])
+            weight = 1.0
+            item_neg = sample_negative(sparse_indices, sparse_indptr,
+                                       &user_embed[user, 0], &item_embed[0, 0],
+                                       user, item_pos, n_items,
+                                       embed_size + 1, warp, max_trials,
+                                       &rng[t], &dist[t], &weight)
+            if item_neg < 0:
+                continue
 
             user_embed_ptr = &user_embed[user, 0]
             item_pos_embed_ptr = &item_embed[item_pos, 0]
@@ -359,7 +439,7 @@ cdef void _bpr_update_adam(const int[:] user_indices,
             for j in range(embed_size + 1):
                 item_diff = item_diff + user_embed_ptr[j] * (
                     item_pos_embed_ptr[j] - item_neg_embed_ptr[j])
-            log_sigmoid_grad = 1.0 / (1.0 + cexp(item_diff))
+            log_sigmoid_grad = weight / (1.0 + cexp(item_diff))
 
             for j in range(embed_size + 1):
                 if j < embed_size:
@@ -17,18 +17,22 @@ import time
 import logging
 from itertools import islice
 from functools import partial
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
+from scipy.sparse import csr_matrix
 from .base import Base
 from ..evaluate.evaluate import EvalMixin
-from ..utils.misc import time_block
+from ..utils.misc import time_block, colorize
 from ..utils.initializers import truncated_normal
+from ..utils.checkpoint import save_checkpoint
 try:
     from ._als import als_update
 except ImportError:
     LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
     logging.basicConfig(format=LOG_FORMAT)
     logging.warn("Als cython version is not available")
-    pass
+    als_update = None
 
 
 class ALS(Base, EvalMixin):
@@ -52,6 +56,9 @@ class ALS(Base, EvalMixin):
         self.user_consumed = None
         self.user_embed = None
         self.item_embed = None
+        self.history = None
+        self.quantized_user = None
+        self.quantized_item = None
 
         self._build_model()
         print("Als init end..")
@@ -64,46 +71,142 @@ class ALS(Base, EvalMixin):
             shape=[self.n_items, self.embed_size], mean=0.0, scale=0.03)
 
     def fit(self, train_data, verbose=1, shuffle=True, use_cg=True,
-            n_threads=1, eval_data=None, metrics=None):
+            n_threads=1, eval_data=None, metrics=None, warm_start_from=None,
+            tol=None, patience=1, n_jobs=1, checkpoint_dir=None,
+            checkpoint_every=1, resume_from=None):
+        """Alternate user and item sweeps for at most `n_epochs` epochs.
+
+        After every epoch the regularized training loss is recorded in
+        `self.history`, a dict of per-epoch "epoch", "loss" and "time" lists.
+        If `tol` is given, training stops when the loss hasn't decreased by
+        more than `tol` relative to the best loss for `patience` epochs.
+        With `n_jobs` > 1, sweeps run in that many processes over row shards
+        of shared memory, see `_ShardedALS`.
+        Factors and training state are saved to `checkpoint_dir` every
+        `checkpoint_every` epochs, `resume_from=checkpoint_dir` continues
+        after the saved epoch.
+        """
         self.show_start_time()
         self.user_consumed = train_data.user_consumed
-
-        user_interaction = train_data.sparse_interaction  # sparse.csr_matrix
-        item_interaction = user_interaction.T.tocsr()
+        if warm_start_from is not None:
+            self._warm_start(warm_start_from)
+        resume_meta = None
+        if resume_from is not None:
+            resume_meta = self._resume_checkpoint(
+                resume_from, {"user_embed": self.user_embed,
+                              "item_embed": self.item_embed})
+
+        # confidence is built on a copy, so fitting again on the same
+        # train_data, e.g. resuming or warm starting, sees the raw labels
+        user_interaction = train_data.sparse_interaction.copy()
         if self.task == "ranking":
             self._check_has_sampled(train_data, verbose)
             user_interaction.data = user_interaction.data * self.alpha + 1
-            item_interaction.data = item_interaction.data * self.alpha + 1
+        item_interaction = user_interaction.T.tocsr()
         trainer = self._choose_algo(use_cg)
-
-        for epoch in range(1, self.n_epochs + 1):
+        sharded = None
+        if n_jobs > 1:
+            sharded = _ShardedALS(user_interaction, item_interaction,
+                                  self.user_embed, self.item_embed,
+                                  self.task, n_jobs)
+            self.user_embed, self.item_embed = (
+                sharded.user_embed, sharded.item_embed)
+
+        try:
+            self._train_epochs(trainer, sharded, user_interaction,
+                               item_interaction, verbose, n_threads,
+                               eval_data, metrics, tol, patience,
+                               checkpoint_dir, checkpoint_every, resume_meta)
+        finally:
+            if sharded is not None:
+                self.user_embed, self.item_embed = sharded.close()
+
+    def _train_epochs(self, trainer, sharded, user_interaction,
+                      item_interaction, verbose, n_threads, eval_data,
+                      metrics, tol, patience, checkpoint_dir=None,
+                      checkpoint_every=1, resume_meta=None):
+        resume_meta = resume_meta or {}
+        self.history = resume_meta.get(
+            "history", {"epoch": [], "loss": [], "time": []})
+        best_loss = resume_meta.get("best_loss")
+        no_improve = resume_meta.get("no_improve", 0)
+        start_epoch = resume_meta.get("epoch", 0) + 1
+        for epoch in range(start_epoch, self.n_epochs + 1):
+            t0 = time.time()
             with time_block(f"Epoch {epoch}", verbose):
-                trainer(interaction=user_interaction,
-                        X=self.user_embed,
-                        Y=self.item_embed,
-                        reg=self.reg,
-                        num_threads=n_threads)
-                trainer(interaction=item_interaction,
-                        X=self.item_embed,
-                        Y=self.user_embed,
-                        reg=self.reg,
-                        num_threads=n_threads)
+                if sharded is not None:
+                    sharded.update("user", self.reg)
+                    sharded.update("item", self.reg)
+                else:
+                    trainer(interaction=user_interaction,
+                            X=self.user_embed,
+                            Y=self.item_embed,
+                            reg=self.reg,
+                            num_threads=n_threads)
+                    trainer(interaction=item_interaction,
+                            X=self.item_embed,
+                            Y=self.user_embed,
+                            reg=self.reg,
+                            num_threads=n_threads)
+            train_time = time.time() - t0
+
+            loss = _als_loss(user_interaction, self.user_embed,
+                             self.item_embed, self.reg, self.task)
+            self.history["epoch"].append(epoch)
+            self.history["loss"].append(loss)
+            self.history["time"].append(train_time)
 
             if verbose > 1:
+                train_loss_str = f"train_loss: {loss:.4f}"
+                print(f"\t {colorize(train_loss_str, 'green')}")
                 self.print_metrics(eval_data=eval_data, metrics=metrics)
                 print("="*30)
 
+            stop = False
+            if tol is not None:
+                if (best_loss is None
+                        or best_loss - loss > tol * abs(best_loss)):
+                    best_loss, no_improve = loss, 0
+                else:
+                    no_improve += 1
+                    stop = no_improve >= patience
+
+            if checkpoint_dir is not None and (
+                    epoch % checkpoint_every == 0 or stop
+                    or epoch == self.n_epochs):
+                save_checkpoint(
+                    checkpoint_dir, epoch,
+                    {"user_embed": self.user_embed,
+                     "item_embed": self.item_embed},
+                    meta={"history": self.history, "best_loss": best_loss,
+                          "no_improve": no_improve})
+
+            if stop:
+                if verbose > 0:
+                    print(f"early stopping at epoch {epoch}, train loss "
+                          f"didn't improve more than {tol} in "
+                          f"{patience} epoch(s)")
+                break
+
+    def _warm_start(self, previous_model):
+        # reuse factors of known users and items, new ones keep random init
+        (user_new, user_old), (item_new, item_old) = (
+            self._warm_start_indices(previous_model))
+        self.user_embed[user_new] = previous_model.user_embed[user_old]
+        self.item_embed[item_new] = previous_model.item_embed[item_old]
+
     def _choose_algo(self, use_cg):
+        update = als_update if als_update is not None else _als_update_py
         if self.task == "rating":
             if use_cg:
-                trainer = partial(als_update, task="rating", use_cg=True)
+                trainer = partial(update, task="rating", use_cg=True)
             else:
-                trainer = partial(als_update, task="rating", use_cg=False)
+                trainer = partial(update, task="rating", use_cg=False)
         elif self.task == "ranking":
             if use_cg:
-                trainer = partial(als_update, task="ranking", use_cg=True)
+                trainer = partial(update, task="ranking", use_cg=True)
             else:
-                trainer = partial(als_update, task="ranking", use_cg=False)
+                trainer = partial(update, task="ranking", use_cg=False)
         return trainer
 
     def predict(self, user, item):
@@ -131,14 +234,17 @@ class ALS(Base, EvalMixin):
 
         return preds[0] if len(user) == 1 else preds
 
-    def recommend_user(self, user, n_rec, **kwargs):
+    def recommend_user(self, user, n_rec, quantized=False, **kwargs):
         user = self._check_unknown_user(user)
         if not user:
             return   # popular ?
 
         consumed = self.user_consumed[user]
         count = n_rec + len(consumed)
-        recos = self.user_embed[user] @ self.item_embed.T
+        if quantized:
+            recos = self._quantized_scores(user)
+        else:
+            recos = self.user_embed[user] @ self.item_embed.T
         if self.task == "ranking":
             recos = 1 / (1 + np.exp(-recos))
 
@@ -150,19 +256,203 @@ class ALS(Base, EvalMixin):
             )
         )
 
+    def _serving_factors(self):
+        return self.user_embed, self.item_embed
+
+
+def _als_update_py(interaction, X, Y, reg, task, use_cg=True, num_threads=1,
+                   cg_steps=3):
+    # same interface as cython `als_update`, num_threads is unused
+    mode = "explicit" if task == "rating" else "implicit"
+    embed_size, num = X.shape[1], X.shape[0]
+    if use_cg:
+        _least_squares_cg(interaction, X, Y, reg, embed_size, num, mode,
+                          cg_steps)
+    else:
+        _least_squares(interaction, X, Y, reg, embed_size, num, mode)
+
+
+class _ShardedALS(object):
+    """Process-parallel ALS half-steps over row shards in shared memory.
+
+    Csr arrays of both interaction matrices and both factor matrices are
+    placed in `multiprocessing.shared_memory` once, and a worker pool
+    attaches to them at start. Every half-step is split into contiguous row
+    ranges with about equal number of interactions, each task solves its
+    rows against the opposite factors and writes them back in place. YtY of
+    implicit feedback is computed once per half-step here and sent along.
+
+    Rows are solved exactly in vectorized batches, so `use_cg` and the
+    cython kernel don't apply. Set OMP_NUM_THREADS / OPENBLAS_NUM_THREADS
+    to about cpu_count // n_jobs to avoid oversubscription of BLAS threads.
+    """
+
+    def __init__(self, user_interaction, item_interaction, user_embed,
+                 item_embed, task, n_jobs, shards_per_job=4):
+        self.task = task
+        self._blocks = []
+        arrays = {"user_indptr": user_interaction.indptr,
+                  "user_indices": user_interaction.indices,
+                  "user_data": user_interaction.data,
+                  "item_indptr": item_interaction.indptr,
+                  "item_indices": item_interaction.indices,
+                  "item_data": item_interaction.data,
+                  "user_embed": user_embed,
+                  "item_embed": item_embed}
+        specs, shared = {}, {}
+        try:
+            for name, array in arrays.items():
+                shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._blocks.append(shm)
+                shared[name] = np.ndarray(array.shape, array.dtype,
+                                          buffer=shm.buf)
+                shared[name][:] = array
+                specs[name] = (shm.name, array.shape, array.dtype.str)
+            self._pool = Pool(processes=n_jobs, initializer=_attach_shared,
+                              initargs=(specs,))
+        except Exception:
+            shared.clear()
+            self._release()
+            raise
+
+        self.user_embed = shared["user_embed"]
+        self.item_embed = shared["item_embed"]
+        self._shards = {
+            "user": _shard_bounds(user_interaction.indptr,
+                                  n_jobs * shards_per_job),
+            "item": _shard_bounds(item_interaction.indptr,
+                                  n_jobs * shards_per_job)
+        }
+
+    def update(self, side, reg):
+        Y = self.item_embed if side == "user" else self.user_embed
+        YtY = Y.T @ Y if self.task == "ranking" else None
+        tasks = [(side, start, end, reg, self.task, YtY)
+                 for start, end in self._shards[side]]
+        self._pool.starmap(_sharded_als_worker, tasks)
+
+    def close(self):
+        # copy factors out before releasing shared memory
+        user_embed, item_embed = self.user_embed.copy(), self.item_embed.copy()
+        self._pool.close()
+        self._pool.join()
+        self.user_embed = self.item_embed = None
+        self._release()
+        return user_embed, item_embed
+
+    def _release(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+
+def _shard_bounds(indptr, n_shards):
+    # contiguous row ranges with about equal number of interactions
+    num = len(indptr) - 1
+    cuts = np.searchsorted(indptr, np.linspace(0, indptr[-1], n_shards + 1))
+    bounds = np.unique(np.clip(np.concatenate([[0], cuts, [num]]), 0, num))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+_SHARED_BLOCKS = []
+_SHARED_ARRAYS = {}
+
+
+def _attach_shared(specs):
+    # pool initializer, blocks are kept open for the worker's lifetime
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = SharedMemory(name=shm_name)
+        _SHARED_BLOCKS.append(shm)
+        _SHARED_ARRAYS[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+def _sharded_als_worker(side, start, end, reg, task, YtY):
+    other = "item" if side == "user" else "user"
+    indptr = _SHARED_ARRAYS[f"{side}_indptr"]
+    X = _SHARED_ARRAYS[f"{side}_embed"]
+    Y = _SHARED_ARRAYS[f"{other}_embed"]
+    offset, offset_end = indptr[start], indptr[end]
+    shard = csr_matrix(
+        (_SHARED_ARRAYS[f"{side}_data"][offset: offset_end],
+         _SHARED_ARRAYS[f"{side}_indices"][offset: offset_end],
+         indptr[start: end + 1] - offset),
+        shape=(end - start, len(Y)))
+    mode = "explicit" if task == "rating" else "implicit"
+    _least_squares_batch(shard, X[start:end], Y, reg, X.shape[1],
+                         end - start, mode, YtY)
+
+
+def _als_loss(interaction, X, Y, reg, task, chunk_nnz=2 ** 20):
+    # Regularized training objective divided by the number of interactions.
+    # For ranking task `interaction` holds confidence c = 1 + alpha * r, the
+    # unobserved pairs with c = 1 and preference 0 contribute sum((X @ Y^T)^2)
+    # = sum(X^T X * Y^T Y), so the dense prediction matrix is never built.
+    indptr = interaction.indptr
+    indices = interaction.indices
+    data = interaction.data
+    loss = 0.0
+    for start in range(0, len(data), chunk_nnz):
+        end = min(start + chunk_nnz, len(data))
+        rows = np.searchsorted(indptr, np.arange(start, end), side="right") - 1
+        preds = np.einsum("ij,ij->i", X[rows], Y[indices[start:end]])
+        if task == "rating":
+            loss += np.sum((data[start:end] - preds) ** 2)
+        else:
+            loss += np.sum(data[start:end] * (1 - preds) ** 2 - preds ** 2)
+    if task == "ranking":
+        loss += np.sum((X.T @ X) * (Y.T @ Y))
+    if reg:
+        loss += reg * (np.sum(X ** 2) + np.sum(Y ** 2))
+    return float(loss) / max(1, len(data))
+
+
+def _least_squares_batch(sparse_interaction, X, Y, reg, embed_size, num,
+                         mode="explicit", YtY=None, batch_elements=2 ** 24):
+    # Rows are solved in batches, A = Ym^T @ Ym + lambda * I of every row is
+    # a segment sum of outer products, then one stacked np.linalg.solve.
+    # Implicit mode weights outer products by c - 1 and b by c on top of
+    # YtY, which is computed here unless given.
+    # Batches are bounded by nnz * embed_size^2 elements of outer products.
+    indices = sparse_interaction.indices
+    indptr = sparse_interaction.indptr
+    data = sparse_interaction.data
+    init_A = reg * np.eye(embed_size, dtype=np.float32)
+    if mode == "implicit":
+        init_A = init_A + (Y.T @ Y if YtY is None else YtY)
+    row_nnz = np.diff(indptr[:num + 1])
+    cum_nnz = np.cumsum(row_nnz)
+    max_nnz = max(1, batch_elements // (embed_size * embed_size))
+    start = 0
+    while start < num:
+        offset = cum_nnz[start - 1] if start > 0 else 0
+        end = max(start + 1, int(np.searchsorted(
+            cum_nnz, offset + max_nnz, side="right")))
+        y = Y[indices[indptr[start]: indptr[end]]]
+        labels = data[indptr[start]: indptr[end]]
+        non_empty = np.flatnonzero(row_nnz[start:end])
+        seg_starts = indptr[start:end][non_empty] - indptr[start]
+
+        A = np.broadcast_to(init_A, (end - start, embed_size, embed_size)).copy()
+        b = np.zeros((end - start, embed_size), dtype=np.float32)
+        if len(non_empty) > 0:
+            outer = y[:, :, None] * y[:, None, :]
+            if mode == "implicit":
+                outer *= (labels - 1)[:, None, None]
+            A[non_empty] += np.add.reduceat(outer, seg_starts, axis=0)
+            b[non_empty] = np.add.reduceat(
+                y * labels[:, None], seg_starts, axis=0)
+        X[start:end] = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+        start = end
+
 
 def _least_squares(sparse_interaction, X, Y, reg, embed_size, num, mode):
     indices = sparse_interaction.indices
     indptr = sparse_interaction.indptr
     data = sparse_interaction.data
     if mode == "explicit":
-        for m in range(num):
-            m_slice = slice(indptr[m], indptr[m + 1])
-            interacted = Y[indices[m_slice]]
-            labels = data[m_slice]
-            A = interacted.T @ interacted + reg * np.eye(embed_size)
-            b = interacted.T @ labels
-            X[m] = np.linalg.solve(A, b)
+        _least_squares_batch(sparse_interaction, X, Y, reg, embed_size, num,
+                             mode="explicit")
     elif mode == "implicit":
         init_A = Y.T @ Y + reg * np.eye(embed_size, dtype=np.float32)
         for m in range(num):
@@ -186,13 +476,9 @@ def _least_squares_cg(sparse_interaction, X, Y, reg, embed_size, num,
     indptr = sparse_interaction.indptr
     data = sparse_interaction.data
     if mode == "explicit":
-        for m in range(num):
-            m_slice = slice(indptr[m], indptr[m + 1])
-            interacted = Y[indices[m_slice]]
-            labels = data[m_slice]
-            A = interacted.T @ interacted + reg * np.eye(embed_size)
-            b = interacted.T @ labels
-            X[m] = np.linalg.solve(A, b)
+        # exact solve, rows are small enough to need no iteration
+        _least_squares_batch(sparse_interaction, X, Y, reg, embed_size, num,
+                             mode="explicit")
     elif mode == "implicit":
         init_A = Y.T @ Y + reg * np.eye(embed_size, dtype=np.float32)
         for m in range(num):
@@ -2,10 +2,22 @@ import abc
 import os
 import multiprocessing
 import numpy as np
-import tensorflow as tf
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
 from ..utils.timing import time_block
 from ..utils.colorize import colorize
 from ..utils.exception import NotSamplingError
+from ..utils.checkpoint import load_checkpoint
+from ..utils.quantize import (
+    quantize_table,
+    dequantize_table,
+    blocked_scores,
+    table_nbytes
+)
+from ..evaluate.evaluate import sample_user
+from ..evaluate.metrics import recall_at_k
 
 
 class Base(abc.ABC):
@@ -84,6 +96,164 @@ class Base(abc.ABC):
         """
         raise NotImplementedError
 
+    def _warm_start_indices(self, previous_model):
+        """Map users and items shared with a previously trained model.
+
+        Parameters
+        ----------
+        previous_model : model object
+            Model of the same class trained on earlier data.
+
+        Returns
+        -------
+        indices: tuple of tuples
+            ((user_new, user_old), (item_new, item_old)), where rows
+            `user_old` of previous model correspond to rows `user_new` of
+            this model, through raw ids in `data_info.user2id/item2id`.
+        """
+        if previous_model.embed_size != self.embed_size:
+            raise ValueError(f"embed_size of previous model "
+                             f"({previous_model.embed_size}) must be same "
+                             f"as current one ({self.embed_size})")
+
+        indices = []
+        for attr in ("user2id", "item2id"):
+            new_mapping = getattr(self.data_info, attr)
+            old_mapping = getattr(previous_model.data_info, attr)
+            pairs = [(new_mapping[raw], old_id)
+                     for raw, old_id in old_mapping.items()
+                     if raw != -1 and raw in new_mapping]
+            if pairs:
+                new_ids, old_ids = map(np.array, zip(*pairs))
+            else:
+                new_ids = old_ids = np.zeros(0, dtype=np.int64)
+            indices.append((new_ids, old_ids))
+
+        n_users, n_items = len(indices[0][0]), len(indices[1][0])
+        print(f"warm start from previous model, {n_users} users and "
+              f"{n_items} items are reused")
+        return tuple(indices)
+
+    def quantize_factors(self, dtype="int8", eval_data=None, k=10,
+                         sample_user_num=1000, seed=42):
+        """Export reduced-precision factor tables for serving.
+
+        After this, `recommend_user(user, n_rec, quantized=True)` scores
+        items from the quantized tables, dequantizing them in blocks.
+
+        Parameters
+        ----------
+        dtype : {"float16", "int8"}
+            Storage type, int8 uses a per-row scale.
+        eval_data : `TransformedSet` object, optional
+            If provided, recall@k of full and quantized factors are compared
+            on sampled users of this data.
+        k : int
+            Number of recommendations compared.
+        sample_user_num : int
+            Number of users used in comparison.
+        seed : int
+            Random seed of user sampling.
+
+        Returns
+        -------
+        report: dict
+            Memory of full and quantized factors in bytes, mean overlap of
+            top-k recommendations, and with `eval_data`, recall@k of both
+            and their delta.
+        """
+        user_factors, item_factors = self._serving_factors()
+        self.quantized_user = quantize_table(user_factors, dtype)
+        self.quantized_item = quantize_table(item_factors, dtype)
+        report = {
+            "dtype": dtype,
+            "full_bytes": user_factors.nbytes + item_factors.nbytes,
+            "quantized_bytes": (table_nbytes(self.quantized_user) +
+                                table_nbytes(self.quantized_item))
+        }
+
+        if eval_data is not None:
+            n_users = len(np.unique(eval_data.user_indices))
+            users = sample_user(eval_data, seed, min(sample_user_num, n_users))
+        else:
+            np.random.seed(seed)
+            users = list(np.random.choice(
+                self.n_users, min(sample_user_num, self.n_users),
+                replace=False))
+
+        full_recos, quantized_recos = dict(), dict()
+        for u in users:
+            full = self.recommend_user(u, k)
+            quantized = self.recommend_user(u, k, quantized=True)
+            if full and quantized:
+                full_recos[u] = [r[0] for r in full]
+                quantized_recos[u] = [r[0] for r in quantized]
+        users = list(full_recos)
+        report["topk_overlap"] = np.mean(
+            [len(set(full_recos[u]).intersection(quantized_recos[u])) /
+             len(full_recos[u]) for u in users]) if users else None
+
+        if eval_data is not None and users:
+            recall_full = recall_at_k(
+                eval_data.user_consumed, full_recos, users, k)
+            recall_quantized = recall_at_k(
+                eval_data.user_consumed, quantized_recos, users, k)
+            report.update(recall_full=recall_full,
+                          recall_quantized=recall_quantized,
+                          recall_delta=recall_quantized - recall_full)
+
+        print(f"{dtype} factors: {report['quantized_bytes']} bytes, "
+              f"full precision: {report['full_bytes']} bytes")
+        if "recall_delta" in report:
+            print(f"recall@{k} full: {report['recall_full']:.4f}, "
+                  f"{dtype}: {report['recall_quantized']:.4f}, "
+                  f"delta: {report['recall_delta']:.4f}")
+        return report
+
+    def _serving_factors(self):
+        """User and item factor tables whose dot products are the raw scores.
+
+        Returns
+        -------
+        factors: tuple of numpy.ndarray
+            (user_factors, item_factors)
+        """
+        raise NotImplementedError
+
+    def _quantized_scores(self, user, block_size=65536):
+        if self.quantized_item is None:
+            raise ValueError("quantized factors not available, "
+                             "call `quantize_factors` first")
+        user_vector = dequantize_table(self.quantized_user, user, user + 1)
+        return blocked_scores(user_vector[0], self.quantized_item, block_size)
+
+    def _resume_checkpoint(self, path, arrays):
+        """Copy arrays of the latest checkpoint in `path` into `arrays`.
+
+        Arrays are overwritten in place, so references held by trainers
+        stay valid. The global numpy random state is restored as well.
+
+        Parameters
+        ----------
+        path : str
+            Checkpoint directory written during a previous `fit`.
+        arrays : dict of {str: numpy.ndarray}
+            Current factors and optimizer states.
+
+        Returns
+        -------
+        meta: dict
+            Saved training state, including the finished `epoch`.
+        """
+        meta, saved = load_checkpoint(path)
+        for name, array in arrays.items():
+            if name not in saved or saved[name].shape != array.shape:
+                raise ValueError(f"checkpoint in {path} doesn't match "
+                                 f"current model on {name}")
+            array[:] = saved[name]
+        print(f"resume training from epoch {meta['epoch']} in {path}")
+        return meta
+
     def _check_unknown(self, user, item):
         unknown_user_indices = list(
             np.where(np.logical_or(user >= self.n_users, user < 0))[0])
@@ -11,23 +11,27 @@ import logging
 from itertools import islice
 from functools import partial
 import numpy as np
-import tensorflow as tf
-from tensorflow.python.keras.initializers import (
-    zeros as tf_zeros,
-    truncated_normal as tf_truncated_normal
-)
+try:
+    import tensorflow as tf
+    from tensorflow.python.keras.initializers import (
+        zeros as tf_zeros,
+        truncated_normal as tf_truncated_normal
+    )
+except ImportError:
+    tf = None
 from .base import Base, TfMixin
 from ..evaluate.evaluate import EvalMixin
-from ..utils.sampling import PairwiseSampling
-from ..utils.misc import time_block, colorize
+from ..utils.sampling import PairwiseSampling, PrefetchSampling, ConsumedPairs
+from ..utils.misc import time_block, colorize, shuffle_data
 from ..utils.initializers import truncated_normal
+from ..utils.checkpoint import save_checkpoint
 try:
     from ._bpr import bpr_update
 except (ImportError, ModuleNotFoundError):
     LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
     logging.basicConfig(format=LOG_FORMAT)
     logging.warning("BPR cython version is not available")
-    pass  # may use tf version, then raise error will fail
+    bpr_update = None
 
 
 class BPR(Base, TfMixin, EvalMixin):
@@ -58,8 +62,12 @@ class BPR(Base, TfMixin, EvalMixin):
         self.user_consumed = None
         self.user_embed = None
         self.item_embed = None
+        self.quantized_user = None
+        self.quantized_item = None
 
         if use_tf:
+            if tf is None:
+                raise ImportError("use_tf=True requires tensorflow")
             TfMixin.__init__(self)
         #    self.sess = tf.Session()
             self._build_model_tf()
@@ -136,10 +144,33 @@ class BPR(Base, TfMixin, EvalMixin):
         self.sess.run(tf.global_variables_initializer())
 
     def fit(self, train_data, verbose=1, shuffle=True, num_threads=1,
-            eval_data=None, metrics=None, optimizer="sgd"):
+            eval_data=None, metrics=None, optimizer="sgd",
+            warm_start_from=None, sampler="uniform", max_trials=10,
+            checkpoint_dir=None, checkpoint_every=1, resume_from=None):
+        """Train on the whole data for `n_epochs` epochs.
+
+        Without tf, the cython `bpr_update` is used if compiled, otherwise
+        a numpy mini-batch version of it with `batch_size`.
+        `sampler="warp"` keeps drawing negatives
+        until one scores higher than the positive item minus a margin of 1,
+        up to `max_trials` draws, and scales the step by the log of the
+        estimated rank of the positive item. Pairs without such a negative
+        are skipped. Since steps are scaled up to log(n_items), a smaller
+        `lr` than with uniform sampling is usually needed.
+
+        Without tf, factors and optimizer states are saved to
+        `checkpoint_dir` every `checkpoint_every` epochs, and
+        `resume_from=checkpoint_dir` continues after the saved epoch.
+        """
+        if self.use_tf and sampler != "uniform":
+            raise ValueError("only uniform sampler is available in tf version")
+        if self.use_tf and (checkpoint_dir or resume_from):
+            raise ValueError("checkpoint is only available without tf")
         self.show_start_time()
         self.user_consumed = train_data.user_consumed
         self._check_has_sampled(train_data, verbose)
+        if warm_start_from is not None:
+            self._warm_start(warm_start_from)
 
         if self.use_tf:
             self._fit_tf(train_data, verbose=verbose, shuffle=shuffle,
@@ -147,22 +178,54 @@ class BPR(Base, TfMixin, EvalMixin):
         else:
             self._fit_cython(train_data, verbose=verbose, shuffle=shuffle,
                              num_threads=num_threads, eval_data=eval_data,
-                             metrics=metrics, optimizer=optimizer)
+                             metrics=metrics, optimizer=optimizer,
+                             sampler=sampler, max_trials=max_trials,
+                             checkpoint_dir=checkpoint_dir,
+                             checkpoint_every=checkpoint_every,
+                             resume_from=resume_from)
+
+    def _warm_start(self, previous_model):
+        # reuse factors of known users and items, new ones keep random init.
+        # Previous factors are numpy arrays with item bias as last column
+        # whichever backend trained them.
+        (user_new, user_old), (item_new, item_old) = (
+            self._warm_start_indices(previous_model))
+        if self.use_tf:
+            user_embed, item_embed, item_bias = self.sess.run(
+                [self.user_embed_var, self.item_embed_var, self.item_bias_var])
+            user_embed[user_new] = previous_model.user_embed[
+                user_old, :self.embed_size]
+            item_embed[item_new] = previous_model.item_embed[
+                item_old, :self.embed_size]
+            item_bias[item_new] = previous_model.item_embed[
+                item_old, self.embed_size]
+            self.user_embed_var.load(user_embed, self.sess)
+            self.item_embed_var.load(item_embed, self.sess)
+            self.item_bias_var.load(item_bias, self.sess)
+        else:
+            self.user_embed[user_new] = previous_model.user_embed[user_old]
+            self.item_embed[item_new] = previous_model.item_embed[item_old]
 
     def _fit_cython(self, train_data, verbose=1, shuffle=True, num_threads=1,
-                    eval_data=None, metrics=None, optimizer="sgd"):
+                    eval_data=None, metrics=None, optimizer="sgd",
+                    sampler="uniform", max_trials=10, checkpoint_dir=None,
+                    checkpoint_every=1, resume_from=None):
+        if bpr_update is not None:
+            update = bpr_update
+        else:
+            update = partial(_bpr_update_py, batch_size=self.batch_size)
 
         if optimizer == "sgd":
-            trainer = partial(bpr_update)
+            optimizer_state = dict()
+            trainer = partial(update)
 
         elif optimizer == "momentum":
             user_velocity = np.zeros_like(self.user_embed, dtype=np.float32)
             item_velocity = np.zeros_like(self.item_embed, dtype=np.float32)
             momentum = 0.9
-            trainer = partial(bpr_update,
-                              u_velocity=user_velocity,
-                              i_velocity=item_velocity,
-                              momentum=momentum)
+            optimizer_state = dict(u_velocity=user_velocity,
+                                   i_velocity=item_velocity)
+            trainer = partial(update, momentum=momentum, **optimizer_state)
 
         elif optimizer == "adam":
             # refer to the "Deep Learning" book,
@@ -172,19 +235,26 @@ class BPR(Base, TfMixin, EvalMixin):
             user_2nd_moment = np.zeros_like(self.user_embed, dtype=np.float32)
             item_2nd_moment = np.zeros_like(self.item_embed, dtype=np.float32)
             rho1, rho2 = 0.9, 0.999
-            trainer = partial(bpr_update,
-                              u_1st_mom=user_1st_moment,
-                              i_1st_mom=item_1st_moment,
-                              u_2nd_mom=user_2nd_moment,
-                              i_2nd_mom=item_2nd_moment,
-                              rho1=rho1,
-                              rho2=rho2)
+            optimizer_state = dict(u_1st_mom=user_1st_moment,
+                                   i_1st_mom=item_1st_moment,
+                                   u_2nd_mom=user_2nd_moment,
+                                   i_2nd_mom=item_2nd_moment)
+            trainer = partial(update, rho1=rho1, rho2=rho2, **optimizer_state)
 
         else:
             raise ValueError("optimizer must be one of these: "
                              "('sgd', 'momentum', 'adam')")
 
-        for epoch in range(1, self.n_epochs + 1):
+        # optimizer states are bound to the trainer, so they are
+        # restored in place
+        train_state = dict(user_embed=self.user_embed,
+                           item_embed=self.item_embed, **optimizer_state)
+        start_epoch = 1
+        if resume_from is not None:
+            meta = self._resume_checkpoint(resume_from, train_state)
+            start_epoch = meta["epoch"] + 1
+
+        for epoch in range(start_epoch, self.n_epochs + 1):
             with time_block(f"Epoch {epoch}", verbose):
                 trainer(optimizer=optimizer,
                         train_data=train_data,
@@ -197,7 +267,14 @@ class BPR(Base, TfMixin, EvalMixin):
                         shuffle=shuffle,
                         num_threads=num_threads,
                         seed=self.seed,
-                        epoch=epoch)
+                        epoch=epoch,
+                        sampler=sampler,
+                        max_trials=max_trials)
+
+            if checkpoint_dir is not None and (
+                    epoch % checkpoint_every == 0 or epoch == self.n_epochs):
+                save_checkpoint(checkpoint_dir, epoch, train_state,
+                                meta={"optimizer": optimizer})
 
             if verbose > 1:
                 self.print_metrics(eval_data=eval_data, metrics=metrics)
@@ -206,9 +283,10 @@ class BPR(Base, TfMixin, EvalMixin):
     def _fit_tf(self, train_data, verbose=1, shuffle=True,
                 eval_data=None, metrics=None):
 
-        data_generator = PairwiseSampling(train_data,
-                                          self.data_info,
-                                          self.num_neg)
+        # batches are sampled in a background thread during sess.run
+        data_generator = PrefetchSampling(
+            PairwiseSampling(train_data, self.data_info, self.num_neg),
+            seed=self.seed)
 
         for epoch in range(1, self.n_epochs + 1):
             with time_block(f"Epoch {epoch}", verbose):
@@ -250,14 +328,17 @@ class BPR(Base, TfMixin, EvalMixin):
 
         return preds[0] if len(user) == 1 else preds
 
-    def recommend_user(self, user, n_rec, **kwargs):
+    def recommend_user(self, user, n_rec, quantized=False, **kwargs):
         user = self._check_unknown_user(user)
         if not user:
             return   # popular ?
 
         consumed = self.user_consumed[user]
         count = n_rec + len(consumed)
-        recos = self.user_embed[user] @ self.item_embed.T
+        if quantized:
+            recos = self._quantized_scores(user)
+        else:
+            recos = self.user_embed[user] @ self.item_embed.T
         recos = 1 / (1 + np.exp(-recos))
 
         ids = np.argpartition(recos, -count)[-count:]
@@ -268,6 +349,10 @@ class BPR(Base, TfMixin, EvalMixin):
             )
         )
 
+    def _serving_factors(self):
+        # item bias is already the last column
+        return self.user_embed, self.item_embed
+
     def _set_latent_factors(self):
         item_bias, user_embed, item_embed = self.sess.run(
             [self.item_bias_var, self.user_embed_var, self.item_embed_var]
@@ -281,6 +366,124 @@ class BPR(Base, TfMixin, EvalMixin):
         self.item_embed = np.hstack([item_embed, item_bias])
 
 
-
-
-
+def _bpr_update_py(optimizer, train_data, user_embed, item_embed, lr, reg,
+                   n_users, n_items, shuffle, num_threads, seed, epoch,
+                   u_velocity=None, i_velocity=None, momentum=0.9,
+                   u_1st_mom=None, i_1st_mom=None, u_2nd_mom=None,
+                   i_2nd_mom=None, rho1=0.9, rho2=0.999, sampler="uniform",
+                   max_trials=10, batch_size=256):
+    # Same interface as cython `bpr_update`, num_threads is unused.
+    # Pairs of a mini-batch are computed at once and gradients are
+    # scattered back with np.add.at, so a row appearing several times
+    # in a batch gets the sum of its gradients.
+    if train_data.has_sampled:
+        user_indices = train_data.user_indices_orig
+        item_indices = train_data.item_indices_orig
+    else:
+        user_indices = train_data.user_indices
+        item_indices = train_data.item_indices
+    if not reg:
+        reg = 0.0
+    if sampler not in ("uniform", "warp"):
+        raise ValueError("sampler must either be 'uniform' or 'warp'")
+    if optimizer == "sgd":
+        user_state = item_state = None
+    elif optimizer == "momentum":
+        user_state, item_state = (u_velocity,), (i_velocity,)
+    elif optimizer == "adam":
+        user_state = (u_1st_mom, u_2nd_mom)
+        item_state = (i_1st_mom, i_2nd_mom)
+    else:
+        raise ValueError("optimizer must be one of these: "
+                         "('sgd', 'momentum', 'adam')")
+
+    if shuffle:
+        user_indices, item_indices = shuffle_data(
+            len(user_indices), user_indices, item_indices)
+    user_indices = user_indices.astype(np.int64)
+    consumed = ConsumedPairs.from_sparse(train_data.sparse_interaction)
+    rng = np.random.default_rng([seed, epoch])
+    embed_size = user_embed.shape[1] - 1
+    params = dict(lr=lr, epoch=epoch, momentum=momentum,
+                  rho1=rho1, rho2=rho2)
+
+    for k in range(0, len(user_indices), batch_size):
+        users = user_indices[k: k + batch_size]
+        items_pos = item_indices[k: k + batch_size]
+        if sampler == "warp":
+            items_neg, weight, found = _warp_negatives(
+                consumed, user_embed, item_embed, users, items_pos,
+                n_items, max_trials, rng)
+            users, items_pos = users[found], items_pos[found]
+            items_neg, weight = items_neg[found], weight[found, None]
+        else:
+            items_neg = consumed.sample_negatives(users, rng)
+            weight = 1.0
+
+        user_vec = user_embed[users]
+        item_pos_vec = item_embed[items_pos]
+        item_neg_vec = item_embed[items_neg]
+        item_diff = np.sum(user_vec * (item_pos_vec - item_neg_vec), axis=1)
+        # d log(sigmoid(x)) / dx = sigmoid(-x), in a numerically stable form
+        log_sigmoid_grad = weight * np.exp(
+            -np.logaddexp(0, item_diff))[:, None]
+
+        user_grad = (log_sigmoid_grad * (item_pos_vec - item_neg_vec)
+                     - reg * user_vec)
+        user_grad[:, embed_size] = 0.0   # user bias column is fixed to 1
+        item_pos_grad = log_sigmoid_grad * user_vec - reg * item_pos_vec
+        item_neg_grad = -log_sigmoid_grad * user_vec - reg * item_neg_vec
+
+        _scatter_update(user_embed, users, user_grad, optimizer,
+                        user_state, **params)
+        _scatter_update(item_embed,
+                        np.concatenate([items_pos, items_neg]),
+                        np.concatenate([item_pos_grad, item_neg_grad]),
+                        optimizer, item_state, **params)
+
+
+def _warp_negatives(consumed, user_embed, item_embed, users, items_pos,
+                    n_items, max_trials, rng):
+    # same rule as cython sampler, all max_trials uniform draws of a row are
+    # made at once and the first unconsumed violating one is taken, so
+    # consumed draws also count as trials
+    n = len(users)
+    candidates = rng.integers(0, n_items, (n, max_trials))
+    consumed_draws = consumed.contains(
+        np.repeat(users, max_trials), candidates.ravel()).reshape(n, max_trials)
+    pos_score = np.sum(user_embed[users] * item_embed[items_pos], axis=1)
+    neg_score = np.einsum("ij,ikj->ik", user_embed[users],
+                          item_embed[candidates])
+    violated = (neg_score > pos_score[:, None] - 1.0) & ~consumed_draws
+    found = violated.any(axis=1)
+    trials = violated.argmax(axis=1) + 1
+    items_neg = candidates[np.arange(n), trials - 1]
+    weight = np.log(np.maximum(1, (n_items - 1) // trials)).astype(np.float32)
+    return items_neg, weight, found
+
+
+def _scatter_update(embed, rows, grads, optimizer, state, lr, epoch,
+                    momentum, rho1, rho2):
+    if optimizer == "sgd":
+        np.add.at(embed, rows, lr * grads)
+        return
+
+    # momentum and adam states are updated once per distinct row
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    grad_sum = np.zeros((len(unique_rows), embed.shape[1]), dtype=embed.dtype)
+    np.add.at(grad_sum, inverse, grads)
+    if optimizer == "momentum":
+        velocity = state[0]
+        velocity[unique_rows] = (momentum * velocity[unique_rows]
+                                 + lr * grad_sum)
+        embed[unique_rows] += velocity[unique_rows]
+    else:
+        first_mom, second_mom = state
+        first_mom[unique_rows] = (rho1 * first_mom[unique_rows]
+                                  + (1.0 - rho1) * grad_sum)
+        second_mom[unique_rows] = (rho2 * second_mom[unique_rows]
+                                   + (1.0 - rho2) * grad_sum ** 2)
+        unbias_first = first_mom[unique_rows] / (1.0 - rho1 ** epoch)
+        unbias_second = second_mom[unique_rows] / (1.0 - rho2 ** epoch)
+        embed[unique_rows] += lr * unbias_first / (
+            np.sqrt(unbias_second) + 1e-8)
@@ -1,12 +1,24 @@
 import random
 import time
 from operator import itemgetter
-from itertools import islice, takewhile
 from collections import defaultdict
 import numpy as np
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 from .base import Base
-from ..utils.similarities import cosine_sim, pearson_sim, jaccard_sim
+from ..utils.similarities import (
+    cosine_sim,
+    pearson_sim,
+    jaccard_sim,
+    save_sim_matrix,
+    load_sim_matrix,
+    compute_sim_stats,
+    merge_interaction,
+    sim_rows,
+    replace_sim_rows,
+    prune_top_k,
+    minhash_jaccard_sim,
+    knn_scores
+)
 from ..utils.misc import time_block, colorize
 from ..evaluate.evaluate import EvalMixin
 
@@ -32,15 +44,42 @@ class ItemCF(Base, EvalMixin):
         self.item_interaction = None
         # sparse similarity matrix
         self.sim_matrix = None
+        self.min_common = None
+        self.top_k = None
+        # per-item norm and mean cached for partial_fit
+        self._x_norm = None
+        self._x_mean = None
         self.print_count = 0
         self._caution_sim_type()
 
     def fit(self, train_data, block_size=None, num_threads=1, min_common=1,
-            mode="invert", verbose=1, eval_data=None, metrics=None):
+            mode="invert", top_k=None, approximate=False, num_perm=128,
+            memory_limit=None, spill_dir=None, verbose=1, eval_data=None,
+            metrics=None):
+        """Compute the item similarity matrix.
+
+        `mode="invert"` accumulates co-occurrences from the user side in
+        blocks of `block_size` items with `num_threads` threads, while
+        `mode="forward"` compares every pair of items directly. `top_k`
+        keeps only the `top_k` most similar neighbors of every item, which
+        is only supported in invert mode. `approximate=True` estimates
+        jaccard similarity with `num_perm` MinHash permutations instead.
+
+        With `memory_limit` (bytes or like "4GB") and no `block_size`,
+        block size and threads are chosen to fit in the limit. With
+        `spill_dir`, rows are computed shard by shard and written to
+        `spill_dir`, and `sim_matrix` is the memory-mapped result. Shards
+        have `block_size` items if given, otherwise they are sized to fit
+        in `memory_limit` (2GB by default). Spilling is only supported in
+        invert mode and without `approximate`.
+        """
         self.show_start_time()
         self.user_interaction = train_data.sparse_interaction
         self.item_interaction = self.user_interaction.T.tocsr()
         self.user_consumed = train_data.user_consumed
+        self.min_common = min_common
+        self.top_k = top_k
+        self._x_norm = self._x_mean = None
 
         with time_block("sim_matrix", verbose=1):
             if self.sim_type == "cosine":
@@ -53,9 +92,21 @@ class ItemCF(Base, EvalMixin):
                 raise ValueError("sim_type must be one of "
                                  "('cosine', 'pearson', 'jaccard')")
 
-            self.sim_matrix = sim_func(
-                self.item_interaction, self.user_interaction, self.n_items,
-                self.n_users, block_size, num_threads, min_common, mode)
+            if approximate:
+                if self.sim_type != "jaccard":
+                    raise ValueError("approximate similarity is only "
+                                     "available for 'jaccard'")
+                if spill_dir is not None:
+                    raise ValueError("spill_dir is not supported with "
+                                     "approximate similarity")
+                self.sim_matrix = minhash_jaccard_sim(
+                    self.item_interaction, self.n_items, num_perm,
+                    min_common=min_common, top_k=top_k)
+            else:
+                self.sim_matrix = sim_func(
+                    self.item_interaction, self.user_interaction, self.n_items,
+                    self.n_users, block_size, num_threads, min_common, mode,
+                    top_k, memory_limit, spill_dir)
 
         assert self.sim_matrix.has_sorted_indices
         if issparse(self.sim_matrix):
@@ -79,53 +130,25 @@ class ItemCF(Base, EvalMixin):
         unknown_num, unknown_index, user, item = self._check_unknown(
             user, item)
 
-        preds = []
-        sim_matrix = self.sim_matrix
-        interaction = self.user_interaction
-        for u, i in zip(user, item):
-            item_slice = slice(sim_matrix.indptr[i], sim_matrix.indptr[i+1])
-            sim_items = sim_matrix.indices[item_slice]
-            sim_values = sim_matrix.data[item_slice]
-
-            user_slice = slice(interaction.indptr[u], interaction.indptr[u+1])
-            user_interacted_i = interaction.indices[user_slice]
-            user_interacted_values = interaction.data[user_slice]
-            common_items, indices_in_i, indices_in_u = np.intersect1d(
-                sim_items, user_interacted_i,
-                assume_unique=True, return_indices=True)
-
-            common_sims = sim_values[indices_in_i]
-            common_labels = user_interacted_values[indices_in_u]
-            if common_items.size == 0 or np.all(common_sims <= 0.0):
-                self.print_count += 1
-                no_str = (f"No common interaction or similar neighbor "
-                          f"for user {u} and item {i}, "
-                          f"proceed with default prediction")
-                if self.print_count < 13:
-                    print(f"{colorize(no_str, 'red')}")
-                preds.append(self.default_prediction)
-            else:
-                k_neighbor_labels, k_neighbor_sims = zip(*islice(
-                    takewhile(lambda x: x[1] > 0,
-                              sorted(zip(common_labels, common_sims),
-                                     key=itemgetter(1),
-                                     reverse=True)
-                              ),
-                    self.k))
-
-                if self.task == "rating":
-                    sims_distribution = (
-                            k_neighbor_sims / np.sum(k_neighbor_sims)
-                    )
-                    weighted_pred = np.average(
-                        k_neighbor_labels, weights=sims_distribution
-                    )
-                    preds.append(
-                        np.clip(weighted_pred, self.lower_bound,
-                                self.upper_bound)
-                    )
-                elif self.task == "ranking":
-                    preds.append(np.mean(k_neighbor_sims))
+        sim_sum, label_sum, count = knn_scores(
+            self.sim_matrix, self.user_interaction, item, user, self.k)
+        no_neighbor = count == 0
+        if self.task == "rating":
+            preds = np.divide(label_sum, sim_sum, out=np.zeros_like(sim_sum),
+                              where=~no_neighbor)
+            preds = np.clip(preds, self.lower_bound, self.upper_bound)
+        else:
+            preds = np.divide(sim_sum, count, out=np.zeros_like(sim_sum),
+                              where=~no_neighbor)
+        preds[no_neighbor] = self.default_prediction
+
+        if np.any(no_neighbor):
+            self.print_count += 1
+            no_str = (f"No common interaction or similar neighbor "
+                      f"for {np.sum(no_neighbor)} pair(s), "
+                      f"proceed with default prediction")
+            if self.print_count < 13:
+                print(f"{colorize(no_str, 'red')}")
 
         if unknown_num > 0:
             preds[unknown_index] = self.default_prediction
@@ -176,6 +199,67 @@ class ItemCF(Base, EvalMixin):
         else:
             return rank_items[:n_rec]
 
+    def partial_fit(self, new_data, verbose=1):
+        """Incrementally update the model with new interactions.
+
+        Only similarity rows (and the symmetric columns) of the items
+        touched by `new_data` are recomputed, with the same `min_common`
+        and `top_k` used in `fit`. Unknown users or items still require a
+        full `fit`. With `top_k`, rows outside the delta can't recover
+        neighbors pruned earlier, so the result is an approximation.
+        """
+        if self.sim_matrix is None:
+            raise RuntimeError("call fit before partial_fit")
+        user_indices = np.asarray(new_data.user_indices)
+        item_indices = np.asarray(new_data.item_indices)
+        if (np.any(user_indices >= self.n_users)
+                or np.any(item_indices >= self.n_items)):
+            raise ValueError("new users or items found in new_data, "
+                             "use fit instead")
+
+        with time_block("partial_fit", verbose=verbose):
+            new_interaction = csr_matrix(
+                (new_data.labels, (user_indices, item_indices)),
+                shape=(self.n_users, self.n_items), dtype=np.float32)
+            self.user_interaction = merge_interaction(
+                self.user_interaction, new_interaction)
+            self.item_interaction = self.user_interaction.T.tocsr()
+            for u, i in zip(user_indices, item_indices):
+                if i not in self.user_consumed[u]:
+                    self.user_consumed[u].append(int(i))
+
+            affected = np.unique(new_data.item_indices)
+            x_interaction = self.item_interaction
+            if self._x_norm is None:
+                self._x_norm, self._x_mean = compute_sim_stats(
+                    x_interaction, self.sim_type)
+            else:
+                x_norm, x_mean = compute_sim_stats(
+                    x_interaction[affected], self.sim_type)
+                self._x_norm[affected] = x_norm
+                if x_mean is not None:
+                    self._x_mean[affected] = x_mean
+
+            new_rows = sim_rows(x_interaction, affected, self.sim_type,
+                                self._x_norm, self._x_mean, self.min_common)
+            self.sim_matrix = replace_sim_rows(self.sim_matrix, affected,
+                                               new_rows)
+            if self.top_k:
+                self.sim_matrix = prune_top_k(self.sim_matrix, self.top_k)
+
+    def save_sim_matrix(self, path):
+        """Write `sim_matrix` to `path` as raw csr arrays, see `load_sim_matrix`."""
+        save_sim_matrix(path, self.sim_matrix)
+
+    def load_sim_matrix(self, path, mmap_mode="r"):
+        """Memory-map a similarity matrix written by `save_sim_matrix`.
+
+        With the default read-only mode, every process loading the same
+        path shares one page-cached copy instead of recomputing or
+        unpickling its own.
+        """
+        self.sim_matrix = load_sim_matrix(path, mmap_mode)
+
     def _caution_sim_type(self):
         if self.task == "ranking" and self.sim_type == "pearson":
             caution_str = (f"Warning: {self.sim_type} is not suitable "
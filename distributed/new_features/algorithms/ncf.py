@@ -21,7 +21,7 @@ from ..utils.tf_ops import (
     dense_nn,
     lr_decay_config
 )
-from ..utils.sampling import NegativeSampling
+from ..utils.sampling import NegativeSamplingPure, PrefetchSampling
 from ..data.data_generator import DataGenPure
 from ..utils.misc import colorize
 
@@ -137,11 +137,13 @@ class NCF(Base, TfMixin, EvalMixin):
 
         if self.task == "ranking" and self.batch_sampling:
             self._check_has_sampled(train_data, verbose)
-            data_generator = NegativeSampling(train_data,
-                                              self.data_info,
-                                              self.num_neg,
-                                              self.batch_size,
-                                              batch_sampling=True)
+            data_generator = PrefetchSampling(
+                NegativeSamplingPure(train_data,
+                                     self.data_info,
+                                     self.num_neg,
+                                     self.batch_size,
+                                     batch_sampling=True),
+                seed=self.seed)
 
         else:
             data_generator = DataGenPure(train_data, self.batch_size)
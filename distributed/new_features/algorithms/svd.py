@@ -17,7 +17,7 @@ from tensorflow.python.keras.initializers import (
 from .base import Base, TfMixin
 from ..evaluate.evaluate import EvalMixin
 from ..utils.tf_ops import reg_config
-from ..utils.sampling import NegativeSampling
+from ..utils.sampling import NegativeSamplingPure, PrefetchSampling
 from ..data.data_generator import DataGenPure
 
 
@@ -51,6 +51,8 @@ class SVD(Base, TfMixin, EvalMixin):
         self.bi = None
         self.pu = None
         self.qi = None
+        self.quantized_user = None
+        self.quantized_item = None
 
         self._build_model()
         self._build_train_ops()
@@ -109,17 +111,21 @@ class SVD(Base, TfMixin, EvalMixin):
         self.sess.run(tf.global_variables_initializer())
 
     def fit(self, train_data, verbose=1, shuffle=True,
-            eval_data=None, metrics=None):
+            eval_data=None, metrics=None, warm_start_from=None):
         self.show_start_time()
         self.user_consumed = train_data.user_consumed
+        if warm_start_from is not None:
+            self._warm_start(warm_start_from)
 
         if self.task == "ranking" and self.batch_sampling:
             self._check_has_sampled(train_data, verbose)
-            data_generator = NegativeSampling(train_data,
-                                              self.data_info,
-                                              self.num_neg,
-                                              self.batch_size,
-                                              batch_sampling=True)
+            data_generator = PrefetchSampling(
+                NegativeSamplingPure(train_data,
+                                     self.data_info,
+                                     self.num_neg,
+                                     self.batch_size,
+                                     batch_sampling=True),
+                seed=self.seed)
 
         else:
             data_generator = DataGenPure(train_data, self.batch_size)
@@ -127,6 +133,19 @@ class SVD(Base, TfMixin, EvalMixin):
         self.train_pure(data_generator, verbose, shuffle, eval_data, metrics)
         self._set_latent_factors()
 
+    def _warm_start(self, previous_model):
+        # reuse factors of known users and items, new ones keep initial values
+        (user_new, user_old), (item_new, item_old) = (
+            self._warm_start_indices(previous_model))
+        for var, previous, new, old in (
+                (self.bu_var, previous_model.bu, user_new, user_old),
+                (self.bi_var, previous_model.bi, item_new, item_old),
+                (self.pu_var, previous_model.pu, user_new, user_old),
+                (self.qi_var, previous_model.qi, item_new, item_old)):
+            value = self.sess.run(var)
+            value[new] = previous[old]
+            var.load(value, self.sess)
+
     def predict(self, user, item):
         user = np.asarray(
             [user]) if isinstance(user, int) else np.asarray(user)
@@ -150,14 +169,17 @@ class SVD(Base, TfMixin, EvalMixin):
 
         return preds[0] if len(user) == 1 else preds
 
-    def recommend_user(self, user, n_rec, **kwargs):
+    def recommend_user(self, user, n_rec, quantized=False, **kwargs):
         user = self._check_unknown_user(user)
         if not user:
             return   # popular ?
 
         consumed = self.user_consumed[user]
         count = n_rec + len(consumed)
-        recos = self.bu[user] + self.bi + self.pu[user] @ self.qi.T
+        if quantized:
+            recos = self._quantized_scores(user)
+        else:
+            recos = self.bu[user] + self.bi + self.pu[user] @ self.qi.T
 
         if self.task == "rating":
             recos += self.global_mean
@@ -171,6 +193,15 @@ class SVD(Base, TfMixin, EvalMixin):
             )
         )
 
+    def _serving_factors(self):
+        # biases folded into the factors, [pu, bu, 1] @ [qi, 1, bi]
+        user_factors = np.hstack([self.pu, self.bu[:, None],
+                                  np.ones([self.n_users, 1], np.float32)])
+        item_factors = np.hstack([self.qi,
+                                  np.ones([self.n_items, 1], np.float32),
+                                  self.bi[:, None]])
+        return user_factors, item_factors
+
     def _set_latent_factors(self):
         self.bu, self.bi, self.pu, self.qi = self.sess.run(
             [self.bu_var, self.bi_var, self.pu_var, self.qi_var]
@@ -17,7 +17,7 @@ from tensorflow.python.keras.initializers import (
 from .base import Base, TfMixin
 from ..evaluate.evaluate import EvalMixin
 from ..utils.tf_ops import reg_config
-from ..utils.sampling import NegativeSampling
+from ..utils.sampling import NegativeSamplingPure, PrefetchSampling
 from ..data.data_generator import DataGenPure
 from ..utils.tf_ops import sparse_tensor_interaction
 from ..utils.misc import colorize
@@ -77,13 +77,14 @@ class SVDpp(Base, TfMixin, EvalMixin):
                                           0.0, 0.03),
                                       regularizer=self.reg)
 
-        yj_var = tf.get_variable(name="yj_var",
-                                 shape=[self.n_items, self.embed_size],
-                                 initializer=tf_truncated_normal(0.0, 0.03),
-                                 regularizer=self.reg)
+        self.yj_var = tf.get_variable(name="yj_var",
+                                      shape=[self.n_items, self.embed_size],
+                                      initializer=tf_truncated_normal(
+                                          0.0, 0.03),
+                                      regularizer=self.reg)
 
         uj = tf.nn.safe_embedding_lookup_sparse(
-            yj_var, sparse_implicit_interaction, sparse_weights=None,
+            self.yj_var, sparse_implicit_interaction, sparse_weights=None,
             combiner="sqrtn", default_id=None
         )   # unknown user will return 0-vector
         self.puj_var = self.pu_var + uj
@@ -118,7 +119,8 @@ class SVDpp(Base, TfMixin, EvalMixin):
         self.sess.run(tf.global_variables_initializer())
 
     def fit(self, train_data, verbose=1, shuffle=True, sample_rate=None,
-            recent_num=None, eval_data=None, metrics=None):
+            recent_num=None, eval_data=None, metrics=None,
+            warm_start_from=None):
         self.show_start_time()
         self.user_consumed = train_data.user_consumed
         sparse_implicit_interaction = sparse_tensor_interaction(
@@ -126,20 +128,38 @@ class SVDpp(Base, TfMixin, EvalMixin):
 
         self._build_model(sparse_implicit_interaction)
         self._build_train_ops()
+        if warm_start_from is not None:
+            self._warm_start(warm_start_from)
 
         if self.task == "ranking" and self.batch_sampling:
             self._check_has_sampled(train_data, verbose)
-            data_generator = NegativeSampling(train_data,
-                                              self.data_info,
-                                              self.num_neg,
-                                              self.batch_size,
-                                              batch_sampling=True)
+            data_generator = PrefetchSampling(
+                NegativeSamplingPure(train_data,
+                                     self.data_info,
+                                     self.num_neg,
+                                     self.batch_size,
+                                     batch_sampling=True),
+                seed=self.seed)
         else:
             data_generator = DataGenPure(train_data, self.batch_size)
 
         self.train_pure(data_generator, verbose, shuffle, eval_data, metrics)
         self._set_latent_factors()
 
+    def _warm_start(self, previous_model):
+        # reuse factors of known users and items, new ones keep initial values
+        (user_new, user_old), (item_new, item_old) = (
+            self._warm_start_indices(previous_model))
+        for var, previous, new, old in (
+                (self.bu_var, previous_model.bu, user_new, user_old),
+                (self.bi_var, previous_model.bi, item_new, item_old),
+                (self.pu_var, previous_model.pu, user_new, user_old),
+                (self.qi_var, previous_model.qi, item_new, item_old),
+                (self.yj_var, previous_model.yj, item_new, item_old)):
+            value = self.sess.run(var)
+            value[new] = previous[old]
+            var.load(value, self.sess)
+
     def predict(self, user, item):
         user = np.asarray(
             [user]) if isinstance(user, int) else np.asarray(user)
@@ -185,8 +205,10 @@ class SVDpp(Base, TfMixin, EvalMixin):
         )
 
     def _set_latent_factors(self):
-        self.bu, self.bi, self.pu, self.qi, self.puj = self.sess.run(
-            [self.bu_var, self.bi_var, self.pu_var, self.qi_var, self.puj_var]
+        (self.bu, self.bi, self.pu, self.qi, self.yj,
+         self.puj) = self.sess.run(
+            [self.bu_var, self.bi_var, self.pu_var, self.qi_var, self.yj_var,
+             self.puj_var]
         )
 
 
@@ -1,12 +1,25 @@
 import random
 import time
 from operator import itemgetter
-from itertools import islice, takewhile
+from itertools import islice
 from collections import defaultdict
 import numpy as np
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix
 from .base import Base
-from ..utils.similarities import cosine_sim, pearson_sim, jaccard_sim
+from ..utils.similarities import (
+    cosine_sim,
+    pearson_sim,
+    jaccard_sim,
+    save_sim_matrix,
+    load_sim_matrix,
+    compute_sim_stats,
+    merge_interaction,
+    sim_rows,
+    replace_sim_rows,
+    prune_top_k,
+    minhash_jaccard_sim,
+    knn_scores
+)
 from ..utils.misc import time_block, colorize
 from ..evaluate.evaluate import EvalMixin
 
@@ -32,15 +45,42 @@ class UserCF(Base, EvalMixin):
         self.item_interaction = None
         # sparse similarity matrix
         self.sim_matrix = None
+        self.min_common = None
+        self.top_k = None
+        # per-user norm and mean cached for partial_fit
+        self._x_norm = None
+        self._x_mean = None
         self.print_count = 0
         self._caution_sim_type()
 
     def fit(self, train_data, block_size=None, num_threads=1, min_common=1,
-            mode="invert", verbose=1, eval_data=None, metrics=None):
+            mode="invert", top_k=None, approximate=False, num_perm=128,
+            memory_limit=None, spill_dir=None, verbose=1, eval_data=None,
+            metrics=None):
+        """Compute the user similarity matrix.
+
+        `mode="invert"` accumulates co-occurrences from the item side in
+        blocks of `block_size` users with `num_threads` threads, while
+        `mode="forward"` compares every pair of users directly. `top_k`
+        keeps only the `top_k` most similar neighbors of every user, which
+        is only supported in invert mode. `approximate=True` estimates
+        jaccard similarity with `num_perm` MinHash permutations instead.
+
+        With `memory_limit` (bytes or like "4GB") and no `block_size`,
+        block size and threads are chosen to fit in the limit. With
+        `spill_dir`, rows are computed shard by shard and written to
+        `spill_dir`, and `sim_matrix` is the memory-mapped result. Shards
+        have `block_size` users if given, otherwise they are sized to fit
+        in `memory_limit` (2GB by default). Spilling is only supported in
+        invert mode and without `approximate`.
+        """
         self.show_start_time()
         self.user_interaction = train_data.sparse_interaction
         self.item_interaction = self.user_interaction.T.tocsr()
         self.user_consumed = train_data.user_consumed
+        self.min_common = min_common
+        self.top_k = top_k
+        self._x_norm = self._x_mean = None
 
         with time_block("sim_matrix", verbose=1):
             if self.sim_type == "cosine":
@@ -53,9 +93,21 @@ class UserCF(Base, EvalMixin):
                 raise ValueError("sim_type must be one of "
                                  "('cosine', 'pearson', 'jaccard')")
 
-            self.sim_matrix = sim_func(
-                self.user_interaction, self.item_interaction, self.n_users,
-                self.n_items, block_size, num_threads, min_common, mode)
+            if approximate:
+                if self.sim_type != "jaccard":
+                    raise ValueError("approximate similarity is only "
+                                     "available for 'jaccard'")
+                if spill_dir is not None:
+                    raise ValueError("spill_dir is not supported with "
+                                     "approximate similarity")
+                self.sim_matrix = minhash_jaccard_sim(
+                    self.user_interaction, self.n_users, num_perm,
+                    min_common=min_common, top_k=top_k)
+            else:
+                self.sim_matrix = sim_func(
+                    self.user_interaction, self.item_interaction, self.n_users,
+                    self.n_items, block_size, num_threads, min_common, mode,
+                    top_k, memory_limit, spill_dir)
 
         assert self.sim_matrix.has_sorted_indices
         if issparse(self.sim_matrix):
@@ -79,53 +131,25 @@ class UserCF(Base, EvalMixin):
         unknown_num, unknown_index, user, item = self._check_unknown(
             user, item)
 
-        preds = []
-        sim_matrix = self.sim_matrix
-        interaction = self.item_interaction
-        for u, i in zip(user, item):
-            user_slice = slice(sim_matrix.indptr[u], sim_matrix.indptr[u+1])
-            sim_users = sim_matrix.indices[user_slice]
-            sim_values = sim_matrix.data[user_slice]
-
-            item_slice = slice(interaction.indptr[i], interaction.indptr[i+1])
-            item_interacted_u = interaction.indices[item_slice]
-            item_interacted_values = interaction.data[item_slice]
-            common_users, indices_in_u, indices_in_i = np.intersect1d(
-                sim_users, item_interacted_u,
-                assume_unique=True, return_indices=True)
-
-            common_sims = sim_values[indices_in_u]
-            common_labels = item_interacted_values[indices_in_i]
-            if common_users.size == 0 or np.all(common_sims <= 0.0):
-                self.print_count += 1
-                no_str = (f"No common interaction or similar neighbor "
-                          f"for user {u} and item {i}, "
-                          f"proceed with default prediction")
-                if self.print_count < 13:
-                    print(f"{colorize(no_str, 'red')}")
-                preds.append(self.default_prediction)
-            else:
-                k_neighbor_labels, k_neighbor_sims = zip(*islice(
-                    takewhile(lambda x: x[1] > 0,
-                              sorted(zip(common_labels, common_sims),
-                                     key=itemgetter(1),
-                                     reverse=True)
-                              ),
-                    self.k))
-
-                if self.task == "rating":
-                    sims_distribution = (
-                            k_neighbor_sims / np.sum(k_neighbor_sims)
-                    )
-                    weighted_pred = np.average(
-                        k_neighbor_labels, weights=sims_distribution
-                    )
-                    preds.append(
-                        np.clip(weighted_pred, self.lower_bound,
-                                self.upper_bound)
-                    )
-                elif self.task == "ranking":
-                    preds.append(np.mean(k_neighbor_sims))
+        sim_sum, label_sum, count = knn_scores(
+            self.sim_matrix, self.item_interaction, user, item, self.k)
+        no_neighbor = count == 0
+        if self.task == "rating":
+            preds = np.divide(label_sum, sim_sum, out=np.zeros_like(sim_sum),
+                              where=~no_neighbor)
+            preds = np.clip(preds, self.lower_bound, self.upper_bound)
+        else:
+            preds = np.divide(sim_sum, count, out=np.zeros_like(sim_sum),
+                              where=~no_neighbor)
+        preds[no_neighbor] = self.default_prediction
+
+        if np.any(no_neighbor):
+            self.print_count += 1
+            no_str = (f"No common interaction or similar neighbor "
+                      f"for {np.sum(no_neighbor)} pair(s), "
+                      f"proceed with default prediction")
+            if self.print_count < 13:
+                print(f"{colorize(no_str, 'red')}")
 
         if unknown_num > 0:
             preds[unknown_index] = self.default_prediction
@@ -182,6 +206,124 @@ class UserCF(Base, EvalMixin):
         else:
             return rank_items[:n_rec]
 
+    def recommend_users(self, users, n_rec, batch_size=1024):
+        """Recommend for a batch of users with sparse matrix products.
+
+        Scores are the same as `recommend_user`, i.e. the sim-weighted mean
+        label among the k nearest neighbors, but a batch of users is scored
+        at once: top-k sim rows times `user_interaction`, with consumed
+        items masked out through the interaction structure. Returns a dict
+        of user -> [(item, score)], users without positive neighbor get -1.
+        """
+        users = np.unique(np.asarray(users))
+        unknown = users[(users < 0) | (users >= self.n_users)]
+        if len(unknown) > 0:
+            unknown_str = (f"detect unknown user(s) {list(unknown)}, "
+                           f"will be ignored")
+            print(f"{colorize(unknown_str, 'red')}")
+            users = users[(users >= 0) & (users < self.n_users)]
+
+        binary_interaction = self.user_interaction.astype(bool).astype(
+            np.float32)
+        recommendations = dict()
+        for start in range(0, len(users), batch_size):
+            batch_users = users[start: start + batch_size]
+            neighbor_sims = prune_top_k(self.sim_matrix[batch_users], self.k)
+            numerator = (neighbor_sims @ self.user_interaction).tocsr()
+            denominator = (neighbor_sims @ binary_interaction).tocsr()
+            # sims may cancel out in the products above, so candidate items
+            # come from absolute sims, then consumed items are masked out
+            candidates = (abs(neighbor_sims) @ binary_interaction).tocsr()
+            candidates = candidates - candidates.multiply(
+                binary_interaction[batch_users])
+            candidates.sort_indices()
+            rows, cols = candidates.nonzero()
+            num = np.asarray(numerator[rows, cols]).ravel()
+            den = np.asarray(denominator[rows, cols]).ravel()
+            scores = candidates.astype(np.float32)
+            scores.data = np.divide(num, den, out=np.zeros_like(num),
+                                    where=den != 0).astype(np.float32)
+            has_neighbor = neighbor_sims.max(axis=1).toarray().ravel() > 0
+
+            for n, user in enumerate(batch_users):
+                if not has_neighbor[n]:
+                    recommendations[user] = -1
+                    continue
+                row_slice = slice(scores.indptr[n], scores.indptr[n+1])
+                row_items = scores.indices[row_slice]
+                row_scores = scores.data[row_slice]
+                if len(row_scores) > n_rec:
+                    top = np.argpartition(-row_scores, n_rec - 1)[:n_rec]
+                else:
+                    top = np.arange(len(row_scores))
+                top = top[np.argsort(-row_scores[top], kind="stable")]
+                recommendations[user] = [
+                    (i, round(v, 4)) for i, v in zip(
+                        row_items[top].tolist(), row_scores[top].tolist())
+                ]
+        return recommendations
+
+    def partial_fit(self, new_data, verbose=1):
+        """Incrementally update the model with new interactions.
+
+        Only similarity rows (and the symmetric columns) of the users
+        touched by `new_data` are recomputed, with the same `min_common`
+        and `top_k` used in `fit`. Unknown users or items still require a
+        full `fit`. With `top_k`, rows outside the delta can't recover
+        neighbors pruned earlier, so the result is an approximation.
+        """
+        if self.sim_matrix is None:
+            raise RuntimeError("call fit before partial_fit")
+        user_indices = np.asarray(new_data.user_indices)
+        item_indices = np.asarray(new_data.item_indices)
+        if (np.any(user_indices >= self.n_users)
+                or np.any(item_indices >= self.n_items)):
+            raise ValueError("new users or items found in new_data, "
+                             "use fit instead")
+
+        with time_block("partial_fit", verbose=verbose):
+            new_interaction = csr_matrix(
+                (new_data.labels, (user_indices, item_indices)),
+                shape=(self.n_users, self.n_items), dtype=np.float32)
+            self.user_interaction = merge_interaction(
+                self.user_interaction, new_interaction)
+            self.item_interaction = self.user_interaction.T.tocsr()
+            for u, i in zip(user_indices, item_indices):
+                if i not in self.user_consumed[u]:
+                    self.user_consumed[u].append(int(i))
+
+            affected = np.unique(new_data.user_indices)
+            x_interaction = self.user_interaction
+            if self._x_norm is None:
+                self._x_norm, self._x_mean = compute_sim_stats(
+                    x_interaction, self.sim_type)
+            else:
+                x_norm, x_mean = compute_sim_stats(
+                    x_interaction[affected], self.sim_type)
+                self._x_norm[affected] = x_norm
+                if x_mean is not None:
+                    self._x_mean[affected] = x_mean
+
+            new_rows = sim_rows(x_interaction, affected, self.sim_type,
+                                self._x_norm, self._x_mean, self.min_common)
+            self.sim_matrix = replace_sim_rows(self.sim_matrix, affected,
+                                               new_rows)
+            if self.top_k:
+                self.sim_matrix = prune_top_k(self.sim_matrix, self.top_k)
+
+    def save_sim_matrix(self, path):
+        """Write `sim_matrix` to `path` as raw csr arrays, see `load_sim_matrix`."""
+        save_sim_matrix(path, self.sim_matrix)
+
+    def load_sim_matrix(self, path, mmap_mode="r"):
+        """Memory-map a similarity matrix written by `save_sim_matrix`.
+
+        With the default read-only mode, every process loading the same
+        path shares one page-cached copy instead of recomputing or
+        unpickling its own.
+        """
+        self.sim_matrix = load_sim_matrix(path, mmap_mode)
+
     def _caution_sim_type(self):
         caution_str = (f"Warning: {self.sim_type} is not suitable "
                        f"for implicit data")
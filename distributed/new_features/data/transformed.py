@@ -41,7 +41,7 @@ class TransformedSet(object):
         return user_consumed, item_consumed
 
     def build_negative_samples(self, data_info, sample_mode=None, num_neg=1,
-                               item_gen_mode="random", seed=42):
+                               item_gen_mode="random", seed=42, pop_alpha=1.0):
         if not sample_mode or sample_mode not in ["pure", "feat"]:
             raise ValueError("sample_mode must either be 'pure' or 'feat'.")
         self.has_sampled = True
@@ -50,7 +50,7 @@ class TransformedSet(object):
             self.user_indices_orig = self._user_indices
             self.item_indices_orig = self._item_indices
             self.build_negative_samples_pure(data_info, num_neg,
-                                             item_gen_mode, seed)
+                                             item_gen_mode, seed, pop_alpha)
         elif sample_mode == "feat":
             self.user_indices_orig = self._user_indices
             self.item_indices_orig = self._item_indices
@@ -58,19 +58,22 @@ class TransformedSet(object):
             self.dense_indices_orig = self._dense_indices
             self.dense_values_orig = self._dense_values
             self.build_negative_samples_feat(data_info, num_neg,
-                                             item_gen_mode, seed)
+                                             item_gen_mode, seed, pop_alpha)
 
     def build_negative_samples_pure(self, data_info, num_neg=1,
-                                    item_gen_mode="random", seed=42):
+                                    item_gen_mode="random", seed=42,
+                                    pop_alpha=1.0):
 
         neg = NegativeSamplingPure(
             self, data_info, num_neg, batch_sampling=False)
 
         (self._user_indices, self._item_indices,
-            self._labels) = neg.generate_all(seed, item_gen_mode=item_gen_mode)
+            self._labels) = neg.generate_all(
+            seed, item_gen_mode=item_gen_mode, pop_alpha=pop_alpha)
 
     def build_negative_samples_feat(self, data_info, num_neg=1,
-                                    item_gen_mode="random", seed=42):
+                                    item_gen_mode="random", seed=42,
+                                    pop_alpha=1.0):
 
         neg = NegativeSamplingFeat(self, data_info, num_neg)
         if self.dense_values is None:
@@ -80,7 +83,8 @@ class TransformedSet(object):
 
         (self._user_indices, self._item_indices, self._sparse_indices,
          self._dense_indices, self._dense_values, self._labels
-         ) = neg_generator(seed=seed, item_gen_mode=item_gen_mode)
+         ) = neg_generator(seed=seed, item_gen_mode=item_gen_mode,
+                           pop_alpha=pop_alpha)
 
     def __len__(self):
         return len(self.labels)
@@ -67,6 +67,215 @@ cdef Py_ssize_t count_freq(
     return res_count
 
 
+# sim_type codes shared by the top-k kernels
+cdef enum:
+    COSINE = 0
+    PEARSON = 1
+    JACCARD = 2
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void heap_sift_down(float *heap_sims, int *heap_ids, 
+                                int size, int pos) nogil:
+    cdef int child, tmp_id
+    cdef float tmp_sim
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and heap_sims[child + 1] < heap_sims[child]:
+            child += 1
+        if heap_sims[pos] <= heap_sims[child]:
+            break
+        tmp_sim = heap_sims[pos]
+        tmp_id = heap_ids[pos]
+        heap_sims[pos] = heap_sims[child]
+        heap_ids[pos] = heap_ids[child]
+        heap_sims[child] = tmp_sim
+        heap_ids[child] = tmp_id
+        pos = child
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int heap_push(float *heap_sims, int *heap_ids, int size, 
+                          int capacity, float sim, int idx) nogil:
+    # bounded min-heap, the root is the weakest of the kept neighbors,
+    # returns the new heap size
+    cdef int pos, parent, tmp_id
+    cdef float tmp_sim
+    if size < capacity:
+        pos = size
+        heap_sims[pos] = sim
+        heap_ids[pos] = idx
+        while pos > 0:
+            parent = (pos - 1) / 2
+            if heap_sims[parent] <= heap_sims[pos]:
+                break
+            tmp_sim = heap_sims[pos]
+            tmp_id = heap_ids[pos]
+            heap_sims[pos] = heap_sims[parent]
+            heap_ids[pos] = heap_ids[parent]
+            heap_sims[parent] = tmp_sim
+            heap_ids[parent] = tmp_id
+            pos = parent
+        return size + 1
+    elif sim > heap_sims[0]:
+        heap_sims[0] = sim
+        heap_ids[0] = idx
+        heap_sift_down(heap_sims, heap_ids, size, 0)
+    return size
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void compute_topk(
+    const int[:] indices, 
+    const int[:] indptr, 
+    const float[:] data, 
+    const int[:] x_indptr, 
+    const int[:] x_entries, 
+    const int[:] entry_y, 
+    const float[:] x_mean, 
+    const float[:] x_norm, 
+    int sim_type, 
+    int min_support, 
+    int n_x, 
+    int n_threads, 
+    int top_k, 
+    float[:, ::1] res_data, 
+    int[:, ::1] res_indices, 
+    int[:] res_counts
+) nogil:
+    # Rows are computed one at a time. For row x1, `x_entries` lists its
+    # positions in `indices` and `entry_y` the y of each position, so all
+    # co-occurring x2 are visited and accumulated in a sparse accumulator:
+    # per-thread arrays of length n_x whose touched entries are recorded
+    # and reset after the row. Only the best `top_k` neighbors are kept
+    # in a bounded heap, so scratch memory is O(threads * n_x).
+    # For pearson `x_mean` is used to center the data, for jaccard
+    # `x_norm` holds the interaction count of every x.
+
+    cdef: 
+        Py_ssize_t p, x1, x2, e, i, j, h, t
+        Py_ssize_t scount, n_touched
+        int heap_size
+        float sprods, sqi, sqj, sim
+
+    cdef float *prods
+    cdef uint *freq
+    cdef int *touched
+    cdef float *heap_sims
+    cdef int *heap_ids
+
+    with parallel(num_threads=n_threads):
+        prods = <float *> calloc(n_x, sizeof(float))
+        freq = <uint *> calloc(n_x, sizeof(uint))
+        touched = <int *> malloc(sizeof(int) * n_x)
+        heap_sims = <float *> malloc(sizeof(float) * top_k)
+        heap_ids = <int *> malloc(sizeof(int) * top_k)
+        try:
+            for x1 in prange(n_x, schedule="dynamic"):
+                n_touched = 0
+                for e in range(x_indptr[x1], x_indptr[x1 + 1]):
+                    i = x_entries[e]
+                    p = entry_y[i]
+                    for j in range(indptr[p], indptr[p + 1]):
+                        if j == i:
+                            continue
+                        x2 = indices[j]
+                        if freq[x2] == 0:
+                            touched[n_touched] = x2
+                            n_touched = n_touched + 1
+                        if sim_type == PEARSON:
+                            prods[x2] += (
+                                (data[i] - x_mean[x1]) * 
+                                (data[j] - x_mean[x2])
+                            )
+                        elif sim_type == COSINE:
+                            prods[x2] += data[i] * data[j]
+                        freq[x2] += 1
+
+                heap_size = 0
+                for t in range(n_touched):
+                    x2 = touched[t]
+                    scount = freq[x2]
+                    if scount >= min_support:
+                        if sim_type == JACCARD:
+                            sim = scount / (x_norm[x1] + x_norm[x2] - scount)
+                        else:
+                            sprods = prods[x2]
+                            sqi = x_norm[x1]
+                            sqj = x_norm[x2]
+                            if sprods == 0.0 or sqi == 0.0 or sqj == 0.0:
+                                sim = 0.0
+                            else:
+                                sim = sprods / (sqi * sqj)
+                        heap_size = heap_push(heap_sims, heap_ids, heap_size, 
+                                              top_k, sim, x2)
+                    prods[x2] = 0.0
+                    freq[x2] = 0
+
+                res_counts[x1] = heap_size
+                for h in range(heap_size):
+                    res_data[x1, h] = heap_sims[h]
+                    res_indices[x1, h] = heap_ids[h]
+
+        finally:
+            free(prods)
+            free(freq)
+            free(touched)
+            free(heap_sims)
+            free(heap_ids)
+
+
+cdef invert_topk(
+    const int[:] indices, 
+    const int[:] indptr, 
+    const float[:] data, 
+    const float[:] x_mean, 
+    const float[:] x_norm, 
+    int sim_type, 
+    int min_support, 
+    int n_x, 
+    int n_y, 
+    int num_threads, 
+    int top_k
+):
+
+    top_k = min(top_k, max(n_x - 1, 1))
+    cdef float[:, ::1] res_data = np.zeros((n_x, top_k), dtype=np.single)
+    cdef int[:, ::1] res_indices = np.zeros((n_x, top_k), dtype=np.intc)
+    cdef int[:] res_counts = np.zeros(n_x, dtype=np.intc)
+
+    # transpose of the y-major input: positions of every x, grouped by x
+    indices_array = np.asarray(indices)
+    cdef int[:] x_entries = np.argsort(
+        indices_array, kind="stable").astype(np.intc)
+    cdef int[:] x_indptr = np.zeros(n_x + 1, dtype=np.intc)
+    np.cumsum(np.bincount(indices_array, minlength=n_x), 
+              out=np.asarray(x_indptr)[1:])
+    cdef int[:] entry_y = np.repeat(
+        np.arange(n_y, dtype=np.intc), np.diff(np.asarray(indptr)))
+
+    with nogil:
+        compute_topk(indices, indptr, data, x_indptr, x_entries, entry_y, 
+            x_mean, x_norm, sim_type, min_support, n_x, num_threads, top_k, 
+            res_data, res_indices, res_counts)
+
+    # compact the fixed-width (n_x, top_k) buffers into csr arrays
+    counts = np.asarray(res_counts)
+    mask = np.arange(top_k) < counts[:, None]
+    res_indptr = np.zeros(n_x + 1, dtype=np.uintc)
+    np.cumsum(counts, out=res_indptr[1:])
+    return (np.asarray(res_indices)[mask].astype(np.uintc), 
+            res_indptr, 
+            np.asarray(res_data)[mask])
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -152,9 +361,15 @@ cpdef invert_cosine(
     int n_y, 
     int block_size, 
     int block_num, 
-    int num_threads=1
+    int num_threads=1, 
+    int top_k=0
 ):
 
+    if top_k > 0:
+        return invert_topk(indices, indptr, data, 
+            np.zeros(n_x, dtype=np.single), x_norm, COSINE, min_support, 
+            n_x, n_y, num_threads, top_k)
+
     cdef Py_ssize_t res_count = count_freq(indices, indptr, min_support, 
                                            n_x, n_y, block_size, block_num, 
                                            num_threads)
@@ -259,9 +474,15 @@ cpdef invert_pearson(
     int n_y, 
     int block_size, 
     int block_num, 
-    int num_threads=1
+    int num_threads=1, 
+    int top_k=0
 ):
 
+    if top_k > 0:
+        return invert_topk(indices, indptr, data, x_mean, 
+            x_mean_centered_norm, PEARSON, min_support, n_x, n_y, 
+            num_threads, top_k)
+
     cdef Py_ssize_t res_count = count_freq(
         indices, indptr, min_support, n_x, n_y, block_size, block_num, num_threads)
 
@@ -339,7 +560,14 @@ cdef void compute_jaccard(
 @cython.cdivision(True)
 cpdef invert_jaccard(const int[:] indices, const int[:] indptr, const float[:] data, 
                     const int[:] x_count, int min_support, int n_x, int n_y, 
-                    int block_size, int block_num, int num_threads=1):
+                    int block_size, int block_num, int num_threads=1, 
+                    int top_k=0):
+
+    if top_k > 0:
+        return invert_topk(indices, indptr, data, 
+            np.zeros(n_x, dtype=np.single), 
+            np.asarray(x_count, dtype=np.single), JACCARD, min_support, 
+            n_x, n_y, num_threads, top_k)
 
     cdef Py_ssize_t res_count = count_freq(
         indices, indptr, min_support, n_x, n_y, block_size, block_num, num_threads)
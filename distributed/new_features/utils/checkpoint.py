@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+def save_checkpoint(path, epoch, arrays, meta=None):
+    """Atomically write a training checkpoint into directory `path`.
+
+    Every array is saved as `{name}.npy` in a temporary directory, which is
+    renamed to `epoch_{epoch}` when complete. Then the `latest` file is
+    replaced to point at it and older checkpoints are removed, so a job
+    killed at any moment leaves the previous checkpoint intact. The state
+    of the global numpy random generator is saved along.
+
+    Parameters
+    ----------
+    path : str
+        Checkpoint directory.
+    epoch : int
+        Last finished epoch.
+    arrays : dict of {str: numpy.ndarray}
+        Factors and optimizer states.
+    meta : dict, optional
+        Extra json serializable training state.
+    """
+    os.makedirs(path, exist_ok=True)
+    name = f"epoch_{epoch:06d}"
+    random_name, random_keys, *random_state = np.random.get_state()
+    meta = dict(meta or {}, epoch=epoch, arrays=list(arrays),
+                random_state=[random_name] + [
+                    state.item() if hasattr(state, "item") else state
+                    for state in random_state])
+
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}-", dir=path)
+    try:
+        for key, array in dict(arrays, random_keys=random_keys).items():
+            with open(os.path.join(tmp_dir, f"{key}.npy"), "wb") as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        checkpoint_dir = os.path.join(path, name)
+        if os.path.exists(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        os.replace(tmp_dir, checkpoint_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    _atomic_write(os.path.join(path, "latest"), name)
+    for entry in os.listdir(path):
+        if entry != name and entry.lstrip(".").startswith("epoch_"):
+            shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+
+
+def load_checkpoint(path, restore_random_state=True):
+    """Load the latest checkpoint written by `save_checkpoint`.
+
+    Returns
+    -------
+    meta: dict
+        Training state, including the finished `epoch`.
+    arrays: dict of {str: numpy.ndarray}
+        Saved factors and optimizer states.
+    """
+    with open(os.path.join(path, "latest")) as f:
+        checkpoint_dir = os.path.join(path, f.read().strip())
+    with open(os.path.join(checkpoint_dir, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {key: np.load(os.path.join(checkpoint_dir, f"{key}.npy"))
+              for key in meta["arrays"]}
+    if restore_random_state:
+        random_keys = np.load(os.path.join(checkpoint_dir, "random_keys.npy"))
+        random_name, *random_state = meta["random_state"]
+        np.random.set_state((random_name, random_keys, *random_state))
+    return meta, arrays
+
+
+def _atomic_write(filename, content):
+    tmp_file = f"{filename}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
@@ -2,7 +2,10 @@ import functools
 import time
 from contextlib import contextmanager
 import numpy as np
-import tensorflow as tf
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
 
 
 def shuffle_data(length, *args):
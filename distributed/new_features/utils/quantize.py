@@ -0,0 +1,59 @@
+from collections import namedtuple
+import numpy as np
+
+
+QuantizedFactors = namedtuple("QuantizedFactors", ["values", "scale"])
+
+
+def quantize_table(factors, dtype="int8"):
+    """Convert a float factor table to reduced precision.
+
+    Parameters
+    ----------
+    factors : array_like
+        Factor table, one row per user or item.
+    dtype : {"float16", "int8"}
+        "float16" casts all values, "int8" stores every row as
+        round(row / scale) with a per-row scale of max(abs(row)) / 127.
+
+    Returns
+    -------
+    table : `QuantizedFactors`
+        Quantized values and float32 per-row scale, scale is None for float16.
+    """
+    factors = np.asarray(factors, dtype=np.float32)
+    if dtype == "float16":
+        return QuantizedFactors(factors.astype(np.float16), None)
+    elif dtype == "int8":
+        scale = np.abs(factors).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        values = np.rint(factors / scale[:, None]).astype(np.int8)
+        return QuantizedFactors(values, scale.astype(np.float32))
+    else:
+        raise ValueError("dtype must either be 'float16' or 'int8'")
+
+
+def dequantize_table(table, start=0, end=None):
+    values = table.values[start:end].astype(np.float32)
+    if table.scale is not None:
+        values *= table.scale[start:end, None]
+    return values
+
+
+def table_nbytes(table):
+    scale_nbytes = table.scale.nbytes if table.scale is not None else 0
+    return table.values.nbytes + scale_nbytes
+
+
+def blocked_scores(user_vector, item_table, block_size=65536):
+    # only one float32 block of item factors exists at a time,
+    # per-row scale of int8 is applied to the block scores
+    n_items = len(item_table.values)
+    scores = np.empty(n_items, dtype=np.float32)
+    for start in range(0, n_items, block_size):
+        end = min(start + block_size, n_items)
+        block = item_table.values[start:end].astype(np.float32)
+        scores[start:end] = block @ user_vector
+        if item_table.scale is not None:
+            scores[start:end] *= item_table.scale[start:end]
+    return scores
@@ -1,10 +1,176 @@
 import abc
-from math import floor
-from random import random, seed as set_random_seed
+import queue
+import threading
+from random import seed as set_random_seed
 import numpy as np
 from .timing import time_block, time_func
 
 
+class ConsumedPairs(object):
+    """Vectorized membership test of consumed (user, item) pairs.
+
+    Pairs are kept as sorted int64 keys `user * n_items + item`. Queries are
+    filtered by a bitset first. If `n_users * n_items` bits fit in
+    `max_bitset_bytes` and take at most `exact_bits_per_pair` bits per pair,
+    the bitset is indexed by the key itself and is exact, otherwise by a
+    multiplicative hash of the key with about 16 bits per pair, and only
+    its hits are confirmed by binary search in the keys.
+
+    Parameters
+    ----------
+    user_indices : array_like
+        Users of consumed pairs.
+    item_indices : array_like
+        Items of consumed pairs.
+    n_users : int
+        Number of users.
+    n_items : int
+        Number of items.
+    max_bitset_bytes : int
+        Memory limit of the bitset.
+    exact_bits_per_pair : int
+        Largest size of the exact bitset per consumed pair, sparser data
+        use the hashed bitset.
+    """
+
+    def __init__(self, user_indices, item_indices, n_users, n_items,
+                 max_bitset_bytes=2 ** 28, exact_bits_per_pair=64):
+        self.n_items = n_items
+        keys = np.sort(np.asarray(user_indices, dtype=np.int64) * n_items
+                       + np.asarray(item_indices, dtype=np.int64))
+        self.keys = keys[np.diff(keys, prepend=-1) != 0]
+
+        max_bits = 8 * max_bitset_bytes
+        if n_users * n_items <= min(max_bits,
+                                    exact_bits_per_pair * len(self.keys)):
+            self.hash_bits = None
+            n_bits = n_users * n_items
+        else:
+            self.hash_bits = min(
+                int(np.ceil(np.log2(max(64, 16 * len(self.keys))))),
+                int(np.log2(max_bits)))
+            n_bits = 1 << self.hash_bits
+        self.bitset = np.zeros((n_bits + 7) // 8, dtype=np.uint8)
+
+        slots = np.sort(self._slots(self.keys))
+        if len(slots) > 0:
+            byte_index = slots >> 3
+            starts = np.flatnonzero(
+                np.r_[True, byte_index[1:] != byte_index[:-1]])
+            self.bitset[byte_index[starts]] = np.bitwise_or.reduceat(
+                np.left_shift(1, slots & 7).astype(np.uint8), starts)
+
+    @classmethod
+    def from_sparse(cls, sparse_interaction, **kwargs):
+        """Build from a user-item csr matrix."""
+        n_users, n_items = sparse_interaction.shape
+        users = np.repeat(np.arange(n_users), np.diff(sparse_interaction.indptr))
+        return cls(users, sparse_interaction.indices, n_users, n_items,
+                   **kwargs)
+
+    def _slots(self, keys):
+        if self.hash_bits is None:
+            return keys
+        # Fibonacci hashing, uint64 multiplication wraps around
+        hashed = keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return (hashed >> np.uint64(64 - self.hash_bits)).astype(np.int64)
+
+    def contains(self, users, items):
+        keys = (np.asarray(users, dtype=np.int64) * self.n_items
+                + np.asarray(items, dtype=np.int64))
+        slots = self._slots(keys)
+        hit = ((self.bitset[slots >> 3] >> (slots & 7)) & 1).astype(bool)
+        if self.hash_bits is not None:
+            candidates = np.flatnonzero(hit)
+            pos = np.searchsorted(self.keys, keys[candidates])
+            pos[pos == len(self.keys)] = 0
+            hit[candidates] = self.keys[pos] == keys[candidates]
+        return hit
+
+    def sample_negatives(self, users, rng=None, item_sampler=None):
+        """Draw an unconsumed item for every user in `users`.
+
+        All items are drawn at once and only the collisions are redrawn.
+        `rng` is a `numpy.random.Generator`, default uses the global state.
+        `item_sampler(size, rng)` draws the candidate items, default is
+        uniform. Rejecting consumed items makes the result follow the
+        candidate distribution renormalized over the unconsumed items.
+        """
+        if item_sampler is None:
+            item_sampler = self._uniform_items
+        users = np.asarray(users, dtype=np.int64)
+        items = item_sampler(len(users), rng)
+        redraw = np.flatnonzero(self.contains(users, items))
+        while len(redraw) > 0:
+            items[redraw] = item_sampler(len(redraw), rng)
+            redraw = redraw[self.contains(users[redraw], items[redraw])]
+        return items
+
+    def _uniform_items(self, size, rng=None):
+        randint = rng.integers if rng is not None else np.random.randint
+        return randint(0, self.n_items, size)
+
+
+class AliasTable(object):
+    """Walker alias table for drawing items with probability proportional
+    to `weights` in O(1) per draw.
+
+    Every column holds the probability of keeping its own item and the
+    alias item taken otherwise. The table is built with Vose's method in
+    closed form: walking the underfull columns in order, each one takes
+    the current overfull column as alias, and an overfull column whose
+    remainder drops below 1 is itself aliased to the next overfull one.
+    So the owner of every underfull column follows from cumulative sums
+    of deficits and excesses.
+
+    Parameters
+    ----------
+    weights : array_like
+        Non-negative item weights, e.g. popularity ** alpha.
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) == 0 or np.any(weights < 0) or weights.sum() <= 0:
+            raise ValueError("weights must be non-negative with positive sum")
+        n = len(weights)
+        self.prob = weights * (n / weights.sum())
+        self.alias = np.arange(n)
+
+        # the max column is at least 1 up to rounding error
+        is_large = self.prob >= 1.0
+        is_large[np.argmax(self.prob)] = True
+        small = np.flatnonzero(~is_large)
+        large = np.flatnonzero(is_large)
+        if len(small) > 0:
+            small_deficit = 1.0 - self.prob[small]
+            deficit = np.cumsum(small_deficit)
+            deficit_before = deficit - small_deficit
+            excess = np.cumsum(self.prob[large] - 1.0)
+            owner = np.searchsorted(excess, deficit_before)
+            self.alias[small] = large[np.minimum(owner, len(large) - 1)]
+            # remainder of an overfull column after its last underfull one
+            last = np.searchsorted(deficit_before, excess, side="right")
+            self.prob[large] = np.clip(
+                1.0 + excess - deficit[last - 1], 0.0, 1.0)
+            self.alias[large[:-1]] = large[1:]
+        # the last overfull column is 1 up to rounding error
+        self.prob[large[-1]] = 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, size, rng=None):
+        if rng is None:
+            columns = np.random.randint(0, len(self.prob), size)
+            coins = np.random.random(size)
+        else:
+            columns = rng.integers(0, len(self.prob), size)
+            coins = rng.random(size)
+        return np.where(coins < self.prob[columns],
+                        columns, self.alias[columns])
+
+
 class SamplingBase(object):
     def __init__(self, dataset, data_info, num_neg=1, batch_size=64):
         self.dataset = dataset
@@ -12,6 +178,33 @@ class SamplingBase(object):
         self.data_info = data_info
         self.num_neg = num_neg
         self.batch_size = batch_size
+        self._consumed = None
+
+    @property
+    def consumed(self):
+        # pairs of the dataset being sampled, so eval sets are covered too
+        if self._consumed is None:
+            if self.dataset.has_sampled:
+                user_indices = self.dataset.user_indices_orig
+                item_indices = self.dataset.item_indices_orig
+            else:
+                user_indices = self.dataset.user_indices
+                item_indices = self.dataset.item_indices
+            n_items = self.data_info.n_items
+            # unknown items are never drawn
+            mask = item_indices < n_items
+            n_users = int(user_indices.max()) + 1 if len(user_indices) else 0
+            self._consumed = ConsumedPairs(
+                user_indices[mask], item_indices[mask], n_users, n_items)
+        return self._consumed
+
+    def _sample_negatives(self, user_indices, item_indices, item_sampler=None,
+                          rng=None):
+        # rows of [positive, num_neg negatives] for every pair, flattened
+        item_neg = self.consumed.sample_negatives(
+            np.repeat(user_indices, self.num_neg), rng, item_sampler)
+        return np.column_stack(
+            [item_indices, item_neg.reshape(-1, self.num_neg)]).ravel()
 
 #    @abc.abstractmethod
 #    def generate_all(self, **kwargs):
@@ -20,58 +213,37 @@ class SamplingBase(object):
     def sample_items_random(self, seed=42):
         set_random_seed(seed)
         np.random.seed(seed)
-        n_items = self.data_info.n_items
-        item_indices_sampled = list()
-        # set `list.append` as local variable to speed up
-        item_append = item_indices_sampled.append
-        # set is much faster for search contains
-        user_consumed = {
-            u: set(items) for u, items in self.dataset.user_consumed.items()
-        }
         # sample negative items for every user
         with time_block("random neg item sampling"):
-            for u, i in zip(self.dataset.user_indices,
-                            self.dataset.item_indices):
-                item_append(i)
-                for _ in range(self.num_neg):
-                    item_neg = floor(n_items * random())
-                    while item_neg in user_consumed[u]:
-                        item_neg = floor(n_items * random())
-                    item_append(item_neg)
-        return np.asarray(item_indices_sampled)
-
-    def sample_items_popular(self, seed=42):
+            item_indices_sampled = self._sample_negatives(
+                self.dataset.user_indices, self.dataset.item_indices)
+        return item_indices_sampled
+
+    def sample_items_popular(self, seed=42, alpha=1.0):
         set_random_seed(seed)
         np.random.seed(seed)
+        user_indices = self.dataset.user_indices
+        item_indices = self.dataset.item_indices
+        # negatives are drawn with probability proportional to
+        # item_count ** alpha among the items a user hasn't consumed
         data = self.data_info.get_indexed_interaction()
-        item_counts = data.item.value_counts().sort_index().to_numpy()
-        user_consumed = self.dataset.user_consumed
-        items = np.arange(self.data_info.n_items)
+        item_weights = np.bincount(
+            data.item.to_numpy(), minlength=self.data_info.n_items
+        ) ** float(alpha)
+        consumed_keys = self.consumed.keys
+        consumed_weights = np.bincount(
+            consumed_keys // self.consumed.n_items,
+            weights=item_weights[consumed_keys % self.consumed.n_items])
+        if np.any(consumed_weights >= item_weights.sum() * (1 - 1e-12)):
+            raise ValueError(
+                "some users have consumed all items with non-zero weight, "
+                "use item_gen_mode='random' or alpha=0")
 
-        item_order = list()
-        item_indices_sampled = list()
         with time_block("popularity-based neg item sampling"):
-            for user, u_data in data.groupby("user", sort=False):
-                item_indices = u_data.index.to_list()
-                item_indices = item_indices * (self.num_neg + 1)
-                item_order.extend(item_indices)
-
-                # add positive items
-                item_indices_sampled.extend(u_data.item.tolist())
-                u_consumed = user_consumed[user]
-                u_item_counts = item_counts.copy()
-                u_item_counts[u_consumed] = 0
-                item_prob = u_item_counts / np.sum(u_item_counts)
-                neg_size = len(u_consumed) * self.num_neg
-
-                neg_sampled = np.random.choice(
-                    items, size=neg_size, p=item_prob, replace=True)
-                item_indices_sampled.extend(neg_sampled)
-
-        item_indices_sampled = np.asarray(item_indices_sampled)
-        # must be stable sort to keep relative order
-        item_order = np.argsort(item_order, kind="mergesort")
-        return item_indices_sampled[item_order]
+            item_sampler = AliasTable(item_weights).sample
+            item_indices_sampled = self._sample_negatives(
+                user_indices, item_indices, item_sampler=item_sampler)
+        return item_indices_sampled
 
     def _label_negative_sampling(self, size):
         factor = self.num_neg + 1
@@ -96,14 +268,16 @@ class NegativeSamplingPure(SamplingBase):
             self.item_indices = dataset.item_indices
         self.data_size = len(self.user_indices)
 
-    def generate_all(self, seed=42, shuffle=False, item_gen_mode="random"):
+    def generate_all(self, seed=42, shuffle=False, item_gen_mode="random",
+                     pop_alpha=1.0):
         if item_gen_mode not in ["random", "popular"]:
             raise ValueError(
                 "sampling item_gen_mode must either be 'random' or 'popular'")
         elif item_gen_mode == "random":
             item_indices_sampled = self.sample_items_random(seed=seed)
         elif item_gen_mode == "popular":
-            item_indices_sampled = self.sample_items_popular(seed=seed)
+            item_indices_sampled = self.sample_items_popular(
+                seed=seed, alpha=pop_alpha)
 
         user_indices_sampled = np.repeat(
             self.user_indices, self.num_neg + 1, axis=0)
@@ -117,35 +291,25 @@ class NegativeSamplingPure(SamplingBase):
         else:
             return user_indices_sampled, item_indices_sampled, label_sampled
         
-    def __call__(self, shuffle=True):
+    def __call__(self, shuffle=True, rng=None):
         if shuffle:
-            mask = np.random.permutation(range(self.data_size))
+            permutation = (rng.permutation if rng is not None
+                           else np.random.permutation)
+            mask = permutation(self.data_size)
             self.user_indices = self.user_indices[mask]
             self.item_indices = self.item_indices[mask]
         #    self.labels = self.labels[mask]
 
-        user_consumed = {
-            u: set(items) for u, items in self.dataset.user_consumed.items()
-        }
-        n_items = self.data_info.n_items
-        return self.sample_batch(user_consumed, n_items)
+        return self.sample_batch(rng)
 
-    def sample_batch(self, user_consumed, n_items):
+    def sample_batch(self, rng=None):
         for k in range(0, self.data_size, self.batch_size):
             batch_slice = slice(k, k + self.batch_size)
             batch_user_indices = self.user_indices[batch_slice]
             batch_item_indices = self.item_indices[batch_slice]
 
-            item_indices_sampled = list()
-            for u, i in zip(batch_user_indices, batch_item_indices):
-                item_indices_sampled.append(i)
-                for _ in range(self.num_neg):
-                    item_neg = floor(random() * n_items)
-                    while item_neg in user_consumed[u]:
-                        item_neg = floor(random() * n_items)
-                    item_indices_sampled.append(item_neg)
-
-            item_sampled = np.asarray(item_indices_sampled)
+            item_sampled = self._sample_negatives(
+                batch_user_indices, batch_item_indices, rng=rng)
             user_sampled = np.repeat(
                 batch_user_indices, self.num_neg + 1, axis=0)
             label_sampled = self._label_negative_sampling(
@@ -165,14 +329,15 @@ class NegativeSamplingFeat(SamplingBase):
         self.data_size = len(self.sparse_indices)
 
     def generate_all(self, seed=42, dense=True, shuffle=False,
-                     item_gen_mode="random"):
+                     item_gen_mode="random", pop_alpha=1.0):
         if item_gen_mode not in ["random", "popular"]:
             raise ValueError(
                 "sampling item_gen_mode must either be 'random' or 'popular'")
         elif item_gen_mode == "random":
             item_indices_sampled = self.sample_items_random(seed=seed)
         elif item_gen_mode == "popular":
-            item_indices_sampled = self.sample_items_popular(seed=seed)
+            item_indices_sampled = self.sample_items_popular(
+                seed=seed, alpha=pop_alpha)
 
         sparse_indices_sampled = self._sparse_indices_sampling(
             self.sparse_indices, item_indices_sampled)
@@ -289,39 +454,103 @@ class PairwiseSampling(SamplingBase):
             self.item_indices = dataset.item_indices
         self.data_size = len(self.user_indices)
 
-    def __call__(self, shuffle=True):
+    def __call__(self, shuffle=True, rng=None):
         if shuffle:
-            mask = np.random.permutation(range(self.data_size))
+            permutation = (rng.permutation if rng is not None
+                           else np.random.permutation)
+            mask = permutation(self.data_size)
             self.user_indices = self.user_indices[mask]
             self.item_indices = self.item_indices[mask]
 
-        user_consumed = {
-            u: set(items) for u, items in self.dataset.user_consumed.items()
-        }
-        n_items = self.data_info.n_items
-        return self.sample_batch(user_consumed, n_items)
+        return self.sample_batch(rng)
 
-    def sample_batch(self, user_consumed, n_items):
+    def sample_batch(self, rng=None):
         for k in range(0, self.data_size, self.batch_size):
             batch_slice = slice(k, k + self.batch_size)
             batch_user_indices = self.user_indices[batch_slice]
             batch_item_indices_pos = self.item_indices[batch_slice]
 
-            batch_item_indices_neg = list()
-            for u in batch_user_indices:
-                item_neg = floor(n_items * random())
-                while item_neg in user_consumed[u]:
-                    item_neg = floor(n_items * random())
-                batch_item_indices_neg.append(item_neg)
-
-            batch_item_indices_neg = np.asarray(batch_item_indices_neg)
+            batch_item_indices_neg = self.consumed.sample_negatives(
+                batch_user_indices, rng)
         #    batch_item_diff
             yield (batch_user_indices,
                    batch_item_indices_pos,
                    batch_item_indices_neg)
 
 
-
-
-
-
+class PrefetchSampling(object):
+    """Run a batch sampler in a background thread.
+
+    Batches of `NegativeSamplingPure` or `PairwiseSampling` are produced
+    into a bounded queue while the caller consumes earlier ones, so
+    sampling overlaps with `sess.run`. Every call starts a new epoch, and
+    the sampler draws from its own generator seeded with (seed, epoch),
+    so the batches don't depend on timing or on other users of the
+    global numpy random state.
+
+    Parameters
+    ----------
+    sampler : `NegativeSamplingPure` or `PairwiseSampling`
+        Batch sampler, called as `sampler(shuffle, rng=rng)`.
+    buffer_size : int
+        Maximum number of ready batches.
+    seed : int
+        Base seed of the per-epoch generators.
+    """
+
+    _end = object()
+
+    def __init__(self, sampler, buffer_size=8, seed=42):
+        self.sampler = sampler
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __call__(self, shuffle=True, batch_size=None):
+        if batch_size is not None:
+            self.sampler.batch_size = batch_size
+        self.epoch += 1
+        rng = np.random.default_rng([self.seed, self.epoch])
+        return self._prefetch(self.sampler(shuffle, rng=rng))
+
+    def _prefetch(self, batches):
+        buffer = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce,
+                                  args=(batches, buffer, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch = buffer.get()
+                if batch is self._end:
+                    break
+                elif isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            # consumer stopped early, unblock and wait for the worker
+            stop.set()
+            while worker.is_alive():
+                try:
+                    buffer.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            worker.join()
+
+    def _produce(self, batches, buffer, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+            put(self._end)
+        except Exception as e:
+            put(e)
@@ -1,6 +1,12 @@
+import os
+import re
+import json
 import time
 import math
+import shutil
 import logging
+import tempfile
+from contextlib import contextmanager
 import numpy as np
 from scipy.sparse import csr_matrix
 from scipy.sparse.linalg import norm as spnorm
@@ -21,7 +27,8 @@ except ImportError:
     pass
 
 
-def _choose_blocks(num, b_size=None):
+def _choose_blocks(num, b_size=None, memory_limit=None, num_threads=1,
+                   sparse_data_y=None, top_k=None):
     # To calculate an n by n similarity matrix (n is num of user or item),
     # memory is usually a big concern, so the matrix is divided into several
     # blocks to calculate separately. The default block size is 1024, so num
@@ -29,16 +36,134 @@ def _choose_blocks(num, b_size=None):
     # Of course num of users/items will vary in various datasets,
     # so here default block num is defined as how many blocks can exist,
     # and block size is calculated to make sure data are divided evenly.
-    if not b_size:
-        block_num = math.ceil(num / (2e8 / num))
-        block_size = math.ceil(num / block_num)
-    print(f"Final block size and num: {block_size, block_num}")
-    return block_size, block_num
+    # With `memory_limit`, the estimated result size is reserved first, and
+    # the remaining budget decides block size and threads, since every
+    # thread holds float prods and uint freq of block_size * num.
+    # The top-k kernel works row by row instead, each thread only holds a
+    # sparse accumulator of 12 * num bytes and block size is unused.
+    if b_size:
+        block_size = min(b_size, num)
+    elif memory_limit is not None and top_k:
+        budget = _parse_memory(memory_limit) - _estimate_result_memory(
+            num, sparse_data_y, top_k)
+        num_threads = max(1, min(num_threads, budget // (12 * num)))
+        block_size = num
+    elif memory_limit is not None:
+        budget = _parse_memory(memory_limit) - _estimate_result_memory(
+            num, sparse_data_y, top_k)
+        row_memory = 8 * num
+        block_size = budget // (row_memory * num_threads)
+        if block_size < 1:
+            num_threads = max(1, min(num_threads, budget // row_memory))
+            block_size = 1
+            if budget < row_memory:
+                logging.warning(f"similarity of {num} users/items may "
+                                f"exceed memory_limit {memory_limit}, "
+                                f"consider using spill_dir")
+        block_size = min(int(block_size), num)
+    else:
+        block_size = math.ceil(num / math.ceil(num / (2e8 / num)))
+    block_num = math.ceil(num / block_size)
+    print(f"Final block size and num: {block_size, block_num}, "
+          f"threads: {num_threads}")
+    return block_size, block_num, num_threads
+
+
+def _parse_memory(memory_limit):
+    # e.g. 4GB, "512MB", "1.5G" or plain bytes
+    if isinstance(memory_limit, (int, float)):
+        return int(memory_limit)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)I?B?\s*",
+                         memory_limit.upper())
+    if match is None:
+        raise ValueError(f"invalid memory_limit: {memory_limit}, "
+                         f"should be bytes or like '4GB'")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit or " "))
+
+
+def _estimate_result_memory(num, sparse_data_y=None, top_k=None):
+    # Upper bound of co-occurring pairs is sum of deg * (deg - 1) / 2 over
+    # y, capped by num * (num - 1) / 2. Each pair costs about 40 bytes across
+    # kernel output, sim matrix and its symmetric sum.
+    if top_k:
+        return 16 * num * top_k
+    if sparse_data_y is None:
+        return 0
+    degree = np.diff(sparse_data_y.indptr).astype(np.float64)
+    n_pairs = min(np.sum(degree * (degree - 1)) / 2, num * (num - 1) / 2)
+    return int(40 * n_pairs)
+
+
+def _spilled_sim(sparse_data_x, sim_type, min_common, top_k, memory_limit,
+                 spill_dir, mode="invert", block_size=None):
+    # Rows of the similarity matrix are computed shard by shard with sparse
+    # products, and every finished shard is appended to the on-disk store
+    # of `save_sim_matrix`, so at most one shard lives in memory. A shard
+    # has `block_size` rows if given, otherwise its size follows the
+    # co-occurrence count of each row, i.e. sum of y degrees, within
+    # `memory_limit`. Sparse products are the invert way of computing,
+    # so forward mode can't be combined with spilling.
+    # Returns the memory-mapped result of `load_sim_matrix`.
+    if mode != "invert":
+        raise ValueError("spill_dir is only supported in 'invert' mode")
+    sparse_data_x = sparse_data_x.tocsr()
+    n_x = sparse_data_x.shape[0]
+    budget = _parse_memory(memory_limit) if memory_limit is not None else 2e9
+    binary = sparse_data_x.copy()
+    binary.data = np.ones_like(binary.data)
+    y_degree = np.asarray(binary.sum(axis=0)).ravel()
+    row_cost = np.cumsum(48 * (binary @ y_degree))
+    x_norm, x_mean = compute_sim_stats(sparse_data_x, sim_type)
+
+    indptr = np.zeros(n_x + 1, dtype=np.int64)
+    with _replace_store(spill_dir) as tmp_dir:
+        with open(os.path.join(tmp_dir, "indices.bin"), "wb") as f_indices, \
+                open(os.path.join(tmp_dir, "data.bin"), "wb") as f_data:
+            start = 0
+            while start < n_x:
+                if block_size:
+                    end = min(start + block_size, n_x)
+                else:
+                    offset = row_cost[start - 1] if start > 0 else 0
+                    end = max(start + 1, int(np.searchsorted(
+                        row_cost, offset + budget, side="right")))
+                shard = sim_rows(sparse_data_x, np.arange(start, end),
+                                 sim_type, x_norm, x_mean, min_common)
+                if top_k:
+                    shard = prune_top_k(shard, top_k)
+                shard.sort_indices()
+                shard.indices.astype(np.int32).tofile(f_indices)
+                shard.data.astype(np.float32).tofile(f_data)
+                indptr[start + 1: end + 1] = indptr[start] + shard.indptr[1:]
+                start = end
+            for f in (f_indices, f_data):
+                f.flush()
+                os.fsync(f.fileno())
+
+        with open(os.path.join(tmp_dir, "indptr.bin"), "wb") as f:
+            indptr.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        nnz = int(indptr[-1])
+        _write_meta(tmp_dir, {
+            "shape": [n_x, n_x],
+            "indptr": {"dtype": indptr.dtype.str, "size": n_x + 1},
+            "indices": {"dtype": np.dtype(np.int32).str, "size": nnz},
+            "data": {"dtype": np.dtype(np.float32).str, "size": nnz}
+        })
+    return load_sim_matrix(spill_dir)
 
 
 def cosine_sim(sparse_data_x, sparse_data_y, num_x, num_y, block_size=None,
-               num_threads=1, min_common=1, mode="invert"):
-    block_size, block_num = _choose_blocks(num_x, block_size)
+               num_threads=1, min_common=1, mode="invert", top_k=None,
+               memory_limit=None, spill_dir=None):
+    _check_top_k(top_k, mode)
+    if spill_dir is not None:
+        return _spilled_sim(sparse_data_x, "cosine", min_common, top_k,
+                            memory_limit, spill_dir, mode, block_size)
+    block_size, block_num, num_threads = _choose_blocks(
+        num_x, block_size, memory_limit, num_threads, sparse_data_y, top_k)
     n_x, n_y = num_x, num_y
 
     if mode == "forward":
@@ -58,19 +183,23 @@ def cosine_sim(sparse_data_x, sparse_data_y, num_x, num_y, block_size=None,
 
         res_indices, res_indptr, res_data = invert_cosine(
             indices, indptr, data, x_norm, min_common, n_x, n_y,
-            block_size, block_num, num_threads)
+            block_size, block_num, num_threads, top_k or 0)
 
     else:
         raise ValueError("mode must either be 'forward' or 'invert'")
 
-    sim_upper_triangular = csr_matrix(
-        (res_data, res_indices, res_indptr), shape=(n_x, n_x), dtype=np.float32)
-    return sim_upper_triangular + sim_upper_triangular.transpose()
+    return _build_sim_matrix(res_indices, res_indptr, res_data, n_x, top_k)
 
 
 def pearson_sim(sparse_data_x, sparse_data_y, num_x, num_y, block_size=None,
-                num_threads=1, min_common=1, mode="invert"):
-    block_size, block_num = _choose_blocks(num_x, block_size)
+                num_threads=1, min_common=1, mode="invert", top_k=None,
+                memory_limit=None, spill_dir=None):
+    _check_top_k(top_k, mode)
+    if spill_dir is not None:
+        return _spilled_sim(sparse_data_x, "pearson", min_common, top_k,
+                            memory_limit, spill_dir, mode, block_size)
+    block_size, block_num, num_threads = _choose_blocks(
+        num_x, block_size, memory_limit, num_threads, sparse_data_y, top_k)
     n_x, n_y = num_x, num_y
 
     if mode == "forward":
@@ -93,19 +222,23 @@ def pearson_sim(sparse_data_x, sparse_data_y, num_x, num_y, block_size=None,
 
         res_indices, res_indptr, res_data = invert_pearson(
             indices, indptr, data, x_mean, x_mean_centered_norm, min_common,
-            n_x, n_y, block_size, block_num, num_threads)
+            n_x, n_y, block_size, block_num, num_threads, top_k or 0)
 
     else:
         raise ValueError("mode must either be 'forward' or 'invert'")
 
-    sim_upper_triangular = csr_matrix(
-        (res_data, res_indices, res_indptr), shape=(n_x, n_x), dtype=np.float32)
-    return sim_upper_triangular + sim_upper_triangular.transpose()
+    return _build_sim_matrix(res_indices, res_indptr, res_data, n_x, top_k)
 
 
 def jaccard_sim(sparse_data_x, sparse_data_y, num_x, num_y, block_size=None,
-                num_threads=1, min_common=1, mode="invert"):
-    block_size, block_num = _choose_blocks(num_x, block_size)
+                num_threads=1, min_common=1, mode="invert", top_k=None,
+                memory_limit=None, spill_dir=None):
+    _check_top_k(top_k, mode)
+    if spill_dir is not None:
+        return _spilled_sim(sparse_data_x, "jaccard", min_common, top_k,
+                            memory_limit, spill_dir, mode, block_size)
+    block_size, block_num, num_threads = _choose_blocks(
+        num_x, block_size, memory_limit, num_threads, sparse_data_y, top_k)
     n_x, n_y = num_x, num_y
 
     if mode == "forward":
@@ -125,14 +258,165 @@ def jaccard_sim(sparse_data_x, sparse_data_y, num_x, num_y, block_size=None,
 
         res_indices, res_indptr, res_data = invert_jaccard(
             indices, indptr, data, x_count, min_common,
-            n_x, n_y, block_size, block_num, num_threads)
+            n_x, n_y, block_size, block_num, num_threads, top_k or 0)
 
     else:
         raise ValueError("mode must either be 'forward' or 'invert'")
 
-    sim_upper_triangular = csr_matrix(
-        (res_data, res_indices, res_indptr), shape=(n_x, n_x), dtype=np.float32)
-    return sim_upper_triangular + sim_upper_triangular.transpose()
+    return _build_sim_matrix(res_indices, res_indptr, res_data, n_x, top_k)
+
+
+def knn_scores(sim_matrix, interaction, sim_index, interaction_index, k,
+               chunk_nnz=2 ** 24):
+    # Neighbors of pair p are the positive entries of sim row
+    # `sim_index[p]` that also appear in interaction row
+    # `interaction_index[p]`, of which the `k` most similar ones are kept.
+    # Pairs are scored in chunks bounded by the sim row sizes, and each
+    # chunk is a few sparse elementwise products and row sums.
+    # Returns sum of neighbor sims, sum of sim * label and neighbor count.
+    sim_index = np.asarray(sim_index)
+    interaction_index = np.asarray(interaction_index)
+    n_pairs = len(sim_index)
+    sim_sum = np.zeros(n_pairs, dtype=np.float32)
+    label_sum = np.zeros(n_pairs, dtype=np.float32)
+    count = np.zeros(n_pairs, dtype=np.int64)
+
+    row_nnz = np.cumsum(np.diff(sim_matrix.indptr)[sim_index])
+    start = 0
+    while start < n_pairs:
+        offset = row_nnz[start - 1] if start > 0 else 0
+        end = max(start + 1, int(np.searchsorted(
+            row_nnz, offset + chunk_nnz, side="right")))
+        sims = sim_matrix[sim_index[start:end]]
+        labels = interaction[interaction_index[start:end]]
+        common = sims.multiply(labels.astype(bool)).tocsr()
+        common.data[common.data < 0] = 0
+        common.eliminate_zeros()
+        common = prune_top_k(common, k)
+
+        sim_sum[start:end] = np.asarray(common.sum(axis=1)).ravel()
+        label_sum[start:end] = np.asarray(
+            common.multiply(labels).sum(axis=1)).ravel()
+        count[start:end] = np.diff(common.indptr)
+        start = end
+    return sim_sum, label_sum, count
+
+
+def minhash_jaccard_sim(sparse_data_x, num_x, num_perm=128, num_bands=None,
+                        min_common=1, top_k=None, seed=42):
+    # Approximate jaccard similarity with MinHash signatures and LSH banding.
+    # Signatures are split into `num_bands` bands, x which share one whole
+    # band fall into the same bucket and become candidate pairs, so only
+    # these pairs are scored rather than every co-occurring pair. Jaccard is
+    # estimated as the fraction of equal signature values, and the common
+    # count used by `min_common` is derived from it. More `num_perm` gives
+    # better estimates at linear extra cost. Default uses 2 rows per band,
+    # which puts the candidate threshold around sqrt(2 / num_perm).
+    if num_bands is None:
+        num_bands = max(1, num_perm // 2)
+    if num_perm % num_bands != 0:
+        raise ValueError("num_perm must be divisible by num_bands")
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k must be a positive integer")
+
+    sparse_data_x = sparse_data_x.tocsr()
+    x_count = compute_sparse_count(sparse_data_x)
+    signatures = _minhash_signatures(sparse_data_x, num_perm, seed)
+    x1, x2 = _lsh_candidates(signatures, np.flatnonzero(x_count),
+                             num_bands)
+
+    sims = np.empty(len(x1), dtype=np.float32)
+    chunk = max(1, 2 ** 24 // num_perm)
+    for start in range(0, len(x1), chunk):
+        end = start + chunk
+        sims[start:end] = np.mean(
+            signatures[x1[start:end]] == signatures[x2[start:end]], axis=1)
+
+    common = sims * (x_count[x1] + x_count[x2]) / (1.0 + sims)
+    mask = (sims > 0) & (common >= min_common - 0.5)
+    x1, x2, sims = x1[mask], x2[mask], sims[mask]
+    sim = csr_matrix((np.concatenate([sims, sims]),
+                      (np.concatenate([x1, x2]), np.concatenate([x2, x1]))),
+                     shape=(num_x, num_x), dtype=np.float32)
+    if top_k:
+        return prune_top_k(sim, top_k)
+    sim.sort_indices()
+    return sim
+
+
+def _minhash_signatures(sparse_data_x, num_perm, seed):
+    # universal hashing h(y) = (a * y + b) mod p stands in for permutations,
+    # signature of x is the min hash value over its interacted y
+    prime = (1 << 31) - 1
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, prime, size=num_perm, dtype=np.int64)
+    b = rng.integers(0, prime, size=num_perm, dtype=np.int64)
+    n_x = sparse_data_x.shape[0]
+    indices = sparse_data_x.indices.astype(np.int64)
+    indptr = sparse_data_x.indptr
+    non_empty = np.diff(indptr) > 0
+    starts = indptr[:-1][non_empty]
+
+    signatures = np.full((n_x, num_perm), prime, dtype=np.int64)
+    if len(indices) == 0:
+        return signatures
+    chunk = max(1, 2 ** 24 // len(indices))
+    for start in range(0, num_perm, chunk):
+        end = min(start + chunk, num_perm)
+        hashed = (np.outer(a[start:end], indices) + b[start:end, None]) % prime
+        signatures[non_empty, start:end] = np.minimum.reduceat(
+            hashed, starts, axis=1).T
+    return signatures
+
+
+def _lsh_candidates(signatures, valid_x, num_bands):
+    # Bucket ids are exact band values (via np.unique), so no false
+    # collisions come from hashing the bands themselves. Within a sorted
+    # bucket, elements i and i + d form a pair when they share the bucket.
+    rows_per_band = signatures.shape[1] // num_bands
+    pairs = []
+    for band in range(num_bands):
+        band_slice = slice(band * rows_per_band, (band + 1) * rows_per_band)
+        _, buckets = np.unique(signatures[valid_x, band_slice], axis=0,
+                               return_inverse=True)
+        buckets = buckets.ravel()
+        order = np.argsort(buckets, kind="stable")
+        members = valid_x[order]
+        sorted_buckets = buckets[order]
+        d = 1
+        while d < len(members):
+            same = sorted_buckets[d:] == sorted_buckets[:-d]
+            if not same.any():
+                break
+            pairs.append(np.stack([members[:-d][same], members[d:][same]]))
+            d += 1
+
+    if not pairs:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    pairs = np.concatenate(pairs, axis=1)
+    x1 = np.minimum(pairs[0], pairs[1]).astype(np.int64)
+    x2 = np.maximum(pairs[0], pairs[1]).astype(np.int64)
+    n_x = signatures.shape[0]
+    keys = np.unique(x1 * n_x + x2)
+    return keys // n_x, keys % n_x
+
+
+def _check_top_k(top_k, mode):
+    if top_k is not None and (top_k < 1 or mode != "invert"):
+        raise ValueError("top_k must be a positive integer "
+                         "and is only supported in 'invert' mode")
+
+
+def _build_sim_matrix(res_indices, res_indptr, res_data, n_x, top_k=None):
+    sim = csr_matrix((res_data, res_indices, res_indptr),
+                     shape=(n_x, n_x), dtype=np.float32)
+    if top_k:
+        # pruned rows already contain both directions of every pair,
+        # but neighbors come out in heap order
+        sim.sort_indices()
+        return sim
+    return sim + sim.transpose()
 
 
 def compute_sparse_norm(sparse_data):
@@ -153,19 +437,178 @@ def compute_sparse_mean_centered_norm(sparse_data):
     # only consider interacted data
     assert np.issubdtype(sparse_data.dtype, np.floating), (
         "sparse_data type must be float...")
-    indices = sparse_data.indices.copy()
-    indptr = sparse_data.indptr.copy()
-    data = sparse_data.data.copy()
-    length = sparse_data.shape[0]
-    for x in range(length):
-        x_slice = slice(indptr[x], indptr[x+1])
-        x_mean = np.mean(data[x_slice])
-        data[x_slice] -= x_mean
-    sparse_data_mean_centered = csr_matrix((data, indices, indptr),
-                                           shape=sparse_data.shape)
-    return compute_sparse_norm(sparse_data_mean_centered)
+    x_mean = compute_sparse_mean(sparse_data)
+    return compute_sparse_norm(_mean_centered(sparse_data, x_mean))
+
+
+def _mean_centered(sparse_data, x_mean):
+    x_num = np.diff(sparse_data.indptr)
+    data = sparse_data.data - np.repeat(x_mean, x_num)
+    return csr_matrix((data, sparse_data.indices.copy(),
+                       sparse_data.indptr.copy()), shape=sparse_data.shape)
 
 
 def compute_sparse_count(sparse_data):
     return np.diff(sparse_data.indptr)
 
+
+def compute_sim_stats(sparse_data, sim_type):
+    # per-row statistics the similarity formulas divide by, returned as
+    # (norm, mean). For jaccard the "norm" is the interaction count.
+    if sim_type == "cosine":
+        return compute_sparse_norm(sparse_data), None
+    elif sim_type == "pearson":
+        return (compute_sparse_mean_centered_norm(sparse_data),
+                compute_sparse_mean(sparse_data))
+    elif sim_type == "jaccard":
+        return compute_sparse_count(sparse_data).astype(np.float32), None
+    else:
+        raise ValueError("sim_type must be one of "
+                         "('cosine', 'pearson', 'jaccard')")
+
+
+def merge_interaction(sparse_interaction, new_interaction):
+    # new labels overwrite the old ones of the same pair
+    overlap = sparse_interaction.multiply(new_interaction.astype(bool))
+    merged = sparse_interaction - overlap + new_interaction
+    return merged.tocsr().astype(sparse_interaction.dtype)
+
+
+def sim_rows(sparse_data_x, rows, sim_type, x_norm, x_mean=None,
+             min_common=1):
+    # Similarities between `rows` and every x, computed with two sparse
+    # products restricted to `rows` instead of the whole x * x matrix.
+    # Diagonal is excluded, same as the full similarity functions.
+    rows = np.asarray(rows)
+    n_x = sparse_data_x.shape[0]
+    binary = sparse_data_x.copy()
+    binary.data = np.ones_like(binary.data)
+    freq = (binary[rows] @ binary.T).tocoo()
+    mask = (freq.data >= min_common) & (rows[freq.row] != freq.col)
+    r, c, common = freq.row[mask], freq.col[mask], freq.data[mask]
+
+    if sim_type == "jaccard":
+        numerator = common
+        denominator = x_norm[rows[r]] + x_norm[c] - common
+    else:
+        if sim_type == "pearson":
+            sparse_data_x = _mean_centered(sparse_data_x, x_mean)
+        prods = (sparse_data_x[rows] @ sparse_data_x.T).tocsr()
+        numerator = np.asarray(prods[r, c]).ravel()
+        denominator = x_norm[rows[r]] * x_norm[c]
+
+    sims = np.zeros(len(r), dtype=np.float32)
+    np.divide(numerator, denominator, out=sims, where=denominator > 0)
+    return csr_matrix((sims, (r, c)), shape=(len(rows), n_x))
+
+
+def replace_sim_rows(sim_matrix, rows, new_rows):
+    # Drop every entry in `rows` and their symmetric columns, then put in
+    # `new_rows` together with its mirror. Pairs inside `rows` already
+    # appear in both directions in `new_rows`, so they are not mirrored.
+    rows = np.asarray(rows)
+    n_x = sim_matrix.shape[0]
+    touched = np.zeros(n_x, dtype=bool)
+    touched[rows] = True
+    old = sim_matrix.tocoo()
+    keep = ~(touched[old.row] | touched[old.col])
+    new = new_rows.tocoo()
+    new_row = rows[new.row]
+    mirror = ~touched[new.col]
+
+    row = np.concatenate([old.row[keep], new_row, new.col[mirror]])
+    col = np.concatenate([old.col[keep], new.col, new_row[mirror]])
+    data = np.concatenate([old.data[keep], new.data, new.data[mirror]])
+    res = csr_matrix((data.astype(np.float32), (row, col)),
+                     shape=(n_x, n_x))
+    res.sort_indices()
+    return res
+
+
+def prune_top_k(sim_matrix, top_k):
+    # keep the `top_k` largest entries in every row
+    sim_matrix = sim_matrix.tocsr()
+    counts = np.diff(sim_matrix.indptr)
+    row = np.repeat(np.arange(sim_matrix.shape[0]), counts)
+    order = np.lexsort((-sim_matrix.data, row))
+    rank = np.arange(len(order)) - sim_matrix.indptr[row]
+    keep = order[rank < top_k]
+    res = csr_matrix((sim_matrix.data[keep],
+                      (row[keep], sim_matrix.indices[keep])),
+                     shape=sim_matrix.shape)
+    res.sort_indices()
+    return res
+
+
+@contextmanager
+def _replace_store(path):
+    # Yields a temporary directory next to `path`, which replaces `path` once
+    # the block finishes. Old files are never truncated, so processes still
+    # mapping them keep reading the old matrix.
+    path = os.path.abspath(path)
+    parent, name = os.path.split(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}-", dir=parent)
+    old_dir = None
+    try:
+        yield tmp_dir
+        # a non-empty directory can't be replaced directly, move it aside first
+        if os.path.exists(path):
+            old_dir = tempfile.mkdtemp(prefix=f".{name}-old-", dir=parent)
+            os.replace(path, os.path.join(old_dir, name))
+        os.replace(tmp_dir, path)
+    except BaseException:
+        if old_dir is not None and not os.path.exists(path):
+            os.replace(os.path.join(old_dir, name), path)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_sim_matrix(path, sim_matrix):
+    # Each csr array is written as one raw binary file starting at offset 0,
+    # so `load_sim_matrix` can map it directly and several processes share
+    # the same page-cached copy. The whole directory is replaced at once.
+    sim_matrix = sim_matrix.tocsr()
+    if not sim_matrix.has_sorted_indices:
+        sim_matrix.sort_indices()
+
+    with _replace_store(path) as tmp_dir:
+        meta = {"shape": list(sim_matrix.shape)}
+        for name in ("indptr", "indices", "data"):
+            array = np.ascontiguousarray(getattr(sim_matrix, name))
+            with open(os.path.join(tmp_dir, f"{name}.bin"), "wb") as f:
+                array.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            meta[name] = {"dtype": array.dtype.str, "size": int(array.size)}
+        _write_meta(tmp_dir, meta)
+
+
+def load_sim_matrix(path, mmap_mode="r"):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    arrays = []
+    for name in ("data", "indices", "indptr"):
+        dtype = np.dtype(meta[name]["dtype"])
+        size = meta[name]["size"]
+        if size == 0:
+            # empty file can't be memory-mapped
+            arrays.append(np.zeros(0, dtype=dtype))
+        else:
+            arrays.append(np.memmap(os.path.join(path, f"{name}.bin"),
+                                    dtype=dtype, mode=mmap_mode, shape=(size,)))
+
+    sim_matrix = csr_matrix(tuple(arrays), shape=tuple(meta["shape"]),
+                            copy=False)
+    sim_matrix.has_sorted_indices = True
+    return sim_matrix
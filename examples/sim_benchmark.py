@@ -0,0 +1,223 @@
+"""Benchmark of similarity implementations on synthetic interaction data.
+
+Usage from repository root::
+
+    python -m examples.sim_benchmark --n-users 20000 --n-items 5000 \
+        --density 0.001 0.005 --threads 1 4 --block-sizes 0 512 \
+        --json sim_benchmark.json
+
+Item-item similarity is computed by every implementation, i.e. forward and
+invert modes of `cosine_sim`, `pearson_sim` and `jaccard_sim` in
+distributed/new_features, libreco `sk_sim` and the libreco sparse cython
+engine. Every case runs in a forked process, so peak RSS is per case.
+Block size 0 means the default blocking of `_choose_blocks`.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import resource
+import signal
+import sys
+import time
+from queue import Empty
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from distributed.new_features.utils.similarities import (
+    cosine_sim,
+    pearson_sim,
+    jaccard_sim
+)
+from libreco.utils.similarities import sk_sim
+try:
+    from libreco.utils.similarities_cy import (
+        cosine_sparse_cy,
+        pearson_sparse_cy
+    )
+except ImportError:
+    cosine_sparse_cy = pearson_sparse_cy = None
+
+SIM_FUNCS = {"cosine": cosine_sim, "pearson": pearson_sim,
+             "jaccard": jaccard_sim}
+SPARSE_CY_FUNCS = {"cosine": cosine_sparse_cy, "pearson": pearson_sparse_cy}
+
+
+def power_law_interactions(n_users, n_items, density, alpha=1.0, seed=42):
+    """Sample a user-item csr matrix whose user activity and item popularity
+    both follow a power law with exponent `alpha`, labels are in [1, 5]."""
+    rng = np.random.default_rng(seed)
+    n_samples = max(1, int(density * n_users * n_items))
+    user_weights = 1.0 / np.arange(1, n_users + 1) ** alpha
+    item_weights = 1.0 / np.arange(1, n_items + 1) ** alpha
+    users = rng.choice(n_users, size=n_samples,
+                       p=user_weights / user_weights.sum())
+    items = rng.choice(n_items, size=n_samples,
+                       p=item_weights / item_weights.sum())
+    # shuffle ids so popular ones don't cluster in the first blocks
+    users = rng.permutation(n_users)[users]
+    items = rng.permutation(n_items)[items]
+    _, unique_index = np.unique(users * n_items + items, return_index=True)
+    labels = rng.integers(1, 6, size=len(unique_index)).astype(np.float32)
+    return csr_matrix((labels, (users[unique_index], items[unique_index])),
+                      shape=(n_users, n_items))
+
+
+def benchmark_cases(user_interaction, sim_types, threads, block_sizes,
+                    min_common):
+    """Yield (description, callable) for every implementation and setting."""
+    n_users, n_items = user_interaction.shape
+    item_interaction = user_interaction.T.tocsr()
+    for sim_type in sim_types:
+        sim_func = SIM_FUNCS[sim_type]
+        yield ({"impl": "new_features", "sim_type": sim_type,
+                "mode": "forward"},
+               lambda f=sim_func: f(item_interaction, user_interaction,
+                                    n_items, n_users, min_common=min_common,
+                                    mode="forward"))
+        for n_threads, block_size in itertools.product(threads, block_sizes):
+            yield ({"impl": "new_features", "sim_type": sim_type,
+                    "mode": "invert", "num_threads": n_threads,
+                    "block_size": block_size},
+                   lambda f=sim_func, t=n_threads, b=block_size: f(
+                       item_interaction, user_interaction, n_items, n_users,
+                       block_size=b or None, num_threads=t,
+                       min_common=min_common, mode="invert"))
+
+        sparse_cy_func = SPARSE_CY_FUNCS.get(sim_type)
+        if sparse_cy_func is not None:
+            yield ({"impl": "libreco_sparse_cy", "sim_type": sim_type},
+                   lambda f=sparse_cy_func: f(n_items, user_interaction,
+                                              min_support=min_common))
+
+    if "cosine" in sim_types:
+        # sk_sim takes dict-of-dicts, built outside the timed call
+        coo = user_interaction.tocoo()
+        user_dict = {u: dict() for u in range(n_users)}
+        for u, i, label in zip(coo.row, coo.col, coo.data):
+            user_dict[u][i] = label
+        yield ({"impl": "libreco_sk_sim", "sim_type": "cosine"},
+               lambda: sk_sim(user_dict, n_items, n_users,
+                              min_support=min_common))
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _run_case(func, queue):
+    base_rss = _peak_rss_mb()
+    result = {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            sim = func()
+            result["seconds"] = time.perf_counter() - start
+        result["nnz"] = int(sim.getnnz() if issparse(sim)
+                            else np.count_nonzero(sim))
+    except Exception as e:
+        result["error"] = repr(e)
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["extra_rss_mb"] = result["peak_rss_mb"] - base_rss
+    queue.put(result)
+
+
+def _wait_result(process, queue, poll_seconds=1.0):
+    # A child killed by the OOM killer or crashed in a kernel never puts
+    # its result, so the queue is polled while the process is alive, and
+    # a failed row with the exit code is returned once it died.
+    while True:
+        try:
+            result = queue.get(timeout=poll_seconds)
+            process.join()
+            return result
+        except Empty:
+            if not process.is_alive():
+                break
+    # the result may have been flushed right before exit
+    try:
+        result = queue.get(timeout=poll_seconds)
+        process.join()
+        return result
+    except Empty:
+        pass
+
+    process.join()
+    exitcode = process.exitcode
+    if exitcode == -signal.SIGKILL:
+        error = "killed by SIGKILL, likely OOM"
+    elif exitcode is not None and exitcode < 0:
+        error = f"killed by {signal.Signals(-exitcode).name}"
+    else:
+        error = f"exited with code {exitcode} without result"
+    return {"error": error, "exitcode": exitcode}
+
+
+def run_benchmark(n_users, n_items, densities, sim_types=("cosine",),
+                  threads=(1,), block_sizes=(0,), min_common=1, alpha=1.0,
+                  seed=42):
+    """Run all cases for every density, returning a list of result dicts."""
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    for density in densities:
+        user_interaction = power_law_interactions(
+            n_users, n_items, density, alpha, seed)
+        for desc, func in benchmark_cases(user_interaction, sim_types,
+                                          threads, block_sizes, min_common):
+            queue = ctx.Queue()
+            process = ctx.Process(target=_run_case, args=(func, queue))
+            process.start()
+            result = _wait_result(process, queue)
+            result.update(desc, n_users=n_users, n_items=n_items,
+                          density=density,
+                          n_interactions=int(user_interaction.nnz))
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    setting = (f"threads={result.get('num_threads', '-')}, "
+               f"block={result.get('block_size', '-')}")
+    if "error" in result:
+        outcome = f"error: {result['error']}"
+    else:
+        outcome = (f"{result['seconds']:8.3f} s, "
+                   f"peak rss {result['peak_rss_mb']:9.1f} MB "
+                   f"(+{result['extra_rss_mb']:.1f}), "
+                   f"nnz {result['nnz']}")
+    print(f"density {result['density']:<8g} {result['impl']:<18} "
+          f"{result['sim_type']:<8} {result.get('mode', '-'):<8} "
+          f"{setting:<22} {outcome}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-users", type=int, default=10000)
+    parser.add_argument("--n-items", type=int, default=2000)
+    parser.add_argument("--density", type=float, nargs="+",
+                        default=[0.001, 0.01])
+    parser.add_argument("--alpha", type=float, default=1.0)
+    parser.add_argument("--sim-types", nargs="+", default=["cosine"],
+                        choices=list(SIM_FUNCS))
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=[0])
+    parser.add_argument("--min-common", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write results to this path")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.n_users, args.n_items, args.density,
+                            args.sim_types, args.threads, args.block_sizes,
+                            args.min_common, args.alpha, args.seed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
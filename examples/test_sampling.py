@@ -0,0 +1,86 @@
+import time
+import numpy as np
+from libreco.utils.sampling import ConsumedPairs, NegativeItemCursor
+
+
+def random_pairs(n_users, n_items, n_pairs, seed=0):
+    rng = np.random.default_rng(seed)
+    user_indices = rng.integers(0, n_users, n_pairs)
+    item_indices = rng.integers(0, n_items, n_pairs)
+    return user_indices, item_indices
+
+
+def check_contains(n_users=2000, n_items=1000, n_pairs=50000):
+    # both bitset layouts must give exactly the answers of np.isin on the keys
+    user_indices, item_indices = random_pairs(n_users, n_items, n_pairs)
+    exact = ConsumedPairs(user_indices, item_indices, n_users, n_items, exact_bits_per_pair=n_users * n_items)
+    hashed = ConsumedPairs(user_indices, item_indices, n_users, n_items, exact_bits_per_pair=0)
+    assert exact.hash_bits is None and hashed.hash_bits is not None
+
+    rng = np.random.default_rng(1)
+    users = np.concatenate([user_indices, rng.integers(0, n_users, 200000)])
+    items = np.concatenate([item_indices, rng.integers(0, n_items, 200000)])
+    expected = np.isin(users.astype(np.int64) * n_items + items, user_indices.astype(np.int64) * n_items + item_indices)
+    for consumed in (exact, hashed):
+        assert np.array_equal(consumed.contains(users, items), expected)
+    print("contains: exact {} bytes, hashed {} bytes, both match np.isin".format(
+        exact.bitset.nbytes, hashed.bitset.nbytes))
+
+
+def check_sample_negatives(n_users=500, n_items=300):
+    # the first users consume all but a few items, so most draws are rejected
+    user_indices, item_indices = random_pairs(n_users, n_items, 20000)
+    heavy_users = np.repeat(np.arange(10), n_items - 3)
+    heavy_items = np.concatenate([np.arange(3, n_items)] * 10)
+    user_indices = np.concatenate([user_indices, heavy_users])
+    item_indices = np.concatenate([item_indices, heavy_items])
+    for exact_bits_per_pair in (64, 0):
+        consumed = ConsumedPairs(user_indices, item_indices, n_users, n_items,
+                                 exact_bits_per_pair=exact_bits_per_pair)
+        users = np.repeat(np.arange(n_users), 50)
+        items = consumed.sample_negatives(users)
+        assert not consumed.contains(users, items).any()
+        assert np.all(items[users < 10] < 3)
+    print("sample_negatives: no consumed pair drawn")
+
+
+def check_cursor_pass(n_users=300, n_items=257):
+    user_indices, item_indices = random_pairs(n_users, n_items, 30000)
+    consumed = ConsumedPairs(user_indices, item_indices, n_users, n_items)
+    cursor = NegativeItemCursor(consumed, n_users, seed=7)
+    rng = np.random.default_rng(2)
+    n_free = n_items - np.bincount(consumed.keys // n_items, minlength=n_users)
+
+    # requests of all users interleaved in several calls, one full pass per user
+    requests = rng.permutation(np.repeat(np.arange(n_users), n_free))
+    drawn = np.concatenate([cursor.draw(part) for part in np.array_split(requests, 7)])
+    users = np.concatenate(np.array_split(requests, 7))
+    for u in range(n_users):
+        items = np.sort(drawn[users == u])
+        unconsumed = np.setdiff1d(np.arange(n_items), consumed.keys[consumed.keys // n_items == u] % n_items)
+        assert np.array_equal(items, unconsumed), "user {} pass is not a permutation".format(u)
+    print("cursor: one pass draws every unconsumed item exactly once")
+
+
+def check_cursor_full_users(n_items=50):
+    # user 0 consumed every item, user 1 only half of them
+    user_indices = np.r_[np.zeros(n_items, dtype=int), np.ones(n_items // 2, dtype=int)]
+    item_indices = np.r_[np.arange(n_items), np.arange(n_items // 2)]
+    consumed = ConsumedPairs(user_indices, item_indices, 2, n_items)
+    cursor = NegativeItemCursor(consumed, 2)
+    assert np.all(cursor.draw([1, 1, 1]) >= n_items // 2)
+    try:
+        cursor.draw([1, 0])
+    except ValueError:
+        print("cursor: raises on users who consumed every item")
+    else:
+        raise AssertionError("drawing for a user who consumed every item should raise")
+
+
+if __name__ == "__main__":
+    t0 = time.time()
+    check_contains()
+    check_sample_negatives()
+    check_cursor_pass()
+    check_cursor_full_users()
+    print("all sampling checks passed in {:.2f}s".format(time.time() - t0))
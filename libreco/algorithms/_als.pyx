@@ -54,7 +54,7 @@ def least_squares_weighted(data, X, Y, reg, n_factors, user=True, num_threads=0)
     if user:
         Cui = data
     else:
-        Cui = data.T
+        Cui = data.T.tocsr()
     _least_squares(Cui.indptr, Cui.indices, Cui.data.astype('float32'),
                    X, Y, reg, num_threads) 
 
@@ -126,11 +126,77 @@ def _least_squares(integral[:] indptr, integral[:] indices, float[:] data,
             free(b)
 
 
+def least_squares_explicit(data, X, Y, reg, n_factors, user=True, num_threads=0):
+    if user:
+        Rui = data
+    else:
+        Rui = data.T.tocsr()
+    _least_squares_explicit(Rui.indptr, Rui.indices, Rui.data.astype('float32'),
+                            X, Y, reg, num_threads)
+
+
+@cython.boundscheck(False)
+def _least_squares_explicit(integral[:] indptr, integral[:] indices, float[:] data,
+                            floating[:, :] X, floating[:, :] Y, double regularization,
+                            int num_threads=0):
+    dtype = np.float64 if floating is double else np.float32
+
+    cdef int users = X.shape[0], factors = X.shape[1], u, i, j, index, err, one = 1
+    cdef floating rating
+
+    cdef floating[:, :] initialA = regularization * np.eye(factors, dtype=dtype)
+    cdef floating[:] initialB = np.zeros(factors, dtype=dtype)
+
+    cdef floating * A
+    cdef floating * b
+
+    with nogil, parallel(num_threads=num_threads):
+        # allocate temp memory for each thread
+        A = <floating *> malloc(sizeof(floating) * factors * factors)
+        b = <floating *> malloc(sizeof(floating) * factors)
+        try:
+            for u in prange(users, schedule='guided'):
+                # keep the previous factors if there are no ratings for this user,
+                # same as the python solvers
+                if indptr[u] == indptr[u+1]:
+                    continue
+
+                # Xu = (YutYu + regularization * I)^-1 * YutRu,
+                # only rated items are involved in explicit case
+                memcpy(A, &initialA[0, 0], sizeof(floating) * factors * factors)
+                memcpy(b, &initialB[0], sizeof(floating) * factors)
+
+                for index in range(indptr[u], indptr[u+1]):
+                    i = indices[index]
+                    rating = data[index]
+
+                    # b += Yi * Rui
+                    axpy(&factors, &rating, &Y[i, 0], &one, b, &one)
+
+                    # A += Yi^T Yi
+                    for j in range(factors):
+                        axpy(&factors, &Y[i, j], &Y[i, 0], &one, A + j * factors, &one)
+
+                err = 0
+                posv("U", &factors, &one, A, &factors, b, &factors, &err)
+
+                if not err:
+                    memcpy(&X[u, 0], b, sizeof(floating) * factors)
+                else:
+                    with gil:
+                        raise ValueError("cython_lapack.posv failed (err=%i) on row %i. Try "
+                                         "increasing the regularization parameter." % (err, u))
+
+        finally:
+            free(A)
+            free(b)
+
+
 def least_squares_weighted_cg(data, X, Y, reg, n_factors, user=True, num_threads=0, cg_steps=3):
     if user:
         Cui = data
     else:
-        Cui = data.T
+        Cui = data.T.tocsr()
     return _least_squares_cg(Cui.indptr, Cui.indices, Cui.data.astype('float32'),
                              X, Y, reg, num_threads, cg_steps)
 
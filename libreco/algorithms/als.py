@@ -20,12 +20,14 @@ import functools
 import itertools
 import logging
 import numpy as np
-from scipy.sparse import csr_matrix, coo_matrix, dok_matrix
+from scipy.sparse import csr_matrix
 from ..utils.initializers import truncated_normal
+from ..evaluate import recall_at_k
 from .base import BasePure
 try:
     from . import Als_cy
 except ImportError:
+    Als_cy = None
     LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
     logging.basicConfig(format=LOG_FORMAT)
     logging.warn("Cython version is not available")
@@ -42,9 +44,21 @@ class Als(BasePure):
         self.seed = seed
         self.alpha = alpha
         self.neg_sampling = neg_sampling
+        self.fold_in_consumed = dict()
+        self._YtY = None
+        self.history = None
+        self.quantized_X = None
+        self.quantized_Y = None
         super(Als, self).__init__()
 
-    def fit(self, dataset, verbose=1, use_cg=False, cg_steps=3, use_cython=True, **kwargs):
+    def fit(self, dataset, verbose=1, use_cg=False, cg_steps=3, use_cython=True, sparse_interaction=None,
+            tol=None, patience=1, **kwargs):
+        """Alternate user and item sweeps for at most `n_epochs` epochs.
+
+        Regularized training loss and time of every epoch are recorded in `self.history`.
+        If `tol` is given, training stops when the loss hasn't decreased by more than
+        `tol` relative to the best loss for `patience` epochs.
+        """
         np.random.seed(self.seed)
         self.dataset = dataset
         self.global_mean = dataset.global_mean
@@ -59,16 +73,29 @@ class Als(BasePure):
                                    mean=0.0, scale=0.05).astype(np.float32)
         self.Y = truncated_normal(shape=(dataset.n_items, self.n_factors),
                                    mean=0.0, scale=0.05).astype(np.float32)
+        self.fold_in_consumed = dict()
+        self._YtY = None
+        self.quantized_X = None
+        self.quantized_Y = None
 
         if self.task == "ranking":
             t0 = time.time()
-            confidence_data = dok_matrix((dataset.n_users, dataset.n_items), dtype=np.float32)
-            for u, i, l in zip(dataset.train_user_indices, dataset.train_item_indices, dataset.train_labels):
-                confidence_data[u, i] = self.alpha * l + 1
-            confidence_data = confidence_data.tocsr()
-            print("sparse matrix constrtct time: ", time.time() - t0)
+            confidence_data = self._build_confidence(dataset, sparse_interaction)
+            print("sparse matrix construct time: ", time.time() - t0)
 
         if self.task == "rating":
+            rating_data = csr_matrix(
+                (np.asarray(dataset.train_labels, dtype=np.float32),
+                 (dataset.train_user_indices, dataset.train_item_indices)),
+                shape=(dataset.n_users, dataset.n_items))
+
+        if use_cython and Als_cy is None:
+            # extension not compiled, use the python solvers
+            use_cython = False
+
+        if self.task == "rating" and use_cython:
+            method = functools.partial(Als_cy.least_squares_explicit, data=rating_data, num_threads=0)
+        elif self.task == "rating":
             method = Als.least_squares
         elif self.task == "ranking" and use_cg:
             if use_cython:
@@ -84,20 +111,28 @@ class Als(BasePure):
             else:
                 method = functools.partial(Als.least_squares_weighted, dataset=self.dataset, alpha=self.alpha)
 
-
+        loss_data = rating_data if self.task == "rating" else confidence_data
+        self.history = {"epoch": [], "loss": [], "time": []}
+        best_loss, no_improve = None, 0
         for epoch in range(1, self.n_epochs + 1):
             t0 = time.time()
 
-            if self.task == "rating":
+            if self.task == "rating" and not use_cython:
                 method(self.dataset, self.X, self.Y, reg=self.reg, n_factors=self.n_factors, user=True)
                 method(self.dataset, self.Y, self.X, reg=self.reg, n_factors=self.n_factors, user=False)
 
-            elif self.task == "ranking":
+            else:
                 method(X=self.X, Y=self.Y, reg=self.reg, n_factors=self.n_factors, user=True)
                 method(X=self.Y, Y=self.X, reg=self.reg, n_factors=self.n_factors, user=False)
 
+            train_time = time.time() - t0
+            loss = Als.loss(loss_data, self.X, self.Y, self.reg, self.task)
+            self.history["epoch"].append(epoch)
+            self.history["loss"].append(loss)
+            self.history["time"].append(train_time)
+
             if verbose >= 1:
-                print("Epoch {}: training time: {:.4f}".format(epoch, time.time() - t0))
+                print("Epoch {}: training time: {:.4f}, train loss: {:.4f}".format(epoch, train_time, loss))
                 if verbose > 1:
                     metrics = kwargs.get("metrics", self.metrics)
                     if hasattr(self, "sess"):
@@ -106,8 +141,40 @@ class Als(BasePure):
                         self.print_metrics(dataset, epoch, verbose, **metrics)
                     print()
 
+            if tol is None:
+                continue
+            if best_loss is None or best_loss - loss > tol * abs(best_loss):
+                best_loss, no_improve = loss, 0
+            else:
+                no_improve += 1
+                if no_improve >= patience:
+                    if verbose >= 1:
+                        print("early stopping at epoch {}, train loss didn't improve more than {} "
+                              "in {} epoch(s)".format(epoch, tol, patience))
+                    break
+
         return self
 
+    def _build_confidence(self, dataset, sparse_interaction=None):
+        # Confidence is 1 + alpha * label, duplicate (user, item) labels are summed.
+        # A prebuilt user-item csr matrix, e.g. TransformedSet.sparse_interaction,
+        # shares its indices and indptr with the result, only data are allocated.
+        if sparse_interaction is not None:
+            sparse_interaction = sparse_interaction.tocsr()
+            if not sparse_interaction.has_canonical_format:
+                sparse_interaction.sum_duplicates()
+            data = (self.alpha * sparse_interaction.data + 1).astype(np.float32)
+            return csr_matrix((data, sparse_interaction.indices, sparse_interaction.indptr),
+                              shape=sparse_interaction.shape, copy=False)
+
+        confidence_data = csr_matrix(
+            (np.asarray(dataset.train_labels, dtype=np.float32),
+             (dataset.train_user_indices, dataset.train_item_indices)),
+            shape=(dataset.n_users, dataset.n_items))
+        confidence_data.sum_duplicates()
+        confidence_data.data = self.alpha * confidence_data.data + 1
+        return confidence_data
+
     def predict(self, u, i):
         try:
             pred = np.dot(self.X[u], self.Y[i])
@@ -121,13 +188,160 @@ class Als(BasePure):
         return pred
 
     def recommend_user(self, u, n_rec):
-        consumed = self.dataset.train_user[u]
+        if u in self.fold_in_consumed:
+            consumed = self.fold_in_consumed[u]
+        else:
+            consumed = self.dataset.train_user[u]
         count = n_rec + len(consumed)
-        preds = np.dot(self.X[u], self.Y.T)
+        if self.quantized_Y is not None:
+            preds = self._quantized_scores(u)
+        else:
+            preds = np.dot(self.X[u], self.Y.T)
         ids = np.argpartition(preds, -count)[-count:]
         rank = sorted(zip(ids, preds[ids]), key=lambda x: -x[1])
         return list(itertools.islice((rec for rec in rank if rec[0] not in consumed), n_rec))
 
+    def quantize_factors(self, dtype="int8", k=10, sample_user=None, block_size=65536):
+        """Keep reduced-precision copies of X and Y for serving.
+
+        `dtype` is "float16", or "int8" which stores every row as round(row / scale) with a
+        float32 per-row scale of max(abs(row)) / 127. After this, `recommend_user` scores items
+        from the quantized tables, casting `block_size` rows of Y to float32 at a time.
+
+        Returns memory of full and quantized factors in bytes, and recall@k of both on the test
+        data of the fitted dataset, see `evaluate.recall_at_k`, with their delta.
+        """
+        if dtype not in ("float16", "int8"):
+            raise ValueError("dtype must either be 'float16' or 'int8'")
+        self.quantized_X = self.quantized_Y = None
+        recall_full = recall_at_k(self, self.dataset, k, sample_user)
+        self.quantized_X = Als._quantize(self.X, dtype)
+        self.quantized_Y = Als._quantize(self.Y, dtype)
+        self.quantize_block_size = block_size
+        recall_quantized = recall_at_k(self, self.dataset, k, sample_user)
+
+        report = {"dtype": dtype,
+                  "full_bytes": self.X.nbytes + self.Y.nbytes,
+                  "quantized_bytes": sum(values.nbytes + (scale.nbytes if scale is not None else 0)
+                                         for values, scale in (self.quantized_X, self.quantized_Y)),
+                  "recall_full": recall_full,
+                  "recall_quantized": recall_quantized,
+                  "recall_delta": recall_quantized - recall_full}
+        print("{} factors: {} bytes, full precision: {} bytes, recall@{} delta: {:.4f}".format(
+            dtype, report["quantized_bytes"], report["full_bytes"], k, report["recall_delta"]))
+        return report
+
+    @staticmethod
+    def _quantize(factors, dtype):
+        factors = np.asarray(factors, dtype=np.float32)
+        if dtype == "float16":
+            return factors.astype(np.float16), None
+        elif dtype == "int8":
+            scale = np.abs(factors).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            return np.rint(factors / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+        else:
+            raise ValueError("dtype must either be 'float16' or 'int8'")
+
+    def _quantized_scores(self, u):
+        # users appended by fold_in_users after quantizing only have full precision factors
+        X_values, X_scale = self.quantized_X
+        if u < len(X_values):
+            user_vector = X_values[u].astype(np.float32)
+            if X_scale is not None:
+                user_vector *= X_scale[u]
+        else:
+            user_vector = self.X[u].astype(np.float32)
+
+        # only one float32 block of item factors exists at a time,
+        # per-row scale of int8 is applied to the block scores
+        Y_values, Y_scale = self.quantized_Y
+        preds = np.empty(len(Y_values), dtype=np.float32)
+        for start in range(0, len(Y_values), self.quantize_block_size):
+            end = min(start + self.quantize_block_size, len(Y_values))
+            preds[start:end] = Y_values[start:end].astype(np.float32).dot(user_vector)
+            if Y_scale is not None:
+                preds[start:end] *= Y_scale[start:end]
+        return preds
+
+    def fold_in_users(self, interactions, append=False, use_cg=False, cg_steps=3):
+        """Compute factors of new users against the fixed item factors Y.
+
+        `interactions` is a list of {item: label} dicts, one for each new user,
+        same as the values of `dataset.train_user`. Only these users' regularized
+        least squares of `fit` are solved, explicit for rating task, confidence
+        weighted for ranking task, in which `use_cg` runs `cg_steps` conjugate
+        gradient steps from zero instead of an exact solve. Unknown items are ignored.
+
+        Returns the new factors, or with `append=True`, appends them to X so
+        `predict` and `recommend_user` work, and returns the new user indices.
+        """
+        Y = self.Y
+        reg_eye = self.reg * np.eye(self.n_factors, dtype=Y.dtype)
+        if self.task == "ranking" and self._YtY is None:
+            self._YtY = Y.T.dot(Y)
+
+        factors = np.zeros((len(interactions), self.n_factors), dtype=np.float32)
+        for n, user_labels in enumerate(interactions):
+            pairs = [(i, l) for i, l in user_labels.items() if 0 <= i < len(Y)]
+            if not pairs:
+                continue
+            items, labels = map(np.asarray, zip(*pairs))
+            Yu = Y[items]
+            if self.task == "rating":
+                factors[n] = np.linalg.solve(Yu.T.dot(Yu) + reg_eye, Yu.T.dot(labels))
+                continue
+
+            confidence = 1 + self.alpha * labels
+            A = self._YtY + reg_eye + (Yu.T * (confidence - 1)).dot(Yu)
+            b = Yu.T.dot(confidence)
+            if not use_cg:
+                factors[n] = np.linalg.solve(A, b)
+                continue
+
+            x = np.zeros(self.n_factors)
+            r = b.copy()
+            p = r.copy()
+            rs_old = r.dot(r)
+            for _ in range(cg_steps):
+                if rs_old < 1e-10:
+                    break
+                Ap = A.dot(p)
+                step = rs_old / p.dot(Ap)
+                x += step * p
+                r -= step * Ap
+                rs_new = r.dot(r)
+                p = r + (rs_new / rs_old) * p
+                rs_old = rs_new
+            factors[n] = x
+
+        if not append:
+            return factors
+        new_users = np.arange(len(self.X), len(self.X) + len(factors))
+        self.X = np.vstack([self.X, factors])
+        for u, user_labels in zip(new_users, interactions):
+            self.fold_in_consumed[int(u)] = user_labels
+        return new_users
+
+    @staticmethod
+    def loss(data, X, Y, reg, task, chunk_nnz=2 ** 20):
+        # Regularized training objective divided by number of interactions, `data` is the
+        # user-item csr matrix of ratings or confidence. Unobserved pairs in ranking task have
+        # confidence 1 and preference 0, their sum((XY^T)^2) equals sum(XtX * YtY).
+        loss = 0.0
+        for start in range(0, data.nnz, chunk_nnz):
+            end = min(start + chunk_nnz, data.nnz)
+            rows = np.searchsorted(data.indptr, np.arange(start, end), side="right") - 1
+            preds = np.einsum("ij,ij->i", X[rows], Y[data.indices[start:end]])
+            if task == "rating":
+                loss += np.sum((data.data[start:end] - preds) ** 2)
+            else:
+                loss += np.sum(data.data[start:end] * (1 - preds) ** 2 - preds ** 2)
+        if task == "ranking":
+            loss += np.sum(X.T.dot(X) * Y.T.dot(Y))
+        loss += reg * (np.sum(X ** 2) + np.sum(Y ** 2))
+        return float(loss) / max(1, data.nnz)
+
     @staticmethod
     def least_squares(dataset, X, Y, reg, n_factors, user=True):
         if user:
@@ -139,7 +353,7 @@ class Als(BasePure):
             consumed = np.array(list(data[s].keys()))
             labels = np.array(list(data[s].values()))
             A = Y[consumed].T.dot(Y[consumed]) + \
-                     reg * np.eye(n_factors)
+                     reg * np.eye(n_factors, dtype=Y.dtype)
             b = Y[consumed].T.dot(labels)
             X[s] = np.linalg.solve(A, b)
 
@@ -152,8 +366,8 @@ class Als(BasePure):
 
         YtY = Y.T.dot(Y)
         for s in data:
-            A = YtY + reg * np.eye(n_factors)
-            b = np.zeros(n_factors)
+            A = YtY + reg * np.eye(n_factors, dtype=Y.dtype)
+            b = np.zeros(n_factors, dtype=Y.dtype)
             for i in data[s]:
                 factor = Y[i]
                 confidence = 1 + alpha * data[s][i]
@@ -171,7 +385,7 @@ class Als(BasePure):
         else:
             data = dataset.train_item
 
-        YtY = Y.T.dot(Y) + reg * np.eye(n_factors)
+        YtY = Y.T.dot(Y) + reg * np.eye(n_factors, dtype=Y.dtype)
         for s in data:
             x = X[s]
             r = -YtY.dot(x)
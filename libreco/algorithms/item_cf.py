@@ -1,6 +1,7 @@
 import time, sys
 from operator import itemgetter
 import numpy as np
+from scipy.sparse import csr_matrix
 from ..utils.similarities import *
 from ..utils.baseline_estimates import baseline_als, baseline_sgd
 from .base import BasePure
@@ -8,6 +9,10 @@ try:
     from ..utils.similarities_cy import cosine_cy, pearson_cy
 except ImportError:
     pass
+try:
+    from ..utils.similarities_cy import cosine_sparse_cy, pearson_sparse_cy
+except ImportError:
+    cosine_sparse_cy = pearson_sparse_cy = None
 import logging
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 logging.basicConfig(format=LOG_FORMAT)
@@ -17,13 +22,21 @@ logging.warning("Item KNN method requires huge memory for constructing similarit
 
 
 class itemCF(BasePure):
-    def __init__(self, sim_option="pearson", k=50, min_support=1, baseline=True, task="rating", neg_sampling=False):
+    def __init__(self, sim_option="pearson", k=50, min_support=1, baseline=True, task="rating", neg_sampling=False,
+                 sparse=True):
         self.k = k
         self.min_support = min_support
         self.baseline = baseline
         self.task = task
         self.neg_sampling = neg_sampling
-        if sim_option == "cosine":
+        # sparse co-occurrence engine, only observed pairs are stored.
+        # falls back to the dense similarities if the cython extension isn't built
+        self.sparse = sparse and sim_option in ("cosine", "pearson") and cosine_sparse_cy is not None
+        if sim_option == "cosine" and self.sparse:
+            self.sim_option = cosine_sparse_cy
+        elif sim_option == "pearson" and self.sparse:
+            self.sim_option = pearson_sparse_cy
+        elif sim_option == "cosine":
             self.sim_option = cosine_cy  # cosine_sim
         elif sim_option == "pearson":
             self.sim_option = pearson_sim  # pearson_cy
@@ -46,13 +59,17 @@ class itemCF(BasePure):
             self.upper_bound = None
 
         t0 = time.time()
-        if self.sim_option == sk_sim:
+        if self.sparse:
+            sparse_data = csr_matrix((dataset.train_labels, (dataset.train_user_indices, dataset.train_item_indices)),
+                                     shape=(dataset.n_users, dataset.n_items), dtype=np.float32)
+            self.sim = self.sim_option(dataset.n_items, sparse_data, min_support=self.min_support)
+        elif self.sim_option == sk_sim:
             self.sim = self.sim_option(self.train_user, dataset.n_users, dataset.n_items,
                                        min_support=self.min_support, sparse=True)
         else:
             user_item_list = {k: list(v.items()) for k, v in dataset.train_user.items()}
             self.sim = self.sim_option(dataset.n_items, user_item_list, min_support=self.min_support)
-            self.sim = np.array(self.sim)
+            self.sim = np.asarray(self.sim)
 
         #    n = len(self.train_item)
         #    ids = list(self.train_item.keys())
@@ -76,14 +93,17 @@ class itemCF(BasePure):
         return self
 
     def predict(self, u, i):
-        if self.sim_option == sk_sim:
-            i_nonzero_neighbors = set(self.sim.rows[i])
+        if self.sparse:
+            i_slice = slice(self.sim.indptr[i], self.sim.indptr[i + 1])
+            i_neighbor_sims = dict(zip(self.sim.indices[i_slice], self.sim.data[i_slice]))
+        elif self.sim_option == sk_sim:
+            i_neighbor_sims = dict(zip(self.sim.rows[i], self.sim.data[i]))
         else:
-            i_nonzero_neighbors = set(np.where(self.sim[i] != 0.0)[0])
+            i_neighbor_sims = {j: self.sim[i, j] for j in np.where(self.sim[i] != 0.0)[0]}
 
         try:
-            neighbors = [(j, self.sim[i, j], r) for (j, r) in self.train_user[u].items()
-                         if j in i_nonzero_neighbors and i != j]
+            neighbors = [(j, i_neighbor_sims[j], r) for (j, r) in self.train_user[u].items()
+                         if j in i_neighbor_sims and i != j]
             k_neighbors = sorted(neighbors, key=lambda x: x[1], reverse=True)[:self.k]
             if self.baseline and self.task == "rating":
                 bui = self.global_mean + self.bu[u] + self.bi[i]
@@ -132,12 +152,18 @@ class itemCF(BasePure):
 
         for i, _ in u_items:
             i = int(i)
-            if self.sim_option == sk_sim and len(self.sim.rows[i]) <= 1:  # no neighbors, just herself
+            if self.sparse and self.sim.indptr[i + 1] - self.sim.indptr[i] <= 1:  # just herself
+                continue
+            elif self.sim_option == sk_sim and len(self.sim.rows[i]) <= 1:  # no neighbors, just herself
                 continue
-            elif self.sim_option != sk_sim and len(np.where(self.sim[i] != 0.0)[0]) <= 1:
+            elif not self.sparse and self.sim_option != sk_sim and len(np.where(self.sim[i] != 0.0)[0]) <= 1:
                 continue
 
-            if self.sim_option == sk_sim:
+            if self.sparse:
+                i_slice = slice(self.sim.indptr[i], self.sim.indptr[i + 1])
+                indices = np.argsort(self.sim.data[i_slice])[::-1][1: self.k + 1]
+                k_neighbors = self.sim.indices[i_slice][indices]
+            elif self.sim_option == sk_sim:
                 indices = np.argsort(self.sim[i].data[0])[::-1][1: self.k + 1]
                 k_neighbors = np.array(self.sim.rows[i])[indices]
             else:
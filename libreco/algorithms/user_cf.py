@@ -1,6 +1,7 @@
 import time, os, sys
 from operator import itemgetter
 import numpy as np
+from scipy.sparse import csr_matrix
 from ..utils.similarities import *
 from ..utils.baseline_estimates import baseline_als, baseline_sgd
 from .base import BasePure
@@ -8,6 +9,10 @@ try:
     from ..utils.similarities_cy import cosine_cy, pearson_cy
 except ImportError:
     pass
+try:
+    from ..utils.similarities_cy import cosine_sparse_cy, pearson_sparse_cy
+except ImportError:
+    cosine_sparse_cy = pearson_sparse_cy = None
 import logging
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 logging.basicConfig(format=LOG_FORMAT)
@@ -17,13 +22,21 @@ logging.warning("User KNN method requires huge memory for constructing similarit
 
 
 class userCF(BasePure):
-    def __init__(self, sim_option="pearson", k=50, min_support=1, baseline=True, task="rating", neg_sampling=False):
+    def __init__(self, sim_option="pearson", k=50, min_support=1, baseline=True, task="rating", neg_sampling=False,
+                 sparse=True):
         self.k = k
         self.min_support = min_support
         self.baseline = baseline
         self.task = task
         self.neg_sampling = neg_sampling
-        if sim_option == "cosine":
+        # sparse co-occurrence engine, only observed pairs are stored.
+        # falls back to the dense similarities if the cython extension isn't built
+        self.sparse = sparse and sim_option in ("cosine", "pearson") and cosine_sparse_cy is not None
+        if sim_option == "cosine" and self.sparse:
+            self.sim_option = cosine_sparse_cy
+        elif sim_option == "pearson" and self.sparse:
+            self.sim_option = pearson_sparse_cy
+        elif sim_option == "cosine":
             self.sim_option = cosine_cy  # cosine_sim
         elif sim_option == "pearson":
             self.sim_option = pearson_cy  # pearson_cy
@@ -47,7 +60,11 @@ class userCF(BasePure):
 
 
         t0 = time.time()
-        if self.sim_option == sk_sim:
+        if self.sparse:
+            sparse_data = csr_matrix((dataset.train_labels, (dataset.train_item_indices, dataset.train_user_indices)),
+                                     shape=(dataset.n_items, dataset.n_users), dtype=np.float32)
+            self.sim = self.sim_option(dataset.n_users, sparse_data, min_support=self.min_support)
+        elif self.sim_option == sk_sim:
             self.sim = self.sim_option(self.train_item, dataset.n_users, dataset.n_items,
                                        min_support=self.min_support, sparse=True)
         else:
@@ -78,13 +95,16 @@ class userCF(BasePure):
         return self
 
     def predict(self, u, i):
-        if self.sim_option == sk_sim:
-            u_nonzero_neighbors = set(self.sim.rows[u])
+        if self.sparse:
+            u_slice = slice(self.sim.indptr[u], self.sim.indptr[u + 1])
+            u_neighbor_sims = dict(zip(self.sim.indices[u_slice], self.sim.data[u_slice]))
+        elif self.sim_option == sk_sim:
+            u_neighbor_sims = dict(zip(self.sim.rows[u], self.sim.data[u]))
         else:
-            u_nonzero_neighbors = set(np.where(self.sim[u] != 0.0)[0])
+            u_neighbor_sims = {v: self.sim[u, v] for v in np.where(self.sim[u] != 0.0)[0]}
         try:
-            neighbors = [(v, self.sim[u, v], r) for (v, r) in self.train_item[i].items()
-                         if v in u_nonzero_neighbors and u != v]
+            neighbors = [(v, u_neighbor_sims[v], r) for (v, r) in self.train_item[i].items()
+                         if v in u_neighbor_sims and u != v]
             k_neighbors = sorted(neighbors, key=lambda x: x[1], reverse=True)[:self.k]
             if self.baseline and self.task == "rating":
                 bui = self.global_mean + self.bu[u] + self.bi[i]
@@ -125,13 +145,19 @@ class userCF(BasePure):
             return sim_sums
 
     def recommend_user(self, u, n_rec, like_score=4.0, random_rec=False):
-        if self.sim_option == sk_sim and len(self.sim.rows[u]) <= 1:  # no neighbors, just herself
+        if self.sparse and self.sim.indptr[u + 1] - self.sim.indptr[u] <= 1:  # just herself
+            return -1
+        elif self.sim_option == sk_sim and len(self.sim.rows[u]) <= 1:  # no neighbors, just herself
             return -1
-        elif self.sim_option != sk_sim and len(np.where(self.sim[u] != 0.0)[0]) <= 1:
+        elif not self.sparse and self.sim_option != sk_sim and len(np.where(self.sim[u] != 0.0)[0]) <= 1:
             return -1
 
         rank = set()
-        if self.sim_option == sk_sim:
+        if self.sparse:
+            u_slice = slice(self.sim.indptr[u], self.sim.indptr[u + 1])
+            indices = np.argsort(self.sim.data[u_slice])[::-1][1: self.k + 1]
+            k_neighbors = self.sim.indices[u_slice][indices]
+        elif self.sim_option == sk_sim:
             indices = np.argsort(self.sim[u].data[0])[::-1][1: self.k + 1]
             k_neighbors = np.array(self.sim.rows[u])[indices]
         else:
@@ -4,6 +4,142 @@ from multiprocessing import Pool
 import numpy as np
 
 
+class ConsumedPairs:
+    """Vectorized membership test of consumed (user, item) pairs, used to draw
+    negative items for whole arrays of users at once.
+
+    Pairs are stored as sorted int64 keys `user * n_items + item`. A bitset
+    indexed by the key answers queries exactly if the `n_users * n_items` bits
+    fit in `max_bitset_bytes` and take at most `exact_bits_per_pair` bits per
+    pair, otherwise the bitset is indexed by a multiplicative hash of the key
+    (about 16 bits per pair) and its hits are confirmed by binary search in the
+    sorted keys.
+    """
+
+    def __init__(self, user_indices, item_indices, n_users, n_items, max_bitset_bytes=2 ** 28,
+                 exact_bits_per_pair=64):
+        self.n_items = n_items
+        keys = np.sort(np.asarray(user_indices, dtype=np.int64) * n_items
+                       + np.asarray(item_indices, dtype=np.int64))
+        self.keys = keys[np.diff(keys, prepend=-1) != 0]
+
+        max_bits = 8 * max_bitset_bytes
+        if n_users * n_items <= min(max_bits, exact_bits_per_pair * len(self.keys)):
+            self.hash_bits = None
+            n_bits = n_users * n_items
+        else:
+            self.hash_bits = min(int(np.ceil(np.log2(max(64, 16 * len(self.keys))))),
+                                 int(np.log2(max_bits)))
+            n_bits = 1 << self.hash_bits
+        self.bitset = np.zeros((n_bits + 7) // 8, dtype=np.uint8)
+
+        # set all bits falling in the same byte at once
+        slots = np.sort(self._slots(self.keys))
+        if len(slots) > 0:
+            byte_index = slots >> 3
+            starts = np.flatnonzero(np.r_[True, byte_index[1:] != byte_index[:-1]])
+            self.bitset[byte_index[starts]] = np.bitwise_or.reduceat(
+                np.left_shift(1, slots & 7).astype(np.uint8), starts)
+
+    def _slots(self, keys):
+        if self.hash_bits is None:
+            return keys
+        # Fibonacci hashing, uint64 multiplication wraps around
+        hashed = keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return (hashed >> np.uint64(64 - self.hash_bits)).astype(np.int64)
+
+    def contains(self, users, items):
+        keys = np.asarray(users, dtype=np.int64) * self.n_items + np.asarray(items, dtype=np.int64)
+        slots = self._slots(keys)
+        hit = ((self.bitset[slots >> 3] >> (slots & 7)) & 1).astype(bool)
+        if self.hash_bits is not None:
+            candidates = np.flatnonzero(hit)
+            pos = np.searchsorted(self.keys, keys[candidates])
+            pos[pos == len(self.keys)] = 0
+            hit[candidates] = self.keys[pos] == keys[candidates]
+        return hit
+
+    def sample_negatives(self, users):
+        # draw one item for every user, then redraw only the consumed ones
+        users = np.asarray(users, dtype=np.int64)
+        items = np.random.randint(0, self.n_items, len(users))
+        redraw = np.flatnonzero(self.contains(users, items))
+        while len(redraw) > 0:
+            items[redraw] = np.random.randint(0, self.n_items, len(redraw))
+            redraw = redraw[self.contains(users[redraw], items[redraw])]
+        return items
+
+
+class NegativeItemCursor:
+    """Per-user sampling of negative items without replacement.
+
+    Every user walks its own pseudo-random permutation of the item ids, a 4-round Feistel
+    network over the smallest even power of two covering n_items, keyed by (seed, user, pass).
+    Positions mapping to ids >= n_items or to consumed items are skipped, so each unconsumed
+    item is drawn exactly once per pass, after which the user starts a new pass with a new key.
+    The state is a cursor and a pass number per user.
+    """
+
+    def __init__(self, consumed, n_users, seed=42):
+        self.consumed = consumed
+        self.n_items = consumed.n_items
+        self.half_bits = max(1, int(np.ceil(np.log2(max(2, self.n_items)) / 2)))
+        self.domain = 1 << (2 * self.half_bits)
+        self.seed = seed
+        self.cursor = np.zeros(n_users, dtype=np.int64)
+        self.passes = np.zeros(n_users, dtype=np.int64)
+        n_consumed = np.bincount(consumed.keys // self.n_items, minlength=n_users)
+        self.full_users = n_consumed >= self.n_items
+
+    @staticmethod
+    def _mix(x):
+        # splitmix64 finalizer, uint64 multiplication wraps around
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+    def _permute(self, positions, users):
+        h = np.uint64(self.half_bits)
+        mask = np.uint64((1 << self.half_bits) - 1)
+        keys = self._mix(np.uint64(self.seed) ^ self._mix(users.astype(np.uint64))
+                         ^ (self.passes[users].astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)))
+        positions = positions.astype(np.uint64)
+        left, right = positions >> h, positions & mask
+        for r in range(4):
+            round_keys = keys + np.uint64(r * 0x9E3779B97F4A7C15 % 2 ** 64)
+            left, right = right, left ^ (self._mix(right ^ round_keys) & mask)
+        return ((left << h) | right).astype(np.int64)
+
+    def draw(self, users):
+        # one item for every entry of users, entries of the same user get distinct items
+        # unless the user's pass ends in between
+        users = np.asarray(users, dtype=np.int64)
+        if np.any(self.full_users[users]):
+            raise ValueError("some users have consumed all items, no negative item to sample")
+        items = np.empty(len(users), dtype=np.int64)
+        pending = np.argsort(users, kind="stable")
+        while len(pending) > 0:
+            pending_users = users[pending]
+            # k-th pending request of a user takes position cursor + k
+            group_start = np.flatnonzero(np.r_[True, pending_users[1:] != pending_users[:-1]])
+            group_size = np.diff(np.r_[group_start, len(pending)])
+            rank = np.arange(len(pending)) - np.repeat(group_start, group_size)
+            positions = self.cursor[pending_users] + rank
+            in_pass = positions < self.domain
+            candidates = self._permute(np.minimum(positions, self.domain - 1), pending_users)
+            valid = in_pass & (candidates < self.n_items)
+            valid[valid] = ~self.consumed.contains(pending_users[valid], candidates[valid])
+            items[pending[valid]] = candidates[valid]
+
+            group_users = pending_users[group_start]
+            self.cursor[group_users] = np.minimum(self.cursor[group_users] + group_size, self.domain)
+            finished = group_users[self.cursor[group_users] == self.domain]
+            self.cursor[finished] = 0
+            self.passes[finished] += 1
+            pending = pending[~valid]
+        return items
+
+
 class NegativeSampling:
     def __init__(self, dataset, num_neg, batch_size=64, seed=42, replacement_sampling=True):
         self.dataset = dataset
@@ -12,13 +148,13 @@ class NegativeSampling:
         self.seed = seed
         self.i = 0
         self.item_pool = defaultdict(set)
+        self.consumed = ConsumedPairs(dataset.train_user_indices, dataset.train_item_indices,
+                                      dataset.n_users, dataset.n_items)
         if not replacement_sampling:
             self.__init_sampling()
 
     def __init_sampling(self):
-        self.user_negative_pool = {}
-        for u in self.dataset.train_user:
-            self.user_negative_pool[u] = list(set(range(self.dataset.n_items)) - set(self.dataset.train_user[u]))
+        self.negative_cursor = NegativeItemCursor(self.consumed, self.dataset.n_users, self.seed)
 
     def __call__(self, mode):
         if mode == "train":
@@ -49,13 +185,8 @@ class NegativeSampling:
         user_implicit = np.tile(user_indices, self.num_neg + 1)
         label_negative = np.zeros(len(user_indices) * self.num_neg, dtype=np.float32)
         label_implicit = np.concatenate([label_indices, label_negative])
-        item_negative = []
-        for u, i in zip(user_indices, item_indices):
-            for _ in range(self.num_neg):
-                item_neg = np.random.randint(0, self.dataset.n_items)
-                while item_neg in self.dataset.train_user[u]:
-                    item_neg = np.random.randint(0, self.dataset.n_items)
-                item_negative.append(item_neg)
+        # negatives are drawn for the tiled users, so they line up with user_implicit
+        item_negative = self.consumed.sample_negatives(np.tile(user_indices, self.num_neg))
         item_implicit = np.concatenate([item_indices, item_negative])
         return user_implicit, item_implicit, label_implicit
 
@@ -66,26 +197,9 @@ class NegativeSampling:
         batch_pos_item = self.dataset.train_item_indices[self.i * batch_size: end]
         batch_pos_label = self.dataset.train_labels[self.i * batch_size: end]
 
-        batch_user_indices, batch_item_indices, batch_label_indices = [], [], []
-        for i, u in enumerate(batch_pos_user):
-            batch_user_indices.append(batch_pos_user[i])
-            batch_item_indices.append(batch_pos_item[i])
-            batch_label_indices.append(batch_pos_label[i])
-
-            batch_user_indices.extend([u] * self.num_neg)
-            item_neg = np.random.choice(self.user_negative_pool[u], self.num_neg, replace=False)
-            batch_item_indices.extend(item_neg)
-            batch_label_indices.extend([0.0] * self.num_neg)
-            self.user_negative_pool[u] = list(set(self.user_negative_pool[u]) - set(item_neg))
-            if len(self.user_negative_pool[u]) < self.num_neg + 1:
-                self.user_negative_pool[u] = list(set(range(self.dataset.n_items)) - set(self.dataset.train_user[u]))
-                print("negative pool exhausted")
-
+        item_neg = self.negative_cursor.draw(np.repeat(batch_pos_user, self.num_neg))
         self.i += 1
-        indices = np.random.permutation(len(batch_user_indices))
-        return np.array(batch_user_indices)[indices], \
-               np.array(batch_item_indices)[indices], \
-               np.array(batch_label_indices)[indices]
+        return self.__stack_batch(batch_pos_user, batch_pos_item, batch_pos_label, item_neg)
 
     def next_batch(self):
         batch_size = int(self.batch_size / (self.num_neg + 1))
@@ -94,27 +208,20 @@ class NegativeSampling:
         batch_pos_item = self.dataset.train_item_indices[self.i * batch_size: end]
         batch_pos_label = self.dataset.train_labels[self.i * batch_size: end]
 
-        batch_user_indices, batch_item_indices, batch_label_indices = [], [], []
-        for i, u in enumerate(batch_pos_user):
-            batch_user_indices.append(batch_pos_user[i])
-            batch_item_indices.append(batch_pos_item[i])
-            batch_label_indices.append(batch_pos_label[i])
-
-            for _ in range(self.num_neg):
-                item_neg = np.random.randint(0, self.dataset.n_items)
-                #        while item_neg in self.dataset.train_user[u]:
-                while self.dataset.train_user[u].__contains__(item_neg):
-                    item_neg = np.random.randint(0, self.dataset.n_items)  # resample
+        item_neg = self.consumed.sample_negatives(np.repeat(batch_pos_user, self.num_neg))
+        self.i += 1
+        return self.__stack_batch(batch_pos_user, batch_pos_item, batch_pos_label, item_neg)
 
-                batch_user_indices.append(u)
-                batch_item_indices.append(item_neg)
-                batch_label_indices.append(0.0)
+    def __stack_batch(self, batch_pos_user, batch_pos_item, batch_pos_label, item_neg):
+        # every positive is followed by its num_neg negatives, same layout as looped sampling
+        batch_user_indices = np.repeat(batch_pos_user, self.num_neg + 1)
+        batch_item_indices = np.column_stack(
+            [batch_pos_item, item_neg.reshape(-1, self.num_neg)]).ravel()
+        batch_label_indices = np.column_stack(
+            [batch_pos_label, np.zeros((len(batch_pos_label), self.num_neg))]).ravel()
 
-        self.i += 1
         indices = np.random.permutation(len(batch_user_indices))
-        return np.array(batch_user_indices)[indices], \
-               np.array(batch_item_indices)[indices], \
-               np.array(batch_label_indices)[indices]
+        return batch_user_indices[indices], batch_item_indices[indices], batch_label_indices[indices]
 
 
 class NegativeSamplingFeat:
@@ -127,8 +234,12 @@ class NegativeSamplingFeat:
         self.i = 0
         self.item_feat = True if dataset.item_feature_cols is not None else False
         self.item_pool = defaultdict(set)
-        self.neg_indices_dict, self.neg_values_dict = self.__neg_feat_dict()
+        self.item_offset = dataset.user_offset + dataset.n_users
+        self.item_indices_table, self.item_values_table = self.__item_feat_table()
+        self.consumed = ConsumedPairs(dataset.train_user_indices, dataset.train_item_indices,
+                                      dataset.n_users, dataset.n_items)
         self.pre_sampling = pre_sampling
+        self.replacement_sampling = replacement_sampling
         if not replacement_sampling:
             self.__init_sampling()
         if not pre_sampling:
@@ -138,34 +249,46 @@ class NegativeSamplingFeat:
             dataset.train_labels = dataset.train_labels[random_mask]
 
     def __init_sampling(self):
-        self.user_negative_pool = {}
-        for u in self.dataset.train_user:
-            self.user_negative_pool[u] = list(set(range(self.dataset.n_items)) - set(self.dataset.train_user[u]))
+        self.negative_cursor = NegativeItemCursor(self.consumed, self.dataset.n_users, self.seed)
 
-    def __neg_feat_dict(self):
+    def __item_feat_table(self):
+        # dense (n_items, n_cols) tables of item feature indices and numerical values,
+        # taken from the first train sample of every item
         if self.item_feat:
-            neg_indices_dict = dict()
-            total_items_col = [-1]  # last col is item
-            total_items_col.extend(self.dataset.item_feature_cols)
-            total_items_unique = np.unique(self.dataset.train_feat_indices[:, total_items_col], axis=0)
-            total_items = total_items_unique[:, 0]
-            total_items_feat_col = np.delete(total_items_unique, 0, axis=1)
-
-            for item, item_feat_col in zip(total_items, total_items_feat_col):
-                neg_indices_dict[item] = item_feat_col.tolist()
-
-            neg_values_dict = dict()
-            for item in range(self.dataset.n_items):
-                item_repr = item + self.dataset.user_offset + self.dataset.n_users
-                item_values = []
-                for num_col in self.dataset.item_numerical_cols:
-                    item_indices = np.where(self.dataset.train_feat_indices[:, -1] == item_repr)[0][0]
-                    item_values.append(self.dataset.train_feat_values[item_indices, num_col])
-                neg_values_dict[item_repr] = item_values
-            return neg_indices_dict, neg_values_dict
+            item_repr, first_rows = np.unique(self.dataset.train_feat_indices[:, -1], return_index=True)
+            items = item_repr - self.item_offset
+            item_indices_table = np.zeros((self.dataset.n_items, len(self.dataset.item_feature_cols)),
+                                          dtype=self.dataset.train_feat_indices.dtype)
+            item_values_table = np.zeros((self.dataset.n_items, len(self.dataset.item_numerical_cols)),
+                                         dtype=self.dataset.train_feat_values.dtype)
+            item_indices_table[items] = self.dataset.train_feat_indices[
+                np.ix_(first_rows, self.dataset.item_feature_cols)]
+            item_values_table[items] = self.dataset.train_feat_values[
+                np.ix_(first_rows, self.dataset.item_numerical_cols)]
+            return item_indices_table, item_values_table
         else:
             return None, None
 
+    def __sample_feat(self, feat_indices, feat_values, feat_labels):
+        # negatives copy the features of their positive sample, with item id and item features replaced
+        users = np.repeat(feat_indices[:, -2] - self.dataset.user_offset, self.num_neg)
+        if self.replacement_sampling:
+            item_neg = self.consumed.sample_negatives(users)
+        else:
+            item_neg = self.negative_cursor.draw(users)
+        neg_indices = np.repeat(feat_indices, self.num_neg, axis=0)
+        neg_values = np.repeat(feat_values, self.num_neg, axis=0)
+        neg_indices[:, -1] = item_neg + self.item_offset
+        if self.item_feat:
+            neg_indices[:, self.dataset.item_feature_cols] = self.item_indices_table[item_neg]
+            neg_values[:, self.dataset.item_numerical_cols] = self.item_values_table[item_neg]
+
+        indices = np.concatenate([feat_indices, neg_indices])
+        values = np.concatenate([feat_values, neg_values])
+        labels = np.concatenate([feat_labels, np.zeros(len(item_neg), dtype=np.float32)])
+        random_mask = np.random.permutation(len(indices))
+        return indices[random_mask], values[random_mask], labels[random_mask]
+
     def __call__(self, mode):
         if mode == "train":
             feat_indices = self.dataset.train_feat_indices
@@ -176,35 +299,7 @@ class NegativeSamplingFeat:
             feat_values = self.dataset.test_feat_values
             feat_labels = self.dataset.test_labels
 
-        indices, values, labels = [], [], []
-        for i, sample in enumerate(feat_indices):
-            ss = sample.tolist()
-            user = ss[-2] - self.dataset.user_offset
-            indices.append(feat_indices[i])
-            values.append(feat_values[i])
-            labels.append(feat_labels[i])
-            for _ in range(self.num_neg):
-                item_neg = np.random.randint(0, self.dataset.n_items)
-                while item_neg in self.dataset.train_user[user]:
-                    item_neg = np.random.randint(0, self.dataset.n_items)
-                item_neg += (self.dataset.user_offset + self.dataset.n_users)
-                ss[-1] = item_neg
-
-                if self.item_feat:
-                    dt = self.neg_indices_dict[item_neg]
-                    for col, orig_col in enumerate(self.dataset.item_feature_cols):
-                        ss[orig_col] = dt[col]
-
-                indices.append(ss)
-                vv = feat_values[i]
-                if self.item_feat:
-                    dv = self.neg_values_dict[item_neg]
-                    for col, orig_col in enumerate(self.dataset.item_numerical_cols):
-                        vv[orig_col] = dv[col]
-                values.append(vv)
-                labels.append(0.0)
-        random_mask = np.random.permutation(range(len(indices)))
-        return np.array(indices)[random_mask], np.array(values)[random_mask], np.array(labels)[random_mask]
+        return self.__sample_feat(feat_indices, feat_values, feat_labels)
 
     def next_batch(self):
         if self.pre_sampling:
@@ -221,37 +316,8 @@ class NegativeSamplingFeat:
             batch_feat_values = self.dataset.train_feat_values[self.i * batch_size: end]
             batch_feat_labels = self.dataset.train_labels[self.i * batch_size: end]
 
-            indices, values, labels = [], [], []
-            for i, sample in enumerate(batch_feat_indices):
-                ss = sample.tolist()
-                user = ss[-2] - self.dataset.user_offset
-                indices.append(batch_feat_indices[i])
-                values.append(batch_feat_values[i])
-                labels.append(batch_feat_labels[i])
-                for _ in range(self.num_neg):
-                    item_neg = np.random.randint(0, self.dataset.n_items)
-                    while item_neg in self.dataset.train_user[user]:
-                        item_neg = np.random.randint(0, self.dataset.n_items)
-                    item_neg += (self.dataset.user_offset + self.dataset.n_users)  # item offset
-                    ss[-1] = item_neg
-
-                    if self.item_feat:
-                        dt = self.neg_indices_dict[item_neg]
-                        for col, orig_col in enumerate(self.dataset.item_feature_cols):
-                            ss[orig_col] = dt[col]
-
-                    indices.append(ss)
-                    vv = batch_feat_values[i]
-                    if self.item_feat:
-                        dv = self.neg_values_dict[item_neg]
-                        for col, orig_col in enumerate(self.dataset.item_numerical_cols):
-                            vv[orig_col] = dv[col]
-                    values.append(vv)
-                    labels.append(0.0)
-
             self.i += 1
-            random_mask = np.random.permutation(len(indices))
-            return np.array(indices)[random_mask], np.array(values)[random_mask], np.array(labels)[random_mask]
+            return self.__sample_feat(batch_feat_indices, batch_feat_values, batch_feat_labels)
 
 
 class PairwiseSampling:
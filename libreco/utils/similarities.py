@@ -1,6 +1,7 @@
 import time
 from collections import defaultdict
 from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
 from scipy.sparse import csr_matrix, lil_matrix, issparse
 from math import sqrt
@@ -93,7 +94,17 @@ def map_func(dataset, sim_func, i, train_ids, min_support=5):
     return [sim_func(dataset, i, other, min_support) for other in train_ids]
 
 
-def get_sim_parallel(data, sim_func, i, ids, n_jobs=4, min_support=5):
+def get_sim_parallel(data, sim_func, i, ids, n_jobs=4, min_support=5,
+                     shared=True):
+    # With shared=True, data are converted to csr arrays placed in shared
+    # memory, every worker computes a contiguous range of rows and writes
+    # them into a shared output, so nothing is pickled per row. Only built-in
+    # cosine, msd and pearson are supported there, others fall back to
+    # Pool.starmap.
+    sim_name = _SHARED_SIM_NAMES.get(sim_func, sim_func)
+    if shared and sim_name in ("cosine", "msd", "pearson"):
+        return _get_sim_shared(data, sim_name, i, ids, n_jobs, min_support)
+
     params = [[data], [sim_func], i, [ids], [min_support]]
     with Pool(processes=n_jobs) as p:
         sim = p.starmap(map_func, itertools.product(*params))
@@ -101,6 +112,100 @@ def get_sim_parallel(data, sim_func, i, ids, n_jobs=4, min_support=5):
     return sim
 
 
+def _get_sim_shared(data, sim_name, i, ids, n_jobs=4, min_support=5):
+    row_ids = np.asarray(list(i), dtype=np.int64)
+    col_ids = np.asarray(list(ids), dtype=np.int64)
+    x_indices, y_indices, values = [], [], []
+    for x, y_labels in data.items():
+        x_indices.extend([x] * len(y_labels))
+        y_indices.extend(y_labels.keys())
+        values.extend(y_labels.values())
+    n_x = max(max(data.keys()), row_ids.max(), col_ids.max()) + 1
+    n_y = max(y_indices) + 1 if y_indices else 1
+    m = csr_matrix((np.array(values, dtype=np.float64),
+                    (np.array(x_indices), np.array(y_indices))),
+                   shape=(n_x, n_y))
+
+    arrays = {"indptr": m.indptr, "indices": m.indices, "data": m.data,
+              "row_ids": row_ids, "col_ids": col_ids,
+              "out": np.zeros((len(row_ids), len(col_ids)))}
+    blocks, specs = [], {}
+    try:
+        for name, array in arrays.items():
+            shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(array.shape, array.dtype, buffer=shm.buf)[:] = array
+            specs[name] = (shm.name, array.shape, array.dtype.str)
+
+        bounds = np.linspace(0, len(row_ids), n_jobs + 1).astype(int)
+        tasks = [(specs, (n_x, n_y), sim_name, min_support, start, end)
+                 for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        with Pool(processes=n_jobs) as p:
+            p.starmap(_shared_sim_worker, tasks)
+        out_name, out_shape, out_dtype = specs["out"]
+        sim = np.ndarray(out_shape, out_dtype, buffer=blocks[-1].buf).copy()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return sim
+
+
+def _shared_sim_worker(specs, shape, sim_name, min_support, start, end):
+    blocks, arrays, m = [], {}, None
+    for name, (shm_name, array_shape, dtype) in specs.items():
+        shm = SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(array_shape, dtype, buffer=shm.buf)
+
+    try:
+        m = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                       shape=shape, copy=False)
+        col = m[arrays["col_ids"]]
+        col_binary, col_square = col.copy(), col.multiply(col).tocsr()
+        col_binary.data = np.ones_like(col_binary.data)
+        # bound dense temporaries to about 4M elements each
+        chunk = max(1, 2 ** 22 // max(1, len(arrays["col_ids"])))
+        for r in range(start, end, chunk):
+            r_end = min(r + chunk, end)
+            arrays["out"][r: r_end] = _sim_rows(
+                m[arrays["row_ids"][r: r_end]], col, col_binary, col_square,
+                sim_name, min_support)
+    finally:
+        # views must be released before closing shared memory
+        del arrays, m
+        for shm in blocks:
+            shm.close()
+
+
+def _sim_rows(row, col, col_binary, col_square, sim_name, min_support):
+    # same formulas as cosine_sim, msd_sim and pearson_sim, computed for
+    # all pairs at once with sparse products over common y
+    row_binary, row_square = row.copy(), row.multiply(row).tocsr()
+    row_binary.data = np.ones_like(row_binary.data)
+    num = (row_binary @ col_binary.T).toarray()
+    prods = (row @ col.T).toarray()
+    sqi = (row_square @ col_binary.T).toarray()
+    sqj = (row_binary @ col_square.T).toarray()
+
+    sim = np.zeros_like(prods)
+    if sim_name == "cosine":
+        denom = np.sqrt(sqi * sqj)
+        np.divide(prods, denom, out=sim, where=denom != 0)
+    elif sim_name == "msd":
+        sq_diff = sqi + sqj - 2 * prods
+        np.divide(num, sq_diff + num, out=sim, where=num != 0)
+    elif sim_name == "pearson":
+        si = (row @ col_binary.T).toarray()
+        sj = (row_binary @ col.T).toarray()
+        denom = np.sqrt(np.maximum(num * sqi - si ** 2, 0) *
+                        np.maximum(num * sqj - sj ** 2, 0))
+        np.divide(num * prods - si * sj, denom, out=sim, where=denom != 0)
+        sim *= num / (num + 10)
+    sim[num < min_support] = 0
+    return sim
+
+
 def invert_sim(data, n_users, min_support=5):
     prods = np.zeros((n_users, n_users))
     num = np.zeros((n_users, n_users))
@@ -131,6 +236,10 @@ def invert_sim(data, n_users, min_support=5):
     return sim
 
 
+_SHARED_SIM_NAMES = {cosine_sim: "cosine", msd_sim: "msd",
+                     pearson_sim: "pearson"}
+
+
 try:
     from .similarities_cy import sk_num
 except:
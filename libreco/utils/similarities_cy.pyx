@@ -2,6 +2,8 @@ cimport numpy as np
 import numpy as np
 cimport cython
 from libc.math cimport sqrt, pow
+from libc.stdlib cimport malloc, calloc, free
+from scipy.sparse import csr_matrix
 
 
 @cython.boundscheck(False)
@@ -88,11 +90,141 @@ def pearson_cy(n, data, min_support=5):
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def sk_num(n, data):
-    cdef np.ndarray[np.int_t, ndim=2] num = np.zeros((n, n), np.intc)
+    cdef int[:, :] num = np.zeros((n, n), np.intc)
     cdef int ui, uj
 
     for i, users in data.items():
         for ui in users:
             for uj in users:
                 num[ui, uj] += 1
-    return num
\ No newline at end of file
+    return np.asarray(num)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _sparse_cooccurrence(const int[:] x_indptr, const int[:] x_indices, 
+                               const float[:] x_data, const int[:] y_indptr, 
+                               const int[:] y_indices, const float[:] y_data, 
+                               int n, int min_support, bint pearson, bint fill, 
+                               int[:] res_indptr, int[:] res_indices, 
+                               float[:] res_data) nogil:
+    # Sparse accumulator over observed pairs only: for every x1, walk its
+    # co-occurring x2 through the shared y, so only touched x2 are ever
+    # visited and reset. With `fill` false only row lengths are counted.
+    cdef int x1, x2, y, p, q, t, n_touched, pos
+    cdef double ri, rj, num, denum, sim
+    cdef int *freq = <int *> calloc(n, sizeof(int))
+    cdef int *touched = <int *> malloc(sizeof(int) * n)
+    cdef double *prods = NULL
+    cdef double *sqi = NULL
+    cdef double *sqj = NULL
+    cdef double *si = NULL
+    cdef double *sj = NULL
+    if fill:
+        prods = <double *> calloc(n, sizeof(double))
+        sqi = <double *> calloc(n, sizeof(double))
+        sqj = <double *> calloc(n, sizeof(double))
+        if pearson:
+            si = <double *> calloc(n, sizeof(double))
+            sj = <double *> calloc(n, sizeof(double))
+
+    for x1 in range(n):
+        n_touched = 0
+        for p in range(x_indptr[x1], x_indptr[x1 + 1]):
+            y = x_indices[p]
+            ri = x_data[p]
+            for q in range(y_indptr[y], y_indptr[y + 1]):
+                x2 = y_indices[q]
+                if freq[x2] == 0:
+                    touched[n_touched] = x2
+                    n_touched += 1
+                freq[x2] += 1
+                if fill:
+                    rj = y_data[q]
+                    prods[x2] += ri * rj
+                    sqi[x2] += ri * ri
+                    sqj[x2] += rj * rj
+                    if pearson:
+                        si[x2] += ri
+                        sj[x2] += rj
+
+        pos = res_indptr[x1] if fill else 0
+        for t in range(n_touched):
+            x2 = touched[t]
+            if x2 == x1 or freq[x2] >= min_support:
+                if fill:
+                    if x2 == x1:
+                        sim = 1.0
+                    elif pearson:
+                        num = freq[x2] * prods[x2] - si[x2] * sj[x2]
+                        denum = sqrt((freq[x2] * sqi[x2] - si[x2] * si[x2]) * 
+                                     (freq[x2] * sqj[x2] - sj[x2] * sj[x2]))
+                        sim = 0.0 if denum == 0.0 else num / denum
+                    else:
+                        denum = sqrt(sqi[x2] * sqj[x2])
+                        sim = 0.0 if denum == 0.0 else prods[x2] / denum
+                    res_indices[pos] = x2
+                    res_data[pos] = sim
+                pos += 1
+
+            freq[x2] = 0
+            if fill:
+                prods[x2] = 0.0
+                sqi[x2] = 0.0
+                sqj[x2] = 0.0
+                if pearson:
+                    si[x2] = 0.0
+                    sj[x2] = 0.0
+
+        if not fill:
+            res_indptr[x1 + 1] = pos
+
+    free(freq)
+    free(touched)
+    free(prods)
+    free(sqi)
+    free(sqj)
+    free(si)
+    free(sj)
+
+
+def _sparse_sim(n, sparse_data, min_support, pearson):
+    # sparse_data: csr_matrix, rows are the shared context (e.g. users for
+    # item similarity) and columns are the n objects being compared.
+    y_major = sparse_data.tocsr()
+    x_major = y_major.tocsc()
+    y_indptr = y_major.indptr.astype(np.intc)
+    y_indices = y_major.indices.astype(np.intc)
+    y_data = y_major.data.astype(np.float32)
+    x_indptr = x_major.indptr.astype(np.intc)
+    x_indices = x_major.indices.astype(np.intc)
+    x_data = x_major.data.astype(np.float32)
+
+    cdef int[:] res_indptr = np.zeros(n + 1, dtype=np.intc)
+    cdef int[:] empty_indices = np.zeros(0, dtype=np.intc)
+    cdef float[:] empty_data = np.zeros(0, dtype=np.float32)
+    # first pass only counts the kept pairs of every row
+    _sparse_cooccurrence(x_indptr, x_indices, x_data, y_indptr, y_indices,
+                         y_data, n, min_support, pearson, False,
+                         res_indptr, empty_indices, empty_data)
+
+    indptr = np.cumsum(np.asarray(res_indptr), dtype=np.intc)
+    cdef int[:] res_indices = np.zeros(indptr[n], dtype=np.intc)
+    cdef float[:] res_data = np.zeros(indptr[n], dtype=np.float32)
+    _sparse_cooccurrence(x_indptr, x_indices, x_data, y_indptr, y_indices,
+                         y_data, n, min_support, pearson, True,
+                         indptr, res_indices, res_data)
+
+    sim = csr_matrix((np.asarray(res_data), np.asarray(res_indices), indptr),
+                     shape=(n, n), dtype=np.float32)
+    sim.sort_indices()
+    return sim
+
+
+def cosine_sparse_cy(n, sparse_data, min_support=5):
+    return _sparse_sim(n, sparse_data, min_support, False)
+
+
+def pearson_sparse_cy(n, sparse_data, min_support=5):
+    return _sparse_sim(n, sparse_data, min_support, True)
@@ -45,7 +45,7 @@ extensions = [
               [os.path.join("libreco", "algorithms", "superSVD_cys" + ext)], 
               include_dirs=[np.get_include()]),
     Extension('libreco.algorithms.Als_cy',
-              [os.path.join("libreco", "algorithms", "Als_cy" + ext)], 
+              [os.path.join("libreco", "algorithms", "_als" + ext)], 
               extra_compile_args=compile_args, 
               extra_link_args=link_args),
     Extension('libreco.similarities_cy',